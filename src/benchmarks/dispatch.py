@@ -0,0 +1,80 @@
+"""
+Benchmark WorkerPool task dispatch cost as the number of workers and the queue depth grow.
+
+Usage (from src/): python -m benchmarks.dispatch
+"""
+import asyncio
+import contextlib
+import io
+import os
+import time
+from asyncio import Future
+from types import SimpleNamespace
+
+os.environ.setdefault('MYSQL_URL', 'sqlite://:memory:')
+
+from starlette.websockets import WebSocketState
+
+from coordinator import WorkerPool, SlotPool
+from utils.models import ConnectedWorker, Task, TaskState
+
+
+class FakeWS:
+    """Websocket stand-in that accepts every message instantly"""
+    client_state = WebSocketState.CONNECTED
+
+    def __init__(self, i: int):
+        self.client = SimpleNamespace(host=f'10.0.{i // 256}.{i % 256}')
+
+    async def send_bytes(self, b: bytes):
+        pass
+
+
+def new_pool() -> WorkerPool:
+    pool = WorkerPool()
+    pool.pool = []
+    pool.running_tasks = {}
+    pool.queued_tasks.clear()
+    pool.slots = SlotPool()
+    return pool
+
+
+async def bench(workers: int, depth: int, max_tasks: int = 4) -> float:
+    """
+    Fill every worker to half of its capacity, queue `depth` tasks, then measure the time of
+    dispatching as many tasks as there are free slots.
+
+    :return: Microseconds per dispatched task
+    """
+    pool = new_pool()
+    for i in range(workers):
+        w = ConnectedWorker(None, None, FakeWS(i), max_tasks)
+        pool.pool.append(w)
+        pool.slots.add(w)
+
+    # Occupy half of the slots with running tasks
+    for i in range(workers * max_tasks // 2):
+        w = pool.slots.acquire()
+        pool.running_tasks[f'r{i}'] = TaskState(Task(f'r{i}', 'compute_audio', {}), Future(), {w: 0})
+
+    for i in range(depth):
+        pool.queued_tasks.append(TaskState(Task(f'q{i}', 'compute_audio', {}), Future()))
+
+    dispatched = min(depth, workers * max_tasks - workers * max_tasks // 2)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        await pool.check_queue()
+        elapsed = time.perf_counter() - start
+
+    return elapsed / dispatched * 1e6
+
+
+async def main():
+    print(f'{"workers":>8} {"queue":>8} {"us/task":>10}')
+    for workers in [10, 100, 500, 1000, 5000]:
+        for depth in [100, 1000, 10000]:
+            print(f'{workers:>8} {depth:>8} {await bench(workers, depth):>10.2f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""
+Benchmark the token lookup of worker handshakes when thousands of workers reconnect at once,
+e.g. after a coordinator restart.
+
+Compares the old lookup by the full token in a non-indexed column with the lookup by an indexed
+digest, with a cold and with a warmed approval cache. Uses an SQLite file database.
+
+Usage (from src/): python -m benchmarks.handshake [workers]
+"""
+import asyncio
+import random
+import string
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from tortoise import Tortoise, fields
+from tortoise.models import Model
+
+from database.db import Worker
+from utils.approval import ApprovalCache, token_digest
+from utils.models import TOKEN_RE
+
+
+class LegacyWorker(Model):
+    """Worker table as it was before token digests"""
+    id = fields.IntField(pk=True)
+    token = fields.CharField(max_length=2048)
+    approved = fields.BooleanField(default=True)
+
+
+def random_token() -> str:
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=2048))
+
+
+async def storm(tokens: list[str], handshake) -> float:
+    """Run every handshake concurrently, return the elapsed seconds"""
+    start = time.perf_counter()
+    await asyncio.gather(*[handshake(t) for t in tokens])
+    return time.perf_counter() - start
+
+
+async def main(n: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        await Tortoise.init(db_url=f'sqlite://{Path(tmp) / "db.sqlite3"}',
+                            modules={'models': ['database.db', __name__]})
+        await Tortoise.generate_schemas()
+
+        tokens = [random_token() for _ in range(n)]
+        await LegacyWorker.bulk_create([LegacyWorker(token=t) for t in tokens])
+        await Worker.bulk_create([Worker(token_digest=token_digest(t)) for t in tokens])
+        random.shuffle(tokens)
+
+        async def legacy(token: str):
+            assert TOKEN_RE.match(token)
+            worker, _ = await LegacyWorker.get_or_create(token=token)
+            assert worker.approved
+
+        def digest(cache: ApprovalCache):
+            async def handshake(token: str):
+                assert TOKEN_RE.match(token)
+                worker, _ = await cache.get(token_digest(token))
+                assert worker.approved
+            return handshake
+
+        print(f'{n} workers reconnecting at once')
+        print(f'{"lookup":>28} {"total s":>9} {"ms/worker":>10} {"queries":>8}')
+
+        t = await storm(tokens, legacy)
+        print(f'{"token, no index":>28} {t:>9.3f} {t / n * 1000:>10.3f} {n:>8}')
+
+        cold = ApprovalCache(300, 100_000)
+        t = await storm(tokens, digest(cold))
+        print(f'{"digest, cold cache":>28} {t:>9.3f} {t / n * 1000:>10.3f} {cold.stats.misses:>8}')
+
+        warm = ApprovalCache(300, 100_000)
+        start = time.perf_counter()
+        await warm.warm()
+        t = time.perf_counter() - start + await storm(tokens, digest(warm))
+        print(f'{"digest, warmed cache":>28} {t:>9.3f} {t / n * 1000:>10.3f} {warm.stats.misses + 1:>8}')
+
+        # A second storm, e.g. after a network outage, is served from the cache
+        t = await storm(tokens, digest(warm))
+        print(f'{"digest, reconnect again":>28} {t:>9.3f} {t / n * 1000:>10.3f} {warm.stats.misses:>8}')
+
+        await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000))
@@ -0,0 +1,98 @@
+"""
+Check that the NumPy mel spectrogram backend matches tfio, then compare their speed on CPU.
+
+Parity is checked on noise and on synthetic voice at common sample rates, including clips shorter
+than one frame. Exits with status 1 if any spectrogram differs by more than the tolerance, relative to
+its largest value.
+
+Usage (from src/): python -m benchmarks.mel [seconds...]
+       python -m benchmarks.mel --reference    (rewrite the reference of tests/test_mel.py)
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+import numpy as np
+
+from benchmarks.segmenter import synthetic_clip
+from utils.mel import mel_filterbank, mel_spectrogram, spectrogram
+
+TOLERANCE = 1e-4
+RATES = (16000, 22050, 44100, 48000)
+REFERENCE = Path(__file__).parent.parent / 'tests' / 'data' / 'mel_reference.npz'
+
+
+def relative_error(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.abs(a - b).max() / max(np.abs(a).max(), 1e-12)) if a.size else 0.0
+
+
+def signals(rng: np.random.Generator, sr: int) -> dict[str, np.ndarray]:
+    voice = synthetic_clip(rng, 5)
+    return {
+        'noise': (rng.standard_normal(sr * 3 + 123) * 0.1).astype(np.float32),
+        'voice': np.interp(np.arange(len(voice) * sr // 16000) * 16000 / sr, np.arange(len(voice)), voice)
+        .astype(np.float32),
+        'short': (rng.standard_normal(300) * 0.1).astype(np.float32),
+    }
+
+
+def parity() -> bool:
+    import tensorflow as tf
+    import tensorflow_io as tfio
+
+    print(f'{"sr":>6} {"signal":>7} {"frames":>7} {"filterbank":>11} {"spectrogram":>12} {"mel":>10}')
+    ok = True
+    rng = np.random.default_rng(0)
+    for sr in RATES:
+        fb = relative_error(tf.signal.linear_to_mel_weight_matrix(128, 1025, sr, 0, 8000).numpy(),
+                            mel_filterbank(sr, 2048, 128, 0, 8000))
+        for name, y in signals(rng, sr).items():
+            spec = relative_error(tfio.audio.spectrogram(y, 2048, 2048, 512).numpy(), spectrogram(y, 2048, 2048, 512))
+            expected = mel_spectrogram(y, sr, backend='tfio')
+            actual = mel_spectrogram(y, sr, backend='numpy')
+            mel = relative_error(expected, actual) if expected.shape == actual.shape else float('inf')
+            ok &= max(fb, spec, mel) <= TOLERANCE
+            print(f'{sr:>6} {name:>7} {len(actual):>7} {fb:>11.2e} {spec:>12.2e} {mel:>10.2e}')
+    return ok
+
+
+def reference(path: Path = REFERENCE, sr: int = 16000):
+    """Store the tf.signal / tfio filterbank and spectrograms of a fixed chirp for tests/test_mel.py"""
+    import tensorflow as tf
+    import tensorflow_io as tfio
+
+    t = np.arange(4801) / sr
+    y = (0.3 * np.sin(2 * np.pi * (150 * t + 400 * t ** 2)) + 0.1 * np.sin(2 * np.pi * 2500 * t) * np.exp(-5 * t))
+    y = y.astype(np.float32)
+    np.savez_compressed(path, y=y, filterbank=tf.signal.linear_to_mel_weight_matrix(128, 1025, sr, 0, 8000).numpy(),
+                        spectrogram=tfio.audio.spectrogram(y, 2048, 2048, 512).numpy(),
+                        mel=mel_spectrogram(y, sr, backend='tfio'))
+    print(f'> [+] Wrote {path}')
+
+
+def speed(durations: list[float], sr: int = 44100, repeat: int = 5):
+    rng = np.random.default_rng(1)
+    print(f'\n{"audio s":>8} {"tfio s":>9} {"numpy s":>9} {"speedup":>8}')
+    for seconds in durations:
+        y = (rng.standard_normal(int(sr * seconds)) * 0.1).astype(np.float32)
+        times = {}
+        for backend in ('tfio', 'numpy'):
+            mel_spectrogram(y[:sr], sr, backend=backend)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                mel_spectrogram(y, sr, backend=backend)
+            times[backend] = (time.perf_counter() - start) / repeat
+        print(f'{seconds:>8g} {times["tfio"]:>9.4f} {times["numpy"]:>9.4f} {times["tfio"] / times["numpy"]:>7.2f}x')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--reference']:
+        reference()
+        sys.exit(0)
+    ok = parity()
+    print('Parity', 'passed' if ok else f'FAILED (tolerance {TOLERANCE})')
+    speed([float(a) for a in sys.argv[1:]] or [5, 60, 600])
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,172 @@
+"""
+Simulate task placement on a fleet of workers with different speeds, on a virtual clock.
+
+Compares speed-blind placement (the least-loaded free worker takes the next task in queue order)
+with cost-aware placement (fastest free worker first, largest of the first queued tasks, long tasks
+may wait for a much faster worker, speeds learned from calibration and observed runtimes). Reports
+the makespan of a burst of tasks and the latency percentiles of a steady stream of tasks.
+
+Usage (from src/): python -m benchmarks.placement [tasks] [seed]
+"""
+import asyncio
+import contextlib
+import heapq
+import io
+import itertools
+import os
+import sys
+import time
+from asyncio import Future
+from types import SimpleNamespace
+
+import numpy as np
+
+os.environ.setdefault('MYSQL_URL', 'sqlite://:memory:')
+
+import coordinator
+from coordinator import WorkerPool, SlotPool
+from utils.models import ConnectedWorker, Task, TaskState, WorkerInfo
+from utils.protocol import decode_message
+
+# (true speed in audio seconds per second per slot, number of workers), 2 slots each
+FLEET = [(0.5, 6), (2, 4), (8, 2)]
+SLOTS = 2
+
+
+class Sim:
+    """Discrete event simulation, tasks finish after duration / speed of their worker"""
+
+    def __init__(self, aware: bool, rng: np.random.Generator):
+        self.now = 0.0
+        self.events = []
+        self.seq = itertools.count()
+        self.latencies: dict[str, float] = {}
+        self.started: dict[str, float] = {}
+        self.finished = 0.0
+
+        coordinator.time = SimpleNamespace(monotonic=lambda: self.now, perf_counter=time.perf_counter)
+        if not aware:
+            coordinator.PLACEMENT_WINDOW = 1
+            coordinator.HOLD_MIN_SECONDS = float('inf')
+            coordinator.WorkerPool.observe_speed = lambda *_: None
+        else:
+            restore_defaults()
+
+        self.pool = WorkerPool()
+        self.pool.slots = SlotPool()
+        for true_speed, n in FLEET:
+            for _ in range(n):
+                calibrated = true_speed * rng.uniform(0.7, 1.3)
+                info = WorkerInfo('', 0, SLOTS, '', '', {}, speed=calibrated if aware else 0)
+                w = ConnectedWorker(info, None, FakeWS(self, true_speed), SLOTS, speed=self.pool.initial_speed(info))
+                self.pool.pool.append(w)
+                self.pool.slots.add(w)
+
+    def at(self, t: float, fn):
+        heapq.heappush(self.events, (t, next(self.seq), fn))
+
+    def submit(self, duration: float):
+        id = f't{next(self.seq)}'
+        self.started[id] = self.now
+        ts = TaskState(Task(id, 'compute_audio', {}, duration), Future())
+        ts.future.add_done_callback(lambda _: self.done(id))
+        self.pool.enqueue(ts)
+
+    def done(self, id: str):
+        self.latencies[id] = self.now - self.started[id]
+        self.finished = max(self.finished, self.now)
+
+    async def run(self):
+        # Stand-in for the watchdog, which re-checks the queue every second
+        async def tick():
+            await self.pool.check_queue()
+            if self.events or self.pool.queued_tasks:
+                self.at(self.now + 1, tick)
+        self.at(0, tick)
+
+        while self.events:
+            self.now, _, fn = heapq.heappop(self.events)
+            await fn()
+
+            # Run the done callbacks of resolved tasks at the current time
+            await asyncio.sleep(0)
+
+
+class FakeWS:
+    """Worker connection that completes every task after duration / speed"""
+
+    def __init__(self, sim: Sim, speed: float):
+        self.sim = sim
+        self.speed = speed
+        self.client = SimpleNamespace(host=f'speed {speed}')
+        self.client_state = coordinator.WebSocketState.CONNECTED
+
+    async def send_bytes(self, b: bytes):
+        t = Task.from_header(decode_message(b).header)
+        worker = next(w for w in self.sim.pool.pool if w.ws is self)
+
+        async def finish():
+            self.sim.pool.resolve(t.id, worker, b'')
+            await self.sim.pool.check_queue()
+        self.sim.at(self.sim.now + t.duration / self.speed, finish)
+
+
+DEFAULTS = {k: getattr(coordinator, k) for k in ('PLACEMENT_WINDOW', 'HOLD_MIN_SECONDS')}
+OBSERVE = coordinator.WorkerPool.observe_speed
+
+
+def restore_defaults():
+    """Undo the speed-blind settings"""
+    for k, v in DEFAULTS.items():
+        setattr(coordinator, k, v)
+    coordinator.WorkerPool.observe_speed = OBSERVE
+
+
+def durations(rng: np.random.Generator, n: int) -> np.ndarray:
+    """Mostly short clips with a heavy tail of long recordings"""
+    return np.clip(rng.lognormal(np.log(20), 1.2, n), 1, 1800)
+
+
+async def burst(aware: bool, n: int, seed: int) -> float:
+    rng = np.random.default_rng(seed)
+    sim = Sim(aware, rng)
+    for d in durations(rng, n):
+        sim.submit(float(d))
+    await sim.run()
+    return sim.finished
+
+
+async def stream(aware: bool, n: int, seed: int, load: float = 0.8) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    sim = Sim(aware, rng)
+    ds = durations(rng, n)
+    capacity = sum(speed * count * SLOTS for speed, count in FLEET)
+    rate = load * capacity / ds.mean()
+
+    t = 0.0
+    for d in ds:
+        t += rng.exponential(1 / rate)
+
+        async def arrive(d=d):
+            sim.submit(float(d))
+            await sim.pool.check_queue()
+        sim.at(t, arrive)
+    await sim.run()
+    return np.array(list(sim.latencies.values()))
+
+
+async def main(n: int, seed: int):
+    print(f'Fleet: {", ".join(f"{c} x speed {s}" for s, c in FLEET)}, {SLOTS} slots each, {n} tasks')
+    print(f'{"placement":>12} {"makespan s":>11} {"p50 s":>8} {"p95 s":>8} {"p99 s":>8}')
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = []
+        for aware in (False, True):
+            makespan = await burst(aware, n, seed)
+            lat = await stream(aware, n, seed)
+            rows.append((aware, makespan, *np.percentile(lat, [50, 95, 99])))
+    for aware, makespan, p50, p95, p99 in rows:
+        print(f'{"cost-aware" if aware else "speed-blind":>12} {makespan:>11.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500, int(sys.argv[2]) if len(sys.argv) > 2 else 0))
@@ -0,0 +1,66 @@
+"""
+Benchmark the coordinator-worker wire protocol against the previous pickle messages.
+
+Usage (from src/): python -m benchmarks.protocol
+"""
+import os
+import timeit
+from dataclasses import dataclass
+from typing import Callable
+
+from hypy_utils.serializer import pickle_encode, pickle_decode
+
+from utils.models import Task
+from utils.protocol import encode_message, encode_parts, decode_message, COMPUTE, CHUNK, RESULT
+
+
+@dataclass()
+class PickledTask:
+    """Task as it was sent before, with the function object itself"""
+    id: str
+    fn: Callable
+    params: dict
+    duration: float
+    size: int
+    audio: str
+
+
+def compute_audio(file: bytes, file_name: str) -> bytes:
+    """Stand-in for tasks.compute_audio, pickle only stores a reference to it"""
+
+
+ID = '5b71d8ae-f33b-4301-810e-8398457e5dd8'
+SHA = 'b53a271520fb12a9f2e52a9dfa7cd45b842453624553758ac56cdca93516e6f7'
+PARAMS = {'file_name': 'voice.ogg', 'with_mel_spect': False}
+CHUNK_DATA = os.urandom(256 * 1024)
+RESULT_DATA = os.urandom(4 * 1024 * 1024)
+
+CASES = {
+    'compute': (
+        lambda: pickle_encode({'type': 'compute', 'task': PickledTask(ID, compute_audio, PARAMS, 12.5, 48000, SHA)}),
+        lambda: encode_message(COMPUTE, Task(ID, 'compute_audio', PARAMS, 12.5, 48000, SHA).to_header()),
+    ),
+    'chunk 256K': (
+        lambda: pickle_encode({'type': 'chunk', 'id': ID, 'offset': 0, 'data': CHUNK_DATA}),
+        lambda: encode_message(CHUNK, {'id': ID, 'offset': 0}, {'data': CHUNK_DATA}),
+    ),
+    'result 4M': (
+        lambda: pickle_encode({'type': 'result', 'id': ID, 'result': RESULT_DATA}),
+        # Workers send results as fragments without joining them
+        lambda: encode_parts(RESULT, {'id': ID}, {'result': RESULT_DATA}),
+    ),
+}
+
+
+def us(fn: Callable, n: int) -> float:
+    return min(timeit.repeat(fn, number=n, repeat=5)) / n * 1e6
+
+
+if __name__ == '__main__':
+    print(f'{"message":<12} {"format":<8} {"bytes":>10} {"encode us":>10} {"decode us":>10}')
+    for name, (old, new) in CASES.items():
+        n = 20000 if name == 'compute' else 200
+        for fmt, enc, dec in [('pickle', old, pickle_decode), ('binary', new, decode_message)]:
+            msg = enc()
+            msg = b''.join(msg) if isinstance(msg, list) else msg
+            print(f'{name:<12} {fmt:<8} {len(msg):>10} {us(enc, n):>10.2f} {us(lambda: dec(msg), n):>10.2f}')
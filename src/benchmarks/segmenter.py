@@ -0,0 +1,56 @@
+"""
+Benchmark batched Segmenter inference: segment synthetic clips one file per forward pass, then in
+batches of several files like a worker's batch process, and compare throughput and results.
+
+Usage (from src/): python -m benchmarks.segmenter [files] [seconds per file] [batch sizes...]
+"""
+import sys
+import time
+
+import numpy as np
+
+SR = 16000
+
+
+def synthetic_clip(rng: np.random.Generator, seconds: float) -> np.ndarray:
+    """Voiced-like harmonics with pauses, 16 kHz mono float32"""
+    t = np.arange(int(seconds * SR)) / SR
+    f0 = rng.uniform(90, 250) * (1 + 0.05 * np.sin(2 * np.pi * 3 * t))
+    voice = sum(np.sin(2 * np.pi * np.cumsum(f0 * k) / SR) / k for k in range(1, 8))
+    gate = (np.sin(2 * np.pi * 0.4 * t + rng.uniform(0, np.pi)) > -0.3).astype(float)
+    y = voice * gate + rng.normal(0, 0.01, len(t))
+    return (y / np.abs(y).max() * 0.5).astype(np.float32)
+
+
+def main(n: int, seconds: float, sizes: list[int]):
+    from tasks import Audio, load, segment_batch, segment_features
+
+    seg = load()
+    rng = np.random.default_rng(42)
+    feats = [segment_features(Audio(synthetic_clip(rng, seconds), SR)) for _ in range(n)]
+
+    # Warm up the networks
+    segment_batch(seg, feats[:2])
+
+    print(f'{n} files of {seconds} s')
+    print(f'{"batch":>6} {"total s":>9} {"files/s":>9} {"speedup":>8} {"max conf diff":>14}')
+    baseline, reference = None, None
+    for size in [1, *sizes]:
+        start = time.perf_counter()
+        results = []
+        for i in range(0, n, size):
+            results += segment_batch(seg, feats[i:i + size])
+        t = time.perf_counter() - start
+
+        if reference is None:
+            baseline, reference = t, results
+        same = all([s[:3] for s in a] == [s[:3] for s in b] for a, b in zip(reference, results))
+        diff = max((abs(x[3] - y[3]) for a, b in zip(reference, results) for x, y in zip(a, b)), default=0)
+        print(f'{size:>6} {t:>9.3f} {n / t:>9.2f} {baseline / t:>7.2f}x {diff:>14.2e}'
+              f'{"" if same else "  (segments differ)"}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 32, float(args[1]) if len(args) > 1 else 10,
+         [int(a) for a in args[2:]] or [2, 4, 8, 16])
@@ -0,0 +1,68 @@
+"""
+Benchmark the startup cost of each process role: import time, resident memory, and whether the
+model stack (TensorFlow, the Segmenter) got loaded.
+
+The coordinator and the worker's main process should only depend on task names, the task processes
+of workers load the models once when they start. Each role is measured in a fresh interpreter.
+
+Usage (from src/): python -m benchmarks.startup [repeats]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+SRC = Path(__file__).parent.parent.absolute()
+
+# Modules that should only be loaded in task processes
+HEAVY = ('tensorflow', 'tensorflow_io', 'inaSpeechSegmenter', 'parselmouth', 'sgs')
+
+# Role name mapped to the code that starts it
+ROLES = {
+    'coordinator': 'import coordinator',
+    'worker': 'import worker',
+    'task process': 'from utils import registry; registry.warm()',
+}
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+import psutil
+print(json.dumps({{'seconds': elapsed, 'rss': psutil.Process().memory_info().rss,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def measure(code: str, cwd: str) -> dict:
+    """Run code in a new interpreter, return its import time, memory and loaded heavy modules"""
+    # The database is only connected on startup, not on import
+    env = {'MYSQL_URL': f'sqlite://{cwd}/db.sqlite3', **os.environ, 'PYTHONPATH': str(SRC),
+           'COORDINATOR_HOST': '127.0.0.1:8000'}
+    p = subprocess.run([sys.executable, '-c', PROBE.format(code=code, heavy=HEAVY)],
+                       cwd=cwd, env=env, capture_output=True, text=True)
+    if p.returncode != 0:
+        return {'error': p.stderr.strip().splitlines()[-1]}
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def main(repeats: int):
+    print(f'{"role":>14} {"import s":>9} {"RSS MiB":>8}  model stack')
+    with tempfile.TemporaryDirectory() as tmp:
+        for role, code in ROLES.items():
+            runs = [measure(code, tmp) for _ in range(repeats)]
+            if 'error' in runs[0]:
+                print(f'{role:>14} failed: {runs[0]["error"]}')
+                continue
+
+            seconds = min(r['seconds'] for r in runs)
+            rss = min(r['rss'] for r in runs) / 1024 / 1024
+            heavy = ', '.join(runs[0]['heavy']) or '-'
+            print(f'{role:>14} {seconds:>9.3f} {rss:>8.1f}  {heavy}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,72 @@
+"""
+Benchmark the voice activity pre-pass: run the Praat and mel stages on synthetic speech padded with
+near-silent noise, over the whole recording and restricted to the detected speech, and compare their
+time and results.
+
+Usage (from src/): python -m benchmarks.vad [speech seconds] [padding seconds...]
+"""
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.segmenter import SR, synthetic_clip
+
+# Level of the padding, like the noise floor of a quiet room on a phone microphone
+NOISE = 3e-4
+
+
+def padded_clip(rng: np.random.Generator, speech: float, padding: float) -> np.ndarray:
+    """Synthetic speech with `padding` seconds of noise split between the start and the end"""
+    lead = rng.uniform(0.2, 0.8) * padding
+    noise = (rng.standard_normal(int(padding * SR)) * NOISE).astype(np.float32)
+    split = int(lead * SR)
+    return np.concatenate([noise[:split], synthetic_clip(rng, speech), noise[split:]])
+
+
+def timed(fn, *args) -> tuple[float, any]:
+    start = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - start, out
+
+
+def main(speech: float, paddings: list[float]):
+    from sgs.config import sgs_config
+
+    from tasks import Audio, mel, praat
+    from utils import vad
+    from utils.vad import speech as detect
+
+    # Compared with and without it, whatever the environment says
+    vad.VAD = True
+    sgs_config.time_step = 0.01
+    rng = np.random.default_rng(42)
+    praat(Audio(synthetic_clip(rng, 1), SR))
+
+    print(f'{speech:g} s of speech at {SR} Hz')
+    print(f'{"padding":>8} {"kept":>6} {"vad s":>7} {"praat s whole/vad":>17} {"mel s whole/vad":>17} '
+          f'{"speedup":>8} {"pitch diff":>11} {"voiced rows":>12}')
+    for padding in paddings:
+        audio = Audio(padded_clip(rng, speech, padding), SR)
+        t_vad, regions = timed(detect, audio, 512)
+        kept = 1 if regions is None else (regions[:, 1] - regions[:, 0]).sum() / len(audio.y)
+
+        t_praat, (result, freq) = timed(praat, audio)
+        t_praat_vad, (result_vad, freq_vad) = timed(praat, audio, regions)
+        t_mel, _ = timed(mel, audio)
+        t_mel_vad, _ = timed(mel, audio, regions)
+
+        # Pitch mean, and rows that are voiced in both analyses
+        diff = abs(result['means']['pitch'] - result_vad['means']['pitch'])
+        n = min(len(freq), len(freq_vad))
+        voiced = ~np.isnan(freq[:n, 0])
+        matched = (voiced & ~np.isnan(freq_vad[:n, 0])).sum() / max(voiced.sum(), 1)
+
+        speedup = (t_praat + t_mel) / (t_vad + t_praat_vad + t_mel_vad)
+        print(f'{padding:>7g}s {kept:>6.0%} {t_vad:>7.4f} {t_praat:>8.3f} {t_praat_vad:>8.3f} '
+              f'{t_mel:>8.3f} {t_mel_vad:>8.3f} {speedup:>7.2f}x {diff:>8.2f} Hz {matched:>12.1%}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(float(args[0]) if args else 10, [float(a) for a in args[1:]] or [0, 2, 5, 10, 30, 60])
@@ -53,12 +53,12 @@ def bdict_encode(d: dict[str, bytes | str]) -> bytes:
     # return ZSTD_compress(bytes(b), 19, CPU_COUNT)
 
 
-def bdict_decode(b: bytes) -> dict[str, bytes]:
+def bdict_decode(b: bytes | memoryview) -> dict[str, bytes | memoryview]:
     """
     Decode byte array dictionary
 
-    :param b:
-    :return:
+    :param b: Encoded bytes. If it is a memoryview, the values are views into it and not copied.
+    :return: Decoded dict
     """
     # b = ZSTD_uncompress(b)
     i = 0
@@ -70,7 +70,7 @@ def bdict_decode(b: bytes) -> dict[str, bytes]:
         i += INT
         lv = int.from_bytes(b[i: i + INT], 'big')
         i += INT
-        k = b[i: i + lk].decode('utf-8')
+        k = bytes(b[i: i + lk]).decode('utf-8')
         i += lk
         v = b[i: i + lv]
         i += lv
@@ -3,13 +3,11 @@ import os
 import sys
 import warnings
 from dataclasses import dataclass
-from datetime import datetime
 from pathlib import Path
 
 import matplotlib
 import numpy as np
 import telegram
-from inaSpeechSegmenter import Segmenter
 from inaSpeechSegmenter.constants import ResultFrame
 from telegram import Update, Message, Bot, ParseMode
 from telegram.ext import Updater, CallbackContext, Dispatcher, CommandHandler, MessageHandler, \
@@ -17,8 +15,10 @@ from telegram.ext import Updater, CallbackContext, Dispatcher, CommandHandler, M
 
 sys.path.append(str(Path(__file__).parent.parent))
 
-from tasks import compute_audio_raw
-from bot import utils, web
+from tasks import compute_audio_raw, load
+from utils.decode import Audio, decode
+from utils.results import COMPONENTS
+from bot import web
 from bot.web import save_process_results
 from bot.render import draw_ml, draw_mspect
 
@@ -47,6 +47,10 @@ class AnalyzeComponents:
 
         return out
 
+    def components(self) -> tuple[str, ...]:
+        """Components of the analysis to compute, see utils.results.COMPONENTS"""
+        return tuple(c for c in COMPONENTS if getattr(self, c))
+
 
 def r(u: Update, msg: str, md=True):
     """
@@ -65,14 +69,14 @@ def get_result_url(uuid: str):
     # return f"http://localhost:5173/result/{uuid}"
 
 
-def send_ml(file: Path, segment: list[ResultFrame], uuid: str, msg: Message):
+def send_ml(audio: Audio, segment: list[ResultFrame], uuid: str, msg: Message):
     """
     Draw and send ML prediction to chat
     """
     assert len(segment), '分析失败, 大概是音量太小或者时长太短吧, 再试试w'
 
     # Draw results
-    with draw_ml(str(file), segment) as buf:
+    with draw_ml(audio.y, audio.sr, segment) as buf:
         f, m, o, pf = get_result_percentages(segment)
         send = f"CNN 模型分析结果: {f*100:.0f}% 🙋‍♀️ | {m*100:.0f}% 🙋‍♂️ | {o*100:.0f}% 🚫\n" \
                f"(结果仅供参考, 如果结果不是你想要的，那就是模型的问题，欢迎反馈)\n" \
@@ -103,23 +107,20 @@ def process_audio(cmd: str, msg: Message):
     audio = msg.audio or msg.voice
     assert audio
 
-    # Download audio file
-    date = datetime.now().strftime('%Y-%m-%d %H-%M')
+    # Download and decode audio file
     downloader: telegram.File = bot.get_file(audio.file_id)
-    ext = downloader.file_path.split('.')[-1]
-    file = Path(tmpdir).joinpath(f'{date} {msg.from_user.name[1:]}.{ext}')
-    print(downloader, '->', file)
-    downloader.download(str(file))
+    print(downloader, '->', msg.from_user.name)
+    decoded = decode(bytes(downloader.download_as_bytearray()))
 
     # Command flags
     flags = AnalyzeComponents.from_command(cmd)
 
-    # Compute
-    results = compute_audio_raw(file)
+    # Compute only what the command shows
+    results = compute_audio_raw(decoded, flags.components())
     uuid = save_process_results(results)
 
     if flags.ml:
-        send_ml(file, [ResultFrame(*s) for s in results.ml], uuid, msg)
+        send_ml(decoded, [ResultFrame(*s) for s in results.ml], uuid, msg)
     if flags.spect:
         send_spect(results.mel_spectrogram, results.freq_array, results.sr, msg)
 
@@ -196,15 +197,11 @@ def get_result_percentages(result: list[ResultFrame]) -> tuple[float, float, flo
 
 
 if __name__ == '__main__':
-    utils.init_tf()
-
     warnings.filterwarnings("ignore")
     matplotlib.use('agg')
 
-    seg = Segmenter()
-
-    tmpdir = Path('audio_tmp')
-    tmpdir.mkdir(exist_ok=True, parents=True)
+    # Load the models before polling, compute_audio_raw shares this Segmenter
+    load()
 
     # Find telegram token
     # path = Path(os.path.abspath(__file__)).parent.parent.parent
@@ -2,7 +2,6 @@ from __future__ import annotations
 
 import io
 import sys
-from pathlib import Path
 
 import numba
 import sgs
@@ -11,11 +10,8 @@ import PIL.Image
 import matplotlib.pyplot as plt
 import numpy as np
 import parselmouth
-import scipy.io.wavfile
-import tensorflow_io as tfio
 from hypy_utils import Timer
 from inaSpeechSegmenter.constants import ResultFrame
-from inaSpeechSegmenter.features import to_wav
 from inaSpeechSegmenter.sidekit_mfcc import read_wav
 from matplotlib.axes import Axes
 from matplotlib.figure import Figure
@@ -23,52 +19,49 @@ from numba import njit, float64, void, uint8, float32
 from numpy import ndarray
 
 from bot.color_scale import get_raw, create_gradient_hex, RGB
+from utils.mel import mel_spectrogram
 
 
-def draw_ml(file: str, result: list[ResultFrame]) -> io.BytesIO:
+def draw_ml(audio: ndarray, sample_rate: int, result: list[ResultFrame]) -> io.BytesIO:
     """
     Draw segmentation result
 
-    :param file: Audio file
+    :param audio: Decoded audio (see utils.decode.decode)
+    :param sample_rate: Sample rate of the audio
     :param result: Segmentation result
     :return: Result image in bytes (please close it after use)
     """
-    def wav_callback(wavfile: Path):
-        sample_rate, audio = scipy.io.wavfile.read(wavfile)
-        _time = np.linspace(0, len(audio) / sample_rate, num=len(audio))
+    _time = np.linspace(0, len(audio) / sample_rate, num=len(audio))
 
-        fig: Figure = plt.gcf()
-        ax: Axes = plt.gca()
+    fig: Figure = plt.gcf()
+    ax: Axes = plt.gca()
 
-        # Plot audio
-        plt.plot(_time, audio, color='white')
+    # Plot audio
+    plt.plot(_time, audio, color='white')
 
-        # Set size
-        # fig.set_dpi(400)
-        fig.set_size_inches(18, 6)
+    # Set size
+    # fig.set_dpi(400)
+    fig.set_size_inches(18, 6)
 
-        # Cutoff frequency so that the plot looks centered
-        cutoff = min(abs(min(audio)), abs(max(audio)))
-        ax.set_ylim([-cutoff, cutoff])
-        ax.set_xlim([result[0].start, result[-1].end])
+    # Cutoff frequency so that the plot looks centered
+    cutoff = min(abs(audio.min()), abs(audio.max()))
+    ax.set_ylim([-cutoff, cutoff])
+    ax.set_xlim([result[0].start, result[-1].end])
 
-        # Draw segmentation areas
-        colors = {'female': '#F5A9B8', 'male': '#5BCEFA', 'default': 'gray'}
-        for r in result:
-            color = colors[r.label] if r.label in colors else colors['default']
-            ax.axvspan(r.start, r.end - 0.01, alpha=.5, color=color)
+    # Draw segmentation areas
+    colors = {'female': '#F5A9B8', 'male': '#5BCEFA', 'default': 'gray'}
+    for r in result:
+        color = colors[r.label] if r.label in colors else colors['default']
+        ax.axvspan(r.start, r.end - 0.01, alpha=.5, color=color)
 
-        # Savefig to bytes
-        buf = io.BytesIO()
-        plt.axis('off')
-        plt.savefig(buf, bbox_inches='tight', pad_inches=0, transparent=False)
-        buf.seek(0)
-        plt.clf()
-        plt.close()
-        return buf
-
-    wav_path = to_wav(file)
-    return wav_callback(wav_path)
+    # Savefig to bytes
+    buf = io.BytesIO()
+    plt.axis('off')
+    plt.savefig(buf, bbox_inches='tight', pad_inches=0, transparent=False)
+    buf.seek(0)
+    plt.clf()
+    plt.close()
+    return buf
 
 
 @njit(cache=True)
@@ -153,11 +146,10 @@ if __name__ == '__main__':
     y, sr, _ = read_wav("/ws/EECS 6414/voice_cnn/VT 150hz baseline example.converted.wav")
     sound = parselmouth.Sound(y, sr)
 
-    t = tfio.audio.spectrogram(y, 2048, 2048, 256)
-    mel_spectrogram = tfio.audio.melscale(t, rate=sr, mels=128, fmin=0, fmax=8000)
+    spec = mel_spectrogram(y, sr, 2048, 2048, 256, mels=128, fmin=0, fmax=8000)
 
     result, freq_array = sgs.api.calculate_feature_classification(sound)
 
-    mspec = draw_mspect(mel_spectrogram.numpy(), freq_array, sr)
+    mspec = draw_mspect(spec, freq_array, sr)
     mspec.show()
 
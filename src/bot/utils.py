@@ -1,7 +1,6 @@
 import json
 from typing import Any
 
-import tensorflow as tf
 from PIL import Image
 from starlette.responses import Response
 
@@ -13,6 +12,8 @@ def show_image_buffer(buf):
 
 
 def init_tf():
+    import tensorflow as tf
+
     gpus = tf.config.experimental.list_physical_devices('GPU')
     for gpu in gpus:
         tf.config.experimental.set_memory_growth(gpu, True)
@@ -1,21 +1,24 @@
 from __future__ import annotations
 
 import json
+import time
 from pathlib import Path
 from threading import Thread
 from uuid import uuid4
 
 import psutil as psutil
 import uvicorn
-from fastapi import FastAPI, UploadFile
+from fastapi import FastAPI, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from hypy_utils import Timer
 from starlette.requests import Request
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, Response
 
 from bot import consts
 from bot.utils import PrettyJSONResponse
-from tasks import compute_audio, RawComputeResults, write_file, compute_audio_raw
+from tasks import compute_audio, RawComputeResults, compute_audio_raw, load
+from utils.metrics import MetricSet, STAGES, collect_stages, stage
+from utils.results import parse_components
 
 SAVED_RESULTS_PATH = Path('audio_results')
 SAVED_RESULTS_PATH.mkdir(exist_ok=True, parents=True)
@@ -23,6 +26,12 @@ SAVED_RESULTS_PATH.mkdir(exist_ok=True, parents=True)
 app = FastAPI()
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True)
 
+metrics = MetricSet()
+requests_total = metrics.counter('voice_web_requests_total', 'Processed requests', ('result',))
+in_flight = metrics.gauge('voice_web_requests_in_flight', 'Requests being processed')
+process_seconds = metrics.histogram('voice_web_process_seconds', 'Time to process a request')
+stage_seconds = metrics.histogram('voice_stage_seconds', 'Time of pipeline stages', ('stage',))
+
 
 @app.get('/', response_class=PrettyJSONResponse)
 async def status():
@@ -37,20 +46,46 @@ async def status():
 
 
 @app.post('/process')
-async def process(file: UploadFile, req: Request) -> dict:
+async def process(file: UploadFile, req: Request, components: str | None = None) -> dict:
     """
     Process audio and return result UUID.
+
+    :param components: Comma separated components to compute (ml, spect, stats), all of them by default
     """
+    try:
+        components = parse_components(components)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
     timer = Timer()
     timer.log(f'User request received from {req.client.host}')
 
-    file = write_file(await file.read(), file.filename)
-    results = compute_audio_raw(file)
-    uuid = save_process_results(results)
+    start = time.perf_counter()
+    in_flight.inc()
+    try:
+        with collect_stages() as timings:
+            results = compute_audio_raw(await file.read(), components)
+            uuid = save_process_results(results)
+    except Exception:
+        requests_total.inc(result='error')
+        raise
+    finally:
+        in_flight.inc(-1)
+
+    requests_total.inc(result='success')
+    process_seconds.observe(time.perf_counter() - start)
+    for k, v in timings.items():
+        if k in STAGES:
+            stage_seconds.observe(v, stage=k)
 
     return {'uuid': uuid}
 
 
+@app.get('/metrics')
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=MetricSet.CONTENT_TYPE)
+
+
 @app.get('/results')
 async def get_process_results(uuid: str) -> FileResponse | None:
     """
@@ -76,12 +111,15 @@ def save_process_results(results: RawComputeResults, uuid: str | None = None) ->
     # TODO: Use redis / mysql
     if uuid is None:
         uuid = str(uuid4())
-    (SAVED_RESULTS_PATH / f'{uuid}.json').write_text(json.dumps(results.to_json_dict()), 'utf-8')
-    (SAVED_RESULTS_PATH / f'{uuid}.bdct').write_bytes(results.to_bdict())
+    with stage('encode'):
+        (SAVED_RESULTS_PATH / f'{uuid}.json').write_text(json.dumps(results.to_json_dict()), 'utf-8')
+        (SAVED_RESULTS_PATH / f'{uuid}.bdct').write_bytes(results.to_bdict())
     return uuid
 
 
 def start():
+    # Load the models before serving, rather than in the first request
+    load()
     uvicorn.run(app, port=48257, host="127.0.0.1")
 
 
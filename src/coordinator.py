@@ -1,129 +1,1204 @@
+from __future__ import annotations
+
 import asyncio
 import copy
+import heapq
+import itertools
 import json
+import math
 import os
-import random
-import re
+import socket
+import time
 import traceback
 import uuid
 from asyncio import Future
-from functools import reduce
-from typing import Callable
+from collections import deque
+from pathlib import Path
+from typing import Collection
 
-from fastapi import FastAPI, WebSocket, UploadFile
-from hypy_utils.serializer import pickle_encode
+from fastapi import FastAPI, WebSocket, UploadFile, HTTPException
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.websockets import WebSocketState
+from starlette.responses import Response, JSONResponse
+from starlette.websockets import WebSocketState, WebSocketDisconnect
 from tortoise.contrib.fastapi import register_tortoise
 from websockets.exceptions import ConnectionClosedError
 
-from utils.models import version, ConnectedWorker, Task, WorkerInfo, TOKEN_RE
-from database.db import Worker
-from tasks import compute_audio
+from database.migrate import migrate
+from utils import chunking
+from utils.approval import ApprovalCache, token_digest
+from utils.broker import Broker, InProcessBroker, Offer, RemoteResult, connect_broker
+from utils.cache import ResultCache, cache_key
+from utils.limiter import AimdLimiter, LatencyTracker, RateMeter
+from utils.mel import MEL_STRIDE
+from utils.metrics import MetricSet, STAGES
+from utils.models import version, ConnectedWorker, Task, WorkerInfo, TOKEN_RE, TaskState
+from utils import registry
+from utils.protocol import decode_message, encode_message, COMPUTE, CHUNK, RESULT, ERROR, PING, PONG
+from utils.results import RawComputeResults, parse_components
+from utils.spool import AudioStore, StoredAudio, claim
+from utils.verification import Verifier, Tolerance, compare_results
 
 db_url = os.environ['MYSQL_URL']
 app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True)
+
+# A worker may spend DEADLINE_BASE + DEADLINE_PER_SECOND * audio duration seconds on a task before
+# the task is given to another worker
+DEADLINE_BASE = float(os.environ.get('TASK_DEADLINE_BASE', 60))
+DEADLINE_PER_SECOND = float(os.environ.get('TASK_DEADLINE_PER_SECOND', 3))
+
+# Dispatch attempts before the request fails
+MAX_ATTEMPTS = int(os.environ.get('TASK_MAX_ATTEMPTS', 3))
+
+# Tasks running longer than this percentile of the fleet's normalized latency get a speculative
+# duplicate on another worker. Set to 0 to disable speculation.
+SPECULATE_PERCENTILE = float(os.environ.get('TASK_SPECULATE_PERCENTILE', 0.95))
+
+WATCHDOG_INTERVAL = 1
+
+# Workers are pinged every HEARTBEAT_INTERVAL seconds and evicted after HEARTBEAT_MISSES pings in
+# a row without a pong, which catches half-open connections that never report a disconnect
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 5))
+HEARTBEAT_MISSES = int(os.environ.get('HEARTBEAT_MISSES', 3))
+
+# Weight of a new sample in the smoothed round-trip time
+RTT_SMOOTHING = 0.2
+
+# Tasks of a disconnected worker wait this many seconds for it to reconnect and resume its session,
+# which delivers the results it computed meanwhile, before they are re-queued
+SESSION_GRACE = float(os.environ.get('SESSION_GRACE', 30))
+
+# Placement: the cost of a task is its audio duration, or its size over COST_BYTES_PER_SECOND if the
+# duration is unknown. Free slots are handed out fastest first, workers within a factor of
+# SPEED_RESOLUTION in speed count as equally fast, and each slot gets the most expensive of the
+# first PLACEMENT_WINDOW queued tasks.
+COST_BYTES_PER_SECOND = 16000
+SPEED_RESOLUTION = 1.2
+PLACEMENT_WINDOW = int(os.environ.get('PLACEMENT_WINDOW', 8))
+
+# Weight of a new observed runtime in a worker's speed
+SPEED_SMOOTHING = 0.3
+
+# A task that would take at least HOLD_MIN_SECONDS on a free slot waits for a busy worker that is
+# expected to finish it HOLD_MARGIN (as a share) sooner, but never longer than the time it saves
+HOLD_MIN_SECONDS = float(os.environ.get('HOLD_MIN_SECONDS', 10))
+HOLD_MARGIN = float(os.environ.get('HOLD_MARGIN', 0.5))
+
+# Uploads are spooled in a directory under this one until their task is resolved, see spool.claim()
+SPOOL_DIR = Path(os.environ.get('SPOOL_DIR', 'audio_spool'))
+
+# Admission control, /process is rejected once the queue holds this many tasks or spooled bytes
+QUEUE_MAX_DEPTH = int(os.environ.get('QUEUE_MAX_DEPTH', 1000))
+QUEUE_MAX_BYTES = int(os.environ.get('QUEUE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# Retry-After sent while no worker is connected
+NO_WORKER_RETRY_AFTER = 30
+
+# Result cache, the disk tier is only used if CACHE_DIR is set
+CACHE_MEMORY_BYTES = int(os.environ.get('CACHE_MEMORY_BYTES', 256 * 1024 * 1024))
+CACHE_DIR = os.environ.get('CACHE_DIR')
+CACHE_DISK_BYTES = int(os.environ.get('CACHE_DISK_BYTES', 4 * 1024 * 1024 * 1024))
+
+# Result verification: share of trusted workers' slots that re-checks may use (0 disables them),
+# the lowest sampling probability of highly trusted workers, how far each passed check moves
+# trusted_level towards 1, and how many re-checks may wait for a trusted slot
+VERIFY_BUDGET = float(os.environ.get('VERIFY_BUDGET', 0.2))
+VERIFY_MIN_RATE = float(os.environ.get('VERIFY_MIN_RATE', 0.02))
+VERIFY_TRUST_STEP = float(os.environ.get('VERIFY_TRUST_STEP', 0.1))
+VERIFY_MAX_PENDING = int(os.environ.get('VERIFY_MAX_PENDING', 100))
+VERIFY_RTOL = float(os.environ.get('VERIFY_RTOL', 1e-3))
+VERIFY_ATOL = float(os.environ.get('VERIFY_ATOL', 1e-4))
+VERIFY_MIN_OVERLAP = float(os.environ.get('VERIFY_MIN_OVERLAP', 0.95))
+
+# Approved workers are cached for APPROVAL_TTL seconds, so reconnects don't query the database
+APPROVAL_TTL = float(os.environ.get('APPROVAL_TTL', 300))
+APPROVAL_MAX_ENTRIES = int(os.environ.get('APPROVAL_MAX_ENTRIES', 100_000))
+
+# Shared queue between coordinator instances, e.g. sqlite:///broker.db for uvicorn --workers.
+# Instances read the audio of each other's tasks from their spools, so they need the same file
+# system. Without it, this process only uses the workers connected to itself.
+BROKER_URL = os.environ.get('BROKER_URL')
+NODE_ID = os.environ.get('NODE_ID', f'{socket.gethostname()}-{os.getpid()}')
+BROKER_INTERVAL = float(os.environ.get('BROKER_INTERVAL', 0.1))
+
+# Exceptions of tasks that failed on another coordinator, by class name
+REMOTE_ERRORS = {'TimeoutError': asyncio.TimeoutError, 'ConnectionError': ConnectionError}
+
+
+class QueueFullError(Exception):
+    """Raised when a task is not admitted to the queue"""
+    def __init__(self, message: str, status: int, retry_after: int):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def task_cost(t: Task) -> float:
+    """Estimated cost of a task in seconds of audio, used to place it and to normalize latencies"""
+    return max(t.duration or t.size / COST_BYTES_PER_SECOND, 1.0)
+
+
+class SlotPool:
+    """Indexed pool of free worker slots. Workers are kept in a heap ordered by speed (in steps of
+    SPEED_RESOLUTION), then by load, then by heartbeat round-trip time, so that picking the fastest
+    (and among equally fast, the least-loaded and closest) worker and returning a slot are both
+    O(log n) regardless of the number of connected workers or running tasks.
+
+    Heap entries are invalidated lazily: every time a worker's load changes, a new entry is
+    pushed and the old one is skipped when it reaches the top of the heap.
+
+    Entries of trusted workers are also pushed to a second heap, so that verification jobs can
+    pick the least-loaded trusted worker without scanning untrusted ones.
+    """
+    heap: list[tuple[int, float, float, int, ConnectedWorker]]
+    trusted_heap: list[tuple[int, float, float, int, ConnectedWorker]]
+    entries: dict[ConnectedWorker, tuple[int, float, float, int, ConnectedWorker]]
+    members: set[ConnectedWorker]
+
+    def __init__(self):
+        self.heap = []
+        self.trusted_heap = []
+        self.entries = {}
+        self.members = set()
+        self.trusted_members = 0
+        self.seq = itertools.count()
+
+    def __len__(self) -> int:
+        """Number of workers that have at least one free slot"""
+        return len(self.entries)
+
+    def add(self, worker: ConnectedWorker) -> None:
+        """Start handing out slots of a worker"""
+        if worker not in self.members and worker.trusted:
+            self.trusted_members += 1
+        self.members.add(worker)
+        self.update(worker)
+
+    def remove(self, worker: ConnectedWorker) -> None:
+        """Stop handing out slots of a worker"""
+        if worker in self.members and worker.trusted:
+            self.trusted_members -= 1
+        self.members.discard(worker)
+        self.entries.pop(worker, None)
+
+    def update(self, worker: ConnectedWorker) -> None:
+        """Re-index a worker after its load or capacity changed"""
+        if worker not in self.members or worker.free_slots <= 0:
+            self.entries.pop(worker, None)
+            return
+
+        speed = -round(math.log(max(worker.speed, 1e-6), SPEED_RESOLUTION))
+        entry = (speed, worker.load, worker.rtt or 0, next(self.seq), worker)
+        self.entries[worker] = entry
+        heapq.heappush(self.heap, entry)
+        if worker.trusted:
+            heapq.heappush(self.trusted_heap, entry)
+
+        # Compact the heaps if stale entries pile up
+        if max(len(self.heap), len(self.trusted_heap)) > 4 * len(self.entries) + 64:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+            self.trusted_heap = [e for e in self.heap if e[-1].trusted]
+            heapq.heapify(self.trusted_heap)
+
+    def acquire(self, exclude: Collection[ConnectedWorker] = (), trusted: bool = False) -> ConnectedWorker | None:
+        """
+        Take one slot from the least-loaded worker
+
+        :param exclude: Workers that must not be picked
+        :param trusted: Only pick trusted workers
+        :return: The worker, or None if every worker that is not excluded is busy
+        """
+        heap = self.trusted_heap if trusted else self.heap
+        skipped = []
+        try:
+            while heap:
+                entry = heapq.heappop(heap)
+                worker = entry[-1]
+                if self.entries.get(worker) is not entry:
+                    continue
+                if worker in exclude:
+                    skipped.append(entry)
+                    continue
+
+                del self.entries[worker]
+                worker.running += 1
+                self.update(worker)
+                return worker
+
+            return None
+        finally:
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+
+    def release(self, worker: ConnectedWorker) -> None:
+        """Return a slot taken by acquire()"""
+        worker.running = max(worker.running - 1, 0)
+        self.update(worker)
 
 
 class WorkerPool:
-    """This class controls worker pools and keeps information about each worker"""
-    pool: list[ConnectedWorker] = []
-    completed_tasks = []
-    running_tasks: dict[str, tuple[Task, ConnectedWorker, Future]] = {}
-    queued_tasks: list[tuple[Task, Future]] = []
+    """
+    This class controls worker pools and keeps information about each worker.
+
+    A pool only holds the workers connected to this coordinator instance (node). Tasks that wait
+    for a slot are offered to the other nodes through the broker, see share().
+    """
+    pool: list[ConnectedWorker]
+    running_tasks: dict[str, TaskState]
+    queued_tasks: deque[TaskState]
+
+    # Verification jobs, they are only dispatched while queued_tasks is empty
+    verify_queue: deque[TaskState]
+
+    # Tasks that already have a result but are still dispatched to other workers. Late results for
+    # them only free the worker slot.
+    resolved_tasks: dict[str, TaskState]
+
+    # Tasks offered to the broker until they are resolved, and when those that another node
+    # claimed were found to be claimed
+    offered: dict[str, TaskState]
+    remote: dict[str, float]
+
+    # Workers by session id, and when the sessions of disconnected workers expire
+    sessions: dict[str, ConnectedWorker]
+    parked: dict[str, float]
+
+    def __init__(self, node: str = NODE_ID, broker: Broker | None = None):
+        self.node = node
+        self.broker = broker or InProcessBroker()
+        self.pool = []
+        self.running_tasks = {}
+        self.queued_tasks = deque()
+        self.verify_queue = deque()
+        self.resolved_tasks = {}
+        self.offered = {}
+        self.remote = {}
+        self.sessions = {}
+        self.parked = {}
+        self.slots = SlotPool()
+
+        # Observed speed over calibrated speed of workers, converts the calibration of a new worker
+        # into its initial speed
+        self.speed_scale = 1.0
+        self.latency = LatencyTracker()
+        self.drain = RateMeter()
+        self.queued_bytes = 0
+
+        # Workers connected to all nodes, as of the last heartbeat
+        self.fleet_workers = 0
 
     def remove_disconnected(self) -> None:
         """Remove disconnected workers"""
         to_remove = [s for s in self.pool if s.ws.client_state != WebSocketState.CONNECTED]
         for s in to_remove:
-            self.pool.remove(s)
+            self.remove_worker(s)
+
+    def remove_worker(self, worker: ConnectedWorker) -> None:
+        """Remove a worker from the pool so that no more tasks are assigned to it"""
+        self.slots.remove(worker)
+        if worker in self.pool:
+            self.pool.remove(worker)
 
     def get_connected(self) -> list[ConnectedWorker]:
         """Get connected workers"""
         self.remove_disconnected()
         return self.pool
 
-    def get_resting_workers(self) -> list[ConnectedWorker]:
-        """Get workers that are not doing anything. If a worker has a max_tasks of 6 and is resting,
-        then the worker will appear in the result 6 times.
+    def enqueue(self, ts: TaskState, front: bool = False) -> None:
+        """Add a task to the queue"""
+        if ts.low_priority:
+            verifier.running.discard(ts.task.id)
+            queue = self.verify_queue
+        else:
+            queue = self.queued_tasks
+            self.queued_bytes += ts.task.size
+
+        ts.queued_at = time.monotonic()
+        if front:
+            queue.appendleft(ts)
+        else:
+            queue.append(ts)
+
+    def dequeue(self, i: int = 0) -> TaskState:
+        """Remove the task at index i of the queue, near the front"""
+        ts = self.queued_tasks[i]
+        del self.queued_tasks[i]
+        self.queued_bytes -= ts.task.size
+        return ts
+
+    def prune_queue(self) -> None:
+        """Drop queued tasks that were resolved elsewhere, e.g. by another node"""
+        self.queued_tasks = deque(ts for ts in self.queued_tasks if not ts.future.done())
+        self.queued_bytes = sum(ts.task.size for ts in self.queued_tasks)
+
+    def capacity(self) -> int:
+        """Total number of slots of connected workers"""
+        return sum(w.max_tasks for w in self.pool)
+
+    def trusted_capacity(self) -> int:
+        """Total number of slots of connected trusted workers"""
+        return sum(w.max_tasks for w in self.pool if w.trusted)
+
+    def estimated_wait(self, depth: int | None = None) -> float | None:
+        """
+        Estimate how long a task entering the queue now waits before it is dispatched
+
+        :param depth: Number of tasks ahead of it, defaults to the current queue depth
+        :return: Seconds, or None if there is nothing to base the estimate on
+        """
+        depth = len(self.queued_tasks) if depth is None else depth
+        if depth == 0:
+            return 0
+
+        # Observed drain rate
+        rate = self.drain.rate()
+        if rate > 0:
+            return depth / rate
+
+        # No completions yet, use the typical latency and the fleet's capacity
+        p50 = self.latency.percentile(0.5)
+        capacity = self.capacity()
+        if p50 is not None and capacity:
+            return depth * p50 / capacity
+        return None
+
+    def admit(self, size: int, count: int = 1) -> None:
+        """
+        Check whether tasks of `size` bytes in total may enter the queue
+
+        :param size: Bytes of audio of the tasks
+        :param count: Number of tasks
+        :raises QueueFullError: If they may not
         """
-        active = [s[1] for s in self.running_tasks.values()]
-        resting = [[s] * (s.max_tasks - active.count(s)) for s in self.get_connected()]
-        return reduce(list.__add__, resting) if resting else []
+        if not self.pool and not self.fleet_workers:
+            rejected.inc(status='503')
+            raise QueueFullError('No worker is available', 503, NO_WORKER_RETRY_AFTER)
+
+        # Tasks that were resolved while queued (cancelled windows, results from another node) are
+        # only dropped when they reach the front, they don't count against the limits
+        if len(self.queued_tasks) + count > QUEUE_MAX_DEPTH or self.queued_bytes + size > QUEUE_MAX_BYTES:
+            self.prune_queue()
+
+        depth_over = len(self.queued_tasks) + count - QUEUE_MAX_DEPTH
+        bytes_over = self.queued_bytes + size - QUEUE_MAX_BYTES
+        if depth_over <= 0 and bytes_over <= 0:
+            return
+
+        # Wait until enough tasks have drained to make room
+        avg_size = self.queued_bytes / len(self.queued_tasks) if self.queued_tasks else size / count
+        excess = max(depth_over, int(bytes_over / max(avg_size, 1)) + 1)
+        wait = self.estimated_wait(excess)
+        retry_after = NO_WORKER_RETRY_AFTER if wait is None else min(max(math.ceil(wait), 1), 300)
+        rejected.inc(status='429')
+        raise QueueFullError(f'Queue is full ({len(self.queued_tasks)} tasks, {self.queued_bytes} bytes)',
+                             429, retry_after)
 
     async def check_queue(self):
         """Check if any tasks in queue can be started"""
-        resting = self.get_resting_workers()
+        # Workers that none of the first queued tasks can go to, e.g. because they expired there. Their
+        # slots are held until the end, so that the next worker is tried instead.
+        passed: list[ConnectedWorker] = []
+        try:
+            while self.queued_tasks:
+                # A late result from an expired worker already resolved this task
+                if self.queued_tasks[0].future.done():
+                    self.dequeue()
+                    continue
+
+                window = min(len(self.slots) + len(passed), PLACEMENT_WINDOW)
+                s = self.slots.acquire(exclude=passed)
+                if s is None:
+                    break
+
+                i = self.place(s, window)
+                if i is None:
+                    passed.append(s)
+                    continue
+
+                ts = self.dequeue(i)
+                if ts.offered and not await self.claim(ts):
+                    self.slots.release(s)
+                    continue
+                queue_wait.observe(time.monotonic() - ts.queued_at, queue='user')
+                if not await self.dispatch(ts, s):
+                    self.enqueue(ts, front=True)
+        finally:
+            for s in passed:
+                self.slots.release(s)
+
+        if self.verify_queue and not self.queued_tasks:
+            await self.check_verify_queue()
+
+    def place(self, s: ConnectedWorker, window: int) -> int | None:
+        """
+        Pick the queued task for a slot of s. Slots are handed out fastest first, so taking the most
+        expensive of the first `window` tasks (one per free worker) gives the largest tasks the
+        fastest workers, which shortens the makespan and the tail latency.
+
+        Tasks that can't go to s (resolved, or expired on s) are passed over and don't count towards
+        the window, so they don't hold up the tasks behind them.
+
+        :return: Index of the task in the queue, or None if all of them should wait for another worker
+        """
+        best, best_cost, seen = None, 0, 0
+        for i, ts in enumerate(self.queued_tasks):
+            if seen >= max(window, 1):
+                break
+            if ts.future.done() or s in ts.expired:
+                continue
+
+            seen += 1
+            cost = task_cost(ts.task)
+            if (best is not None and cost <= best_cost) or self.wait_for_faster(ts, s):
+                continue
+            best, best_cost = i, cost
+        return best
+
+    def wait_for_faster(self, ts: TaskState, s: ConnectedWorker) -> bool:
+        """Whether a long task should rather wait for a busy worker that would finish it much sooner than s"""
+        cost = task_cost(ts.task)
+        here = cost / s.speed
+        now = time.monotonic()
+        if here < HOLD_MIN_SECONDS or now - ts.queued_at > here * HOLD_MARGIN:
+            return False
+
+        for w in self.pool:
+            if w.speed <= s.speed or w.free_slots or not w.finishes or w in ts.expired:
+                continue
+
+            # Predictions of overdue tasks are unreliable
+            ready = min(w.finishes.values()) - now
+            if ready >= 0 and ready + cost / w.speed < here * (1 - HOLD_MARGIN):
+                return True
+        return False
+
+    async def check_verify_queue(self):
+        """Dispatch verification jobs to trusted workers, within the verification budget"""
+        limit = verifier.limit(self.trusted_capacity())
+        # Jobs that none of the free trusted workers may run, the jobs behind them are tried
+        skipped = 0
+        while len(self.verify_queue) > skipped and not self.queued_tasks and len(verifier.running) < limit:
+            ts = self.verify_queue[skipped]
+            if ts.future.done():
+                del self.verify_queue[skipped]
+                continue
+
+            s = self.slots.acquire(exclude=ts.expired, trusted=True)
+            if s is None:
+                if not ts.expired:
+                    break
+                skipped += 1
+                continue
+
+            del self.verify_queue[skipped]
+            verifier.running.add(ts.task.id)
+            queue_wait.observe(time.monotonic() - ts.queued_at, queue='verify')
+            if not await self.dispatch(ts, s):
+                self.enqueue(ts, front=True)
+
+    async def claim(self, ts: TaskState) -> bool:
+        """
+        Claim an offered task from the broker before dispatching it
+
+        :return: False if another node claimed it, its result is then routed back by the broker
+        """
+        if await self.broker.claim(ts.task.id, self.node):
+            return True
+        self.remote[ts.task.id] = time.monotonic()
+        return False
+
+    async def dispatch(self, ts: TaskState, s: ConnectedWorker) -> bool:
+        """
+        Send a task to a worker whose slot is already acquired
+
+        :return: Whether the task was sent
+        """
+        t = ts.task
+        print(f'Task assigned to {s.ws.client.host}')
+
+        # Add to running list before sending, since the result may arrive before send returns
+        self.running_tasks[t.id] = ts
+        ts.dispatches[s] = time.monotonic()
+        s.finishes[t.id] = ts.dispatches[s] + task_cost(t) / s.speed
+        ts.attempts += 1
+        if s.limiter:
+            s.limiter.mark_busy(s.running)
+
+        try:
+            start = time.perf_counter()
+            await s.ws.send_bytes(encode_message(COMPUTE, t.to_header()))
+            dispatch_seconds.observe(time.perf_counter() - start)
+            if t.audio:
+                asyncio.create_task(self.stream_audio(t, s))
+            return True
+        except Exception as e:
+            # Worker is gone
+            print(f'> [-] Failed to send task to {s.ws.client.host}: {e}')
+            ts.dispatches.pop(s, None)
+            s.finishes.pop(t.id, None)
+            ts.attempts -= 1
+            self.remove_worker(s)
+            self.slots.release(s)
+            return False
+
+    async def stream_audio(self, t: Task, s: ConnectedWorker) -> None:
+        """Send the spooled audio of a task to a worker in chunk frames"""
+        try:
+            start = time.perf_counter()
+            for offset, chunk in store.chunks(t.audio):
+                await s.ws.send_bytes(encode_message(CHUNK, {'id': t.id, 'offset': offset}, {'data': chunk}))
+            audio_stream_seconds.observe(time.perf_counter() - start)
+        except Exception as e:
+            # The listen loop of the worker handles the disconnect
+            print(f'> [-] Failed to stream audio of task {t.id} to {s.ws.client.host}: {e}')
+
+    def deadline(self, t: Task) -> float:
+        """Seconds a worker may spend on a task before it is given to another worker"""
+        return DEADLINE_BASE + DEADLINE_PER_SECOND * t.duration
+
+    def retry(self, ts: TaskState, reason: str, error: type[Exception] = asyncio.TimeoutError) -> None:
+        """Put a task back to the front of the queue, or fail it with `error` after MAX_ATTEMPTS dispatches"""
+        # Another worker is still working on it within its deadline
+        if any(w not in ts.expired for w in ts.dispatches):
+            return
+
+        id = ts.task.id
+        if ts.attempts < MAX_ATTEMPTS:
+            print(f'> [T] Re-queueing task {id} ({reason}, attempt {ts.attempts}/{MAX_ATTEMPTS})')
+            self.enqueue(ts, front=True)
+            asyncio.create_task(self.check_queue())
+            return
+
+        print(f'> [-] Task {id} failed after {ts.attempts} attempts ({reason})')
+        self.running_tasks.pop(id, None)
+        if ts.dispatches:
+            self.resolved_tasks[id] = ts
+        ts.future.set_exception(error(f'{reason} after {ts.attempts} attempts'))
+
+    async def check_deadlines(self):
+        """Re-queue expired tasks and start speculative duplicates of stragglers"""
+        now = time.monotonic()
+        p = self.latency.percentile(SPECULATE_PERCENTILE) if SPECULATE_PERCENTILE else None
+
+        # Give up on tasks claimed by a node that doesn't answer within all of its attempts
+        for id, since in list(self.remote.items()):
+            ts = self.offered.get(id)
+            if ts is not None and not ts.future.done() and now - since > self.deadline(ts.task) * MAX_ATTEMPTS:
+                print(f'> [-] Task {id} claimed by another coordinator timed out')
+                ts.future.set_exception(asyncio.TimeoutError('Deadline exceeded on another coordinator'))
+
+        for ts in list(self.running_tasks.values()):
+            if ts.future.done():
+                continue
+
+            for w, started in list(ts.dispatches.items()):
+                if w in ts.expired:
+                    continue
+
+                elapsed = now - started
+                if elapsed > self.deadline(ts.task):
+                    print(f'> [T] Task {ts.task.id} exceeded its deadline on {w.ws.client.host}')
+                    task_failures.inc(worker=w.name, reason='deadline')
+                    self.observe_speed(w, task_cost(ts.task) / elapsed)
+                    ts.expired.add(w)
+                    self.retry(ts, 'Deadline exceeded')
+
+                # Speculate only with spare capacity, never at the expense of queued tasks
+                elif p is not None and not ts.speculated and not ts.low_priority and not self.queued_tasks \
+                        and elapsed > p * task_cost(ts.task):
+                    s = self.slots.acquire(exclude=ts.dispatches.keys() | ts.expired)
+                    if s is not None:
+                        print(f'> [T] Task {ts.task.id} is a straggler, starting speculative duplicate')
+                        ts.speculated = True
+                        await self.dispatch(ts, s)
+
+    async def watchdog(self):
+        """Periodically check task deadlines and expire sessions"""
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            try:
+                await self.check_deadlines()
+                self.check_sessions()
+
+                # Tasks that waited for a faster worker may have waited long enough
+                if self.queued_tasks and len(self.slots):
+                    await self.check_queue()
+            except Exception:
+                traceback.print_exc()
+
+    def check_sessions(self) -> None:
+        """Re-queue the tasks of disconnected workers that did not resume their session in time"""
+        now = time.monotonic()
+        for session, expires in list(self.parked.items()):
+            if now >= expires:
+                del self.parked[session]
+                worker = self.sessions.pop(session)
+                print(f'> [S] Session of {worker.ws.client.host} expired')
+                self.requeue(worker)
+
+    def resume(self, session: str, worker: ConnectedWorker, holding: Collection[str]) -> bool:
+        """
+        Hand the tasks of a previous connection of the same worker over to its new connection, before
+        it is added to the pool. Its results are then accepted as if it never disconnected.
+
+        :param holding: Ids of the tasks that the worker is still running or has results for, the
+            other tasks of the session are re-queued
+        :return: Whether the session was resumed
+        """
+        old = self.sessions.get(session)
+        if old is None or old.db is None or worker.db is None or old.db.id != worker.db.id:
+            return False
+
+        # The old connection may be half-open and not noticed yet
+        self.parked.pop(session, None)
+        self.remove_worker(old)
+        self.sessions[session] = worker
+        worker.session = session
+
+        holding = set(holding)
+        moved = 0
+        for ts in [*self.running_tasks.values(), *self.resolved_tasks.values()]:
+            if old not in ts.dispatches:
+                continue
+            if ts.task.id not in holding:
+                self.drop_dispatch(ts, old, 'Worker lost the task')
+                continue
 
-        # Run tasks
-        while len(resting) > 0 and len(self.queued_tasks) > 0:
-            s = random.choice(resting)
-            print(f'Task assigned to {s.ws.client.host}')
-            t, future = self.queued_tasks.pop(0)
+            ts.dispatches[worker] = ts.dispatches.pop(old)
+            worker.finishes[ts.task.id] = old.finishes.get(ts.task.id, ts.dispatches[worker])
+            if old in ts.expired:
+                ts.expired.discard(old)
+                ts.expired.add(worker)
+            worker.running += 1
+            moved += 1
 
-            # Run and add to running list
-            await s.ws.send_bytes(pickle_encode({'type': 'compute', 'task': t}))
-            self.running_tasks[t.id] = (t, s, future)
+        print(f'> [S] {worker.ws.client.host} resumed its session with {moved} tasks')
+        sessions_resumed.inc()
+        return True
 
-    def run_compute(self, task: Callable, params: any) -> Future:
-        """Enqueue a computation task"""
+    async def heartbeat(self):
+        """Periodically ping workers and evict the ones that stopped answering"""
+        seq = itertools.count()
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            for w in list(self.pool):
+                try:
+                    await self.ping(w, next(seq))
+                except Exception:
+                    traceback.print_exc()
+
+    async def ping(self, w: ConnectedWorker, seq: int) -> None:
+        """Send a heartbeat to a worker, or evict it if too many heartbeats were not answered"""
+        if w.ping is not None:
+            w.missed += 1
+            if w.missed >= HEARTBEAT_MISSES:
+                return await self.evict(w, f'{w.missed} heartbeats missed')
+
+        w.ping = (seq, time.monotonic())
+        try:
+            await asyncio.wait_for(w.ws.send_bytes(encode_message(PING, {'seq': seq})), HEARTBEAT_INTERVAL)
+        except Exception as e:
+            await self.evict(w, f'heartbeat not sent: {e}')
+
+    def pong(self, w: ConnectedWorker, seq: int) -> None:
+        """Record the round-trip time of an answered heartbeat"""
+        if w.ping is None or w.ping[0] != seq:
+            return
+        rtt = time.monotonic() - w.ping[1]
+        w.rtt = rtt if w.rtt is None else (1 - RTT_SMOOTHING) * w.rtt + RTT_SMOOTHING * rtt
+        w.ping = None
+        w.missed = 0
+
+    async def evict(self, w: ConnectedWorker, reason: str) -> None:
+        """Treat a worker as disconnected, even if its socket doesn't know it yet"""
+        print(f'> [-] Evicting {w.ws.client.host} ({reason})')
+        evictions.inc()
+        self.worker_disconnected(w, park=False)
+        try:
+            await asyncio.wait_for(w.ws.close(1001), HEARTBEAT_INTERVAL)
+        except Exception:
+            pass
+
+    def complete(self, id: str, worker: ConnectedWorker) -> TaskState | None:
+        """
+        Free the worker slot of a finished dispatch
+
+        :return: The task if it is still waiting for its result, None if the response is stale
+        """
+        ts = self.running_tasks.get(id) or self.resolved_tasks.get(id)
+        if ts is None or worker not in ts.dispatches:
+            print(f'> [-] Response from {worker.ws.client.host} ignored. Running task of id {id} not found')
+            return None
+
+        self.task_finished(ts, worker)
+
+        # Late response of a task that was already resolved by another worker, or cancelled
+        if ts.future.done():
+            if not ts.dispatches:
+                self.running_tasks.pop(id, None)
+                self.resolved_tasks.pop(id, None)
+            return None
+
+        self.running_tasks.pop(id)
+        if ts.dispatches:
+            self.resolved_tasks[id] = ts
+        return ts
+
+    def resolve(self, id: str, worker: ConnectedWorker, result: any, timings: dict | None = None) -> None:
+        """
+        Deliver the result of a task. The first result wins, later ones only free their slots.
+
+        :param timings: Seconds spent in each pipeline stage on the worker
+        """
+        for k, v in (timings or {}).items():
+            if k in STAGES:
+                stage_seconds.observe(v, stage=k)
+
+        ts = self.complete(id, worker)
+        if ts is not None:
+            print(f'> [R] Received Response for ID {id}, calling callback')
+            if not ts.low_priority and self.slots.trusted_members \
+                    and verifier.sample(worker.db, len(self.verify_queue)):
+                self.verify(ts, worker, result)
+            ts.future.set_result(result)
+
+    def verify(self, ts: TaskState, worker: ConnectedWorker, result: any) -> None:
+        """Queue a re-run of a task on a trusted worker to check the result of an untrusted one"""
+        t = ts.task
+        job = TaskState(Task(str(uuid.uuid4()), t.fn, dict(t.params), t.duration, t.size, t.audio), Future(),
+                        key=ts.key, low_priority=True)
+        print(f'> [V] Verifying result of task {t.id} from {worker.ws.client.host} as {job.task.id}')
+
+        # Keep the spooled file until the re-run is done
+        if t.audio:
+            store.retain(t.audio)
+            job.future.add_done_callback(lambda _: store.release(t.audio))
+        job.future.add_done_callback(lambda f: asyncio.create_task(self.verified(job, f, worker, result)))
+        self.enqueue(job)
+
+    async def verified(self, job: TaskState, f: Future, worker: ConnectedWorker, result: any) -> None:
+        """Compare the result of a verification job and update the trust of the checked worker"""
+        verifier.running.discard(job.task.id)
+        if f.cancelled() or f.exception() is not None:
+            verifier.stats.errors += 1
+            print(f'> [V] Verification job {job.task.id} failed: {None if f.cancelled() else f.exception()}')
+            return
+
+        expected = f.result()
+        try:
+            mismatch = await asyncio.to_thread(compare_results, expected, result, verifier.tolerance,
+                                               registry.TASKS[job.task.fn].result)
+        except Exception as e:
+            # A malformed result is not evidence against the worker, but the check must not die silently
+            verifier.stats.errors += 1
+            print(f'> [V] Comparing the result of verification job {job.task.id} failed: {type(e).__name__}: {e}')
+            return
+        verifier.record(worker.db, mismatch)
+        await worker.db.save(update_fields=['trusted_level', 'approved'])
+        if mismatch is not None:
+            approvals.invalidate(worker.db.token_digest)
+        if mismatch is None:
+            print(f'> [V] Result of {worker.ws.client.host} verified, trusted_level = {worker.db.trusted_level:.3f}')
+            return
+
+        # Ban the worker, and replace the result it returned if it was cached
+        print(f'> [V] Result of {worker.ws.client.host} does not match ({mismatch}), banning worker')
+        if job.key:
+            cache.invalidate(job.key)
+            await cache.put(job.key, expected)
+        self.remove_worker(worker)
+        if worker.ws.client_state == WebSocketState.CONNECTED:
+            await worker.ws.close(1008)
+
+    def fail(self, id: str, worker: ConnectedWorker, error: str) -> None:
+        """Fail a task because its function raised an error on the worker"""
+        ts = self.complete(id, worker)
+        task_failures.inc(worker=worker.name, reason='error')
+        if ts is not None:
+            print(f'> [-] Task {id} raised an error on {worker.ws.client.host}: {error}')
+            ts.future.set_exception(RuntimeError(error))
+
+    def crashed(self, id: str, worker: ConnectedWorker, error: str) -> None:
+        """Re-queue a task whose process died on the worker, like a task of a disconnected worker"""
+        ts = self.running_tasks.get(id) or self.resolved_tasks.get(id)
+        if ts is None or worker not in ts.dispatches:
+            return
+
+        print(f'> [-] Task {id} crashed on {worker.ws.client.host}: {error}')
+        task_failures.inc(worker=worker.name, reason='crash')
+        del ts.dispatches[worker]
+        worker.finishes.pop(id, None)
+        self.slots.release(worker)
+        if ts.future.done():
+            if not ts.dispatches:
+                self.running_tasks.pop(id, None)
+                self.resolved_tasks.pop(id, None)
+        elif worker not in ts.expired:
+            self.retry(ts, 'Worker process crashed', RuntimeError)
+
+    def task_finished(self, ts: TaskState, w: ConnectedWorker) -> None:
+        """Free the slot of a finished task and let the worker's limiter adjust its capacity"""
+        latency = time.monotonic() - ts.dispatches.pop(w)
+        w.finishes.pop(ts.task.id, None)
+        task_seconds.observe(latency, worker=w.name)
+        cost = task_cost(ts.task)
+        self.latency.observe(latency, cost)
+        self.observe_speed(w, cost / max(latency, 1e-3))
+        if not ts.low_priority:
+            self.drain.mark()
+        if w.limiter:
+            limit = w.limiter.observe(latency, cost)
+            if limit != w.max_tasks:
+                print(f'> [L] Worker {w.ws.client.host} max_tasks {w.max_tasks} -> {limit}')
+                w.max_tasks = limit
+        self.slots.release(w)
+
+    def observe_speed(self, w: ConnectedWorker, speed: float) -> None:
+        """Refine the speed of a worker, and the scale of calibrated speeds, with an observed runtime"""
+        w.speed = (1 - SPEED_SMOOTHING) * w.speed + SPEED_SMOOTHING * speed
+        if w.worker is not None and w.worker.speed > 0:
+            self.speed_scale = (1 - SPEED_SMOOTHING) * self.speed_scale + SPEED_SMOOTHING * speed / w.worker.speed
+
+    def initial_speed(self, info: WorkerInfo) -> float:
+        """Speed of a new worker from its calibration, or the median speed of the pool if it has none"""
+        if info.speed > 0:
+            return info.speed * self.speed_scale
+        speeds = sorted(w.speed for w in self.pool)
+        return speeds[len(speeds) // 2] if speeds else 1.0
+
+    def run_compute(self, task: str, params: dict, audio: StoredAudio | None = None, key: str | None = None,
+                    duration: float | None = None) -> Future:
+        """
+        Enqueue a computation task
+
+        :param task: Registered task name
+        :param params: Keyword arguments of the function
+        :param audio: Spooled audio passed to the function as `file`
+        :param key: Cache key of the result, a result that fails verification is replaced there
+        :param duration: Seconds of audio that the task analyzes, the whole file by default
+        :raises QueueFullError: If the task is not admitted
+        """
+        size = audio.size if audio else 0
+        self.admit(size)
         id = str(uuid.uuid4())
         future = Future()
-        self.queued_tasks.append((Task(id, task, params), future))
+        if duration is None:
+            duration = audio.duration if audio else 0
+        t = Task(id, task, params, duration, size, audio.sha if audio else None)
+        self.enqueue(TaskState(t, future, key=key))
+
+        # Keep the spooled file until the task is resolved, even if the request goes away
+        if audio:
+            store.retain(audio.sha)
+            future.add_done_callback(lambda _: store.release(audio.sha))
         asyncio.create_task(self.check_queue())
         return future
 
+    async def run_chunked(self, file_name: str, audio: StoredAudio, components: tuple[str, ...]) -> bytes:
+        """
+        Analyze a long recording as one task per window, so that different workers can share it,
+        then stitch the results of the windows (see utils.chunking). The task of a window only gets
+        the audio of the window, cut out of the recording here. A recording that can't be cut is
+        analyzed as one task, which the worker reads window by window.
+
+        :param file_name: Name of the uploaded file
+        :param audio: Spooled recording
+        :param components: Components to compute, see utils.results.COMPONENTS
+        :return: Result in the format of compute_audio
+        :raises QueueFullError: If the windows are not admitted
+        """
+        windows = chunking.plan(audio.duration)
+
+        # Check the queue before decoding the recording to cut it
+        self.admit(audio.size, len(windows))
+
+        segments: list[tuple[StoredAudio, chunking.Window, int]] = []
+        futures = []
+        try:
+            for w in windows:
+                try:
+                    data, offset = await asyncio.to_thread(chunking.segment, store.file(audio.sha), w, MEL_STRIDE)
+                except (RuntimeError, ImportError) as e:
+                    if segments:
+                        raise
+                    print(f'> [-] {file_name} can\'t be cut into windows ({e}), analyzing it as one task')
+                    params = {'file_name': file_name, 'components': list(components)}
+                    return bytes(await self.run_compute('compute_audio', params, audio))
+
+                stop = w.stop if w.stop is not None else max(audio.duration, w.start + chunking.CHUNK_SECONDS)
+                segments.append((await store.put(data, stop - w.start + 2 * w.overlap), w, offset))
+
+            # Admit all windows at once, a full queue rejects the recording before any window is queued
+            self.admit(sum(seg.size for seg, _, _ in segments), len(segments))
+            for seg, w, offset in segments:
+                params = {'file_name': file_name, **w.to_params(), 'components': list(components), 'offset': offset}
+                futures.append(self.run_compute('compute_window', params, seg))
+            done = await asyncio.gather(*futures)
+        except BaseException:
+            # The other windows are of no use once one failed or the request went away
+            for f in futures:
+                f.cancel()
+            raise
+        finally:
+            # Queued windows hold their own reference to their segment
+            for seg, _, _ in segments:
+                store.release(seg.sha)
+
+        results = chunking.stitch([RawComputeResults.from_bdict(r) for r in done])
+        if 'stats' in components:
+            means = results.result['means']
+            fem_prob = json.loads(bytes(await self.run_compute('classify_features', {'means': means})))
+            results = results._replace(result={**results.result, 'fem_prob': fem_prob})
+        print(f'> [+] Stitched {len(windows)} windows of {results.audio_dur:.0f}s audio')
+        return results.select(components).to_bdict()
+
+    async def share(self):
+        """
+        Periodically exchange tasks with other nodes through the broker: offer tasks that wait for
+        a slot here, claim tasks of other nodes while workers here are idle, and deliver results
+        of offered tasks
+        """
+        while True:
+            await asyncio.sleep(BROKER_INTERVAL)
+            try:
+                self.fleet_workers = await self.broker.heartbeat(self.node, len(self.pool))
+
+                if self.offered:
+                    results = await self.broker.poll_results(self.node)
+                    for r in results:
+                        self.remote_result(r)
+                    if results:
+                        self.prune_queue()
+
+                if not self.slots:
+                    for ts in [ts for ts in self.queued_tasks if not ts.offered and ts.origin is None]:
+                        await self.offer(ts)
+
+                elif not self.queued_tasks:
+                    free = sum(w.free_slots for w in self.pool)
+                    for offer in await self.broker.claim_next(self.node, free):
+                        await self.accept(offer)
+                    await self.check_queue()
+            except Exception:
+                traceback.print_exc()
+
+    async def offer(self, ts: TaskState) -> None:
+        """Offer a queued task to other nodes"""
+        t = ts.task
+        ts.offered = True
+        self.offered[t.id] = ts
+        await self.broker.submit(self.node, t.id, t.to_header(), store.file(t.audio) if t.audio else None)
+
+        def done(_):
+            self.offered.pop(t.id, None)
+            self.remote.pop(t.id, None)
+            asyncio.create_task(self.broker.withdraw(t.id))
+
+        ts.future.add_done_callback(done)
+
+    async def accept(self, offer: Offer) -> None:
+        """Queue a task claimed from another node, its result is published to the broker"""
+        t = Task.from_header(offer.header)
+        print(f'> [B] Claimed task {t.id} of {offer.origin}')
+        try:
+            if t.audio:
+                await store.fetch(t.audio, lambda dest: self.broker.fetch_audio(t.id, dest))
+        except Exception as e:
+            # The origin withdrew the offer
+            print(f'> [-] Failed to fetch audio of task {t.id}: {e}')
+            return
+
+        ts = TaskState(t, Future(), origin=offer.origin)
+        if t.audio:
+            ts.future.add_done_callback(lambda _: store.release(t.audio))
+        ts.future.add_done_callback(lambda f: asyncio.create_task(self.publish(ts, f)))
+        self.enqueue(ts)
+
+    async def publish(self, ts: TaskState, f: Future) -> None:
+        """Route the result of a claimed task back to its origin"""
+        if f.cancelled():
+            r = RemoteResult(ts.task.id, None, ('CancelledError', 'Task cancelled'))
+        elif f.exception() is not None:
+            r = RemoteResult(ts.task.id, None, (type(f.exception()).__name__, str(f.exception())))
+        else:
+            r = RemoteResult(ts.task.id, f.result(), None)
+        await self.broker.publish_result(ts.origin, r)
+
+    def remote_result(self, r: RemoteResult) -> None:
+        """Deliver the result of an offered task that another node computed"""
+        ts = self.offered.get(r.id)
+        if ts is None or ts.future.done():
+            return
+
+        print(f'> [B] Received result of task {r.id} from another coordinator')
+        if r.error:
+            ts.future.set_exception(REMOTE_ERRORS.get(r.error[0], RuntimeError)(r.error[1]))
+        else:
+            ts.future.set_result(r.result)
+
     async def add_worker(self, worker: ConnectedWorker):
         """Listen to worker finishing requests"""
         self.pool.append(worker)
+        self.slots.add(worker)
+        asyncio.create_task(self.check_queue())
+
+        # Results that arrive in chunk frames, mapped to (timings, buffer, received bytes). They are
+        # dropped with the connection, the worker sends them again whole after resuming its session.
+        partial: dict[str, tuple[dict | None, bytearray, int]] = {}
 
         async def listen():
             try:
                 # Listen for result
                 while worker.ws.client_state == WebSocketState.CONNECTED:
-                    # Receive text
-                    text = await worker.ws.receive_text()
-                    obj = json.loads(text)
+                    message = await worker.ws.receive()
+                    if message['type'] == 'websocket.disconnect':
+                        raise WebSocketDisconnect(message.get('code', 1000))
 
-                    # Missing required fields
-                    if 'id' not in obj or 'result' not in obj:
-                        print(f'> [-] Response from {worker.ws.client.host} ignored. It does not contain id or result')
+                    if message.get('bytes') is None:
+                        print(f'> [-] Text message from {worker.ws.client.host} ignored')
                         continue
 
-                    id = obj['id']
-
-                    # ID not found
-                    if id not in self.running_tasks:
-                        print(f'> [-] Response from {worker.ws.client.host} ignored. Running task of id {id} not found')
+                    # The result body is passed on as a view into the frame, without parsing
+                    msg = decode_message(message['bytes'])
+                    if msg.type == RESULT and 'size' in msg.header:
+                        partial[msg.header['id']] = (msg.header.get('timings'), bytearray(msg.header['size']), 0)
                         continue
+                    elif msg.type == CHUNK:
+                        id, offset, data = msg.header['id'], msg.header['offset'], msg.sections['data']
+                        if id not in partial:
+                            print(f'> [-] Chunk of unknown result {id} from {worker.ws.client.host} ignored')
+                            continue
+                        timings, buf, received = partial[id]
+                        buf[offset: offset + len(data)] = data
+                        received += len(data)
+                        if received < len(buf):
+                            partial[id] = (timings, buf, received)
+                            continue
+                        del partial[id]
+                        self.resolve(id, worker, memoryview(buf), timings)
+                    elif msg.type == RESULT:
+                        self.resolve(msg.header['id'], worker, msg.sections['result'], msg.header.get('timings'))
+                    elif msg.type == ERROR and msg.header.get('crash'):
+                        self.crashed(msg.header['id'], worker, msg.header['error'])
+                    elif msg.type == ERROR:
+                        self.fail(msg.header['id'], worker, msg.header['error'])
+                    elif msg.type == PONG:
+                        self.pong(worker, msg.header['seq'])
+                        continue
+                    else:
+                        print(f'> [-] Message of type {msg.type} from {worker.ws.client.host} ignored')
 
-                    print(f'> [R] Received Response for ID {id}, calling callback')
-
-                    # Return result to asyncio future
-                    t, w, future = self.running_tasks.pop(id)
-                    future.set_result(obj['result'])
-                    future.done()
+                    # A slot is free now, dispatch the next task
+                    await self.check_queue()
 
-            except ConnectionClosedError:
+            except (ConnectionClosedError, WebSocketDisconnect):
                 print(f'> [-] {worker.ws.client.host} Connection closed')
 
-                # Remove running tasks
-                to_remove = [id for id, w in self.running_tasks.items() if w[1].worker is worker]
-                print(f'> [-] Tasks to remove: {to_remove}')
+            finally:
+                self.worker_disconnected(worker)
+
+        await asyncio.gather(listen())
+
+    def worker_disconnected(self, worker: ConnectedWorker, park: bool = True) -> None:
+        """
+        Remove a worker. Its tasks are kept for SESSION_GRACE seconds in case it resumes its session,
+        then put back to the front of the queue.
 
-                # Return future
-                for id in to_remove:
-                    t, w, future = self.running_tasks.pop(id)
-                    future.cancel('Worker disconnected')
+        :param park: Keep the tasks for SESSION_GRACE. Evicted workers stopped answering, their tasks
+            are re-queued right away and their session ends.
+        """
+        self.remove_worker(worker)
 
+        if worker.session is not None:
+            # A worker that already resumed its session on another connection has nothing left here
+            if self.sessions.get(worker.session) is not worker:
                 return
 
-        await asyncio.gather(listen())
+            if park and SESSION_GRACE > 0 and any(worker in ts.dispatches for ts in self.running_tasks.values()):
+                print(f'> [S] Keeping the tasks of {worker.ws.client.host} for {SESSION_GRACE:g}s until it resumes')
+                self.parked[worker.session] = time.monotonic() + SESSION_GRACE
+                return
+            del self.sessions[worker.session]
+
+        self.requeue(worker)
+
+    def requeue(self, worker: ConnectedWorker) -> None:
+        """Put the tasks of a worker that is gone back to the front of the queue"""
+        # Tasks that already failed or were resolved by another worker only need the dispatch dropped
+        for id, ts in list(self.resolved_tasks.items()):
+            if ts.dispatches.pop(worker, None) is not None and not ts.dispatches:
+                del self.resolved_tasks[id]
+
+        # Re-queue the most recently dispatched task last, so that the oldest one ends up in front
+        affected = sorted((ts for ts in self.running_tasks.values() if worker in ts.dispatches),
+                          key=lambda ts: ts.dispatches[worker])
+        if affected:
+            print(f'> [-] Tasks to re-queue: {[ts.task.id for ts in affected]}')
 
+        for ts in reversed(affected):
+            self.drop_dispatch(ts, worker, 'Worker disconnected')
 
-pool = WorkerPool()
+    def drop_dispatch(self, ts: TaskState, worker: ConnectedWorker, reason: str) -> None:
+        """Forget the dispatch of a task to a worker that won't return its result, and retry it"""
+        del ts.dispatches[worker]
+        self.slots.release(worker)
+        if ts.future.done():
+            if not ts.dispatches:
+                self.resolved_tasks.pop(ts.task.id, None)
+            return
+
+        task_failures.inc(worker=worker.name, reason='disconnect')
+
+        # Expired dispatches were already re-queued when they expired
+        if worker not in ts.expired:
+            self.retry(ts, reason, ConnectionError)
+
+
+pool = WorkerPool(NODE_ID, connect_broker(BROKER_URL))
+
+# Coordinator processes sharing a broker must not share a spool directory
+store = AudioStore(claim(SPOOL_DIR))
+cache = ResultCache(CACHE_MEMORY_BYTES, Path(CACHE_DIR) if CACHE_DIR else None, CACHE_DISK_BYTES)
+approvals = ApprovalCache(APPROVAL_TTL, APPROVAL_MAX_ENTRIES)
+
+metrics = MetricSet()
+metrics.gauge('voice_queue_depth', 'Tasks waiting for a worker', ('queue',),
+              lambda: {('user',): len(pool.queued_tasks), ('verify',): len(pool.verify_queue)})
+metrics.gauge('voice_queue_bytes', 'Spooled bytes of queued tasks', fn=lambda: pool.queued_bytes)
+metrics.gauge('voice_tasks_in_flight', 'Tasks dispatched to workers without a result yet', fn=lambda: len(pool.running_tasks))
+metrics.gauge('voice_tasks_offered', 'Tasks offered to other coordinators without a result yet', fn=lambda: len(pool.offered))
+metrics.gauge('voice_workers', 'Connected workers', fn=lambda: len(pool.pool))
+metrics.gauge('voice_fleet_workers', 'Workers connected to all coordinators', fn=lambda: pool.fleet_workers)
+metrics.gauge('voice_worker_slots', 'Task slots of connected workers', fn=lambda: pool.capacity())
+metrics.gauge('voice_worker_running', 'Tasks running on each worker', ('worker',),
+              lambda: {(w.name,): w.running for w in pool.pool})
+metrics.gauge('voice_worker_rtt_seconds', 'Smoothed heartbeat round-trip time of each worker', ('worker',),
+              lambda: {(w.name,): w.rtt for w in pool.pool if w.rtt is not None})
+metrics.counter('voice_cache_requests_total', 'Result cache lookups', ('result',),
+                lambda: {('hit',): cache.stats.hits, ('miss',): cache.stats.misses, ('coalesced',): cache.stats.coalesced})
+metrics.counter('voice_verifications_total', 'Finished result verifications', ('result',),
+                lambda: {('passed',): verifier.stats.passed, ('failed',): verifier.stats.failed,
+                         ('error',): verifier.stats.errors})
+evictions = metrics.counter('voice_worker_evictions_total', 'Workers evicted for missing heartbeats')
+sessions_resumed = metrics.counter('voice_worker_sessions_resumed_total', 'Reconnected workers that resumed their session')
+rejected = metrics.counter('voice_rejected_total', 'Requests rejected by admission control', ('status',))
+queue_wait = metrics.histogram('voice_queue_wait_seconds', 'Time from entering the queue to dispatch', ('queue',))
+dispatch_seconds = metrics.histogram('voice_dispatch_seconds', 'Time to send a task to a worker')
+audio_stream_seconds = metrics.histogram('voice_audio_stream_seconds', 'Time to stream the audio of a task to a worker')
+task_seconds = metrics.histogram('voice_task_seconds', 'Time from dispatch to result on each worker', ('worker',))
+task_failures = metrics.counter('voice_task_failures_total', 'Failed dispatches on each worker', ('worker', 'reason'))
+stage_seconds = metrics.histogram('voice_stage_seconds', 'Time of pipeline stages reported by workers', ('stage',))
+verifier = Verifier(VERIFY_BUDGET, VERIFY_MIN_RATE, VERIFY_TRUST_STEP, VERIFY_MAX_PENDING,
+                    Tolerance(VERIFY_RTOL, VERIFY_ATOL, VERIFY_MIN_OVERLAP))
+
+
+class BinaryResponse(Response):
+    """Octet-stream response that sends bytes-like content (e.g. a memoryview) without copying it"""
+    media_type = 'application/octet-stream'
+
+    def render(self, content: bytes | memoryview) -> bytes | memoryview:
+        return content
 
 
 @app.get('/')
@@ -131,11 +1206,83 @@ async def root():
     return {'message': 'Hello World'}
 
 
+@app.on_event('startup')
+async def start_watchdog():
+    asyncio.create_task(pool.watchdog())
+    asyncio.create_task(pool.heartbeat())
+    asyncio.create_task(pool.share())
+
+
+class AdmissionControl:
+    """
+    Reject uploads to /process before their body is read if the queue cannot take them.
+
+    This is a plain ASGI middleware rather than @app.middleware('http'), which would wrap every
+    response into a StreamingResponse and copy the result bodies.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == '/process':
+            try:
+                size = int(dict(scope['headers']).get(b'content-length', 0))
+                if size < 0:
+                    raise ValueError(size)
+            except ValueError:
+                return await JSONResponse({'detail': 'Invalid content-length'}, 400)(scope, receive, send)
+
+            try:
+                pool.admit(size)
+            except QueueFullError as e:
+                response = JSONResponse({'detail': str(e)}, e.status, {'Retry-After': str(e.retry_after)})
+                return await response(scope, receive, send)
+
+        await self.app(scope, receive, send)
+
+
+# The last middleware added is the outermost, so CORS headers are added to the rejections of
+# AdmissionControl too. Retry-After is exposed so that browsers can back off.
+app.add_middleware(AdmissionControl)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, expose_headers=['Retry-After'])
+
+
 @app.post('/process')
-async def process(file: UploadFile, req: Request, with_mel_spect: bool = False):
+async def process(file: UploadFile, req: Request, components: str | None = None):
+    """
+    Analyze an uploaded recording
+
+    :param components: Comma separated components to compute (ml, spect, stats), all of them by default
+    """
     print(f'Received request from {req.client.host}')
-    params = {'file': await file.read(), 'file_name': file.filename, 'with_mel_spect': with_mel_spect}
-    return await pool.run_compute(compute_audio, params)
+    try:
+        components = parse_components(components)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    audio = await store.save(file)
+    params = {'file_name': file.filename, 'components': list(components)}
+    key = cache_key(audio.sha, 'compute_audio', {'components': list(components)})
+
+    # Long recordings are split into windows that can run on different workers. Recordings whose
+    # duration can't be probed go to a worker whole, which splits them by their decoded length.
+    if audio.probed and audio.duration > chunking.CHUNK_THRESHOLD:
+        compute = lambda: asyncio.ensure_future(pool.run_chunked(file.filename, audio, components))
+    else:
+        compute = lambda: pool.run_compute('compute_audio', params, audio, key)
+
+    try:
+        return BinaryResponse(await cache.get_or_compute(key, compute))
+    except QueueFullError as e:
+        raise HTTPException(e.status, str(e), {'Retry-After': str(e.retry_after)})
+    except asyncio.TimeoutError as e:
+        raise HTTPException(504, str(e))
+    except ConnectionError as e:
+        raise HTTPException(503, str(e))
+    except RuntimeError as e:
+        raise HTTPException(500, str(e))
+    finally:
+        store.release(audio.sha)
 
 
 @app.get('/pool')
@@ -145,10 +1292,44 @@ async def active_workers():
         info.token = '[Censored]'
         return info
 
-    return [{'host': s.ws.client.host, 'info': censor(s.worker), 'max_tasks': s.max_tasks}
+    return [{'host': s.ws.client.host, 'info': censor(s.worker), 'max_tasks': s.max_tasks, 'running': s.running,
+             'limiter': s.limiter.to_dict() if s.limiter else None, 'rtt': s.rtt, 'speed': s.speed,
+             'trusted': s.trusted, 'trusted_level': s.db.trusted_level, 'verify_rate': verifier.rate(s.db)}
             for s in pool.get_connected()]
 
 
+@app.get('/queue')
+async def queue_status():
+    """Queue depth and estimated wait, so that clients can back off before uploading"""
+    return {'depth': len(pool.queued_tasks), 'bytes': pool.queued_bytes,
+            'max_depth': QUEUE_MAX_DEPTH, 'max_bytes': QUEUE_MAX_BYTES,
+            'running': len(pool.running_tasks), 'workers': len(pool.pool), 'capacity': pool.capacity(),
+            'node': pool.node, 'fleet_workers': pool.fleet_workers, 'offered': len(pool.offered),
+            'parked_sessions': len(pool.parked),
+            'drain_rate': pool.drain.rate(), 'estimated_wait': pool.estimated_wait()}
+
+
+@app.get('/cache')
+async def cache_stats():
+    return cache.to_dict()
+
+
+@app.get('/metrics')
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=MetricSet.CONTENT_TYPE)
+
+
+@app.get('/approvals')
+async def approval_stats():
+    return approvals.to_dict()
+
+
+@app.get('/verification')
+async def verification_stats():
+    return {**verifier.to_dict(), 'pending': len(pool.verify_queue),
+            'limit': verifier.limit(pool.trusted_capacity())}
+
+
 @app.websocket('/ws/worker-connect')
 async def worker_connect(ws: WebSocket):
     await ws.accept()
@@ -162,23 +1343,33 @@ async def worker_connect(ws: WebSocket):
         assert info.version == version,\
             f'Please upgrade to the latest version {version} (You\'re on {info.version})'
 
+        # Check task versions
+        assert info.tasks == registry.versions(),\
+            f'Please upgrade to the latest version, tasks {registry.versions()} are required (You have {info.tasks})'
+
         # Check token registration
         assert TOKEN_RE.match(info.token), 'Token format mismatch'
-        worker, created = await Worker.get_or_create(token=info.token)
+        digest = token_digest(info.token)
+        worker, created = await approvals.get(digest)
         if created:
-            print(f'> [U] Token created ({info.token[:16]}...)')
+            print(f'> [U] Token created ({digest[:16]}...)')
         assert worker.approved, 'Token not approved'
 
         if not worker.nickname:
-            worker.nickname = info.token[16:]
+            worker.nickname = digest[:16]
 
-        # Check max tasks
-        max_tasks = min(info.cpu_count, 2)
+        # Start with a conservative number of slots, the limiter raises it up to the worker's capacity
+        capacity = info.capacity or info.cpu_count
+        limiter = AimdLimiter(min(capacity, 2), max(capacity, 1))
 
-        # Passed, add to worker pool
+        # Passed, resume the previous session of the worker or start a new one
         print('> [+] Validation passed.')
-        await ws.send_text('Success')
-        await pool.add_worker(ConnectedWorker(info, worker, ws, max_tasks))
+        connected = ConnectedWorker(info, worker, ws, limiter.limit, limiter, speed=pool.initial_speed(info))
+        if not (info.session and pool.resume(info.session, connected, info.holding)):
+            connected.session = uuid.uuid4().hex
+            pool.sessions[connected.session] = connected
+        await ws.send_text(f'Success {connected.session}')
+        await pool.add_worker(connected)
 
     # Any other errors
     except Exception as e:
@@ -197,3 +1388,16 @@ register_tortoise(
     generate_schemas=True,
     add_exception_handlers=True
 )
+
+
+@app.on_event('startup')
+async def migrate_database():
+    # Registered after register_tortoise, whose startup handler opens the database, and before the
+    # first query
+    await migrate()
+
+
+@app.on_event('startup')
+async def warm_approvals():
+    # Workers reconnect all at once after a restart, load them in one query beforehand
+    print(f'> [U] Loaded {await approvals.warm()} workers')
@@ -4,7 +4,9 @@ from tortoise import fields
 
 class Worker(Model):
     id = fields.IntField(pk=True)
-    token = fields.CharField(max_length=2048)
+
+    # SHA-256 hex digest of the 2048-character token, see utils.approval.token_digest
+    token_digest = fields.CharField(max_length=64, unique=True)
 
     # Only approved servers can be used
     approved = fields.BooleanField(default=True)
@@ -12,6 +14,10 @@ class Worker(Model):
     # Whether we fully trust the server
     trusted = fields.BooleanField(default=False)
 
+    # How much we trust an untrusted server (0 - 1), raised by every verified result. Results are
+    # re-checked on trusted servers with probability 1 - trusted_level.
+    trusted_level = fields.FloatField(default=0)
+
     # Creation date
     created = fields.DatetimeField(auto_now=True)
 
@@ -0,0 +1,82 @@
+"""
+Schema migrations of tables that generate_schemas() created before their models changed.
+generate_schemas() only creates missing tables, so the columns that were added later are added
+here, at startup before the first query.
+
+Also runnable once by hand (from src/): MYSQL_URL=... python -m database.migrate
+"""
+import asyncio
+import os
+
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from utils.approval import token_digest
+
+
+async def columns(conn: BaseDBAsyncClient, table: str) -> set[str]:
+    """Column names of a table"""
+    if conn.capabilities.dialect == 'sqlite':
+        return {r['name'] for r in await conn.execute_query_dict(f'PRAGMA table_info({table})')}
+    rows = await conn.execute_query_dict(
+        f"SELECT column_name AS name FROM information_schema.columns "
+        f"WHERE table_schema = DATABASE() AND table_name = '{table}'")
+    return {r['name'] for r in rows}
+
+
+async def migrate_worker_tokens(conn: BaseDBAsyncClient) -> None:
+    """
+    Replace the plaintext `token` column of workers with `token_digest` (see utils.approval).
+
+    Rows of the same token, which the old unindexed lookup could create concurrently, are merged
+    into the oldest one: it stays approved or trusted only if all of them are.
+    """
+    await conn.execute_script('ALTER TABLE worker ADD COLUMN token_digest VARCHAR(64) NULL')
+
+    rows = await conn.execute_query_dict('SELECT id, token, approved, trusted FROM worker ORDER BY id')
+    kept: dict[str, dict] = {}
+    for r in rows:
+        digest = token_digest(r['token'])
+        first = kept.setdefault(digest, r)
+        if first is not r:
+            first['approved'] = first['approved'] and r['approved']
+            first['trusted'] = first['trusted'] and r['trusted']
+            await conn.execute_script(f'DELETE FROM worker WHERE id = {int(r["id"])}')
+
+    # Digests are hex and ids are integers, they can be inlined in every dialect
+    for digest, r in kept.items():
+        await conn.execute_script(
+            f"UPDATE worker SET token_digest = '{digest}', approved = {int(bool(r['approved']))}, "
+            f"trusted = {int(bool(r['trusted']))} WHERE id = {int(r['id'])}")
+
+    await conn.execute_script('CREATE UNIQUE INDEX uid_worker_token_digest ON worker (token_digest)')
+    if conn.capabilities.dialect != 'sqlite':
+        await conn.execute_script('ALTER TABLE worker MODIFY token_digest VARCHAR(64) NOT NULL')
+    await conn.execute_script('ALTER TABLE worker DROP COLUMN token')
+    print(f'> [+] Migrated {len(rows)} worker tokens to digests ({len(rows) - len(kept)} duplicates merged)')
+
+
+async def migrate(conn: BaseDBAsyncClient | None = None) -> None:
+    """Bring the tables up to date with database.db, does nothing on an up-to-date database"""
+    conn = conn or Tortoise.get_connection('default')
+    worker = await columns(conn, 'worker')
+
+    if 'token' in worker:
+        await migrate_worker_tokens(conn)
+
+    if 'trusted_level' not in worker:
+        kind = 'REAL' if conn.capabilities.dialect == 'sqlite' else 'DOUBLE'
+        await conn.execute_script(f'ALTER TABLE worker ADD COLUMN trusted_level {kind} NOT NULL DEFAULT 0')
+        print('> [+] Added worker.trusted_level')
+
+
+async def main():
+    await Tortoise.init(db_url=os.environ['MYSQL_URL'], modules={'models': ['database.db']})
+    try:
+        await migrate()
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,110 +1,404 @@
-import base64
-import datetime
+from __future__ import annotations
+
 import json
-from pathlib import Path
-from typing import NamedTuple
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterable
 
 import numpy as np
-import parselmouth
-import sgs
-import tensorflow as tf
-import tensorflow_io as tfio
 from hypy_utils import Timer
-from inaSpeechSegmenter import Segmenter
-from inaSpeechSegmenter.constants import ina_config
-from inaSpeechSegmenter.features import to_wav
-from inaSpeechSegmenter.sidekit_mfcc import read_wav
-from sgs.config import sgs_config
 
-from bot.bdict_encoder import bdict_encode
+from utils import batching
+from utils.chunking import CHUNK_THRESHOLD, FREQ_STEP, Span, Window, cut, feature_means, read_span, span, stitch, \
+    windows
+from utils.decode import Audio, open_audio
+from utils.mel import MEL_STRIDE, frame_count, mel_spectrogram
+from utils.metrics import collect_stages, collected, stage
+from utils.results import COMPONENTS, FEATURE_COMPONENTS, RawComputeResults, parse_components
+from utils.stage_graph import Stage, run_stages
+from utils.vad import place_rows, row_regions, speech
 
-gpu_devices = tf.config.experimental.list_physical_devices('GPU')
-for device in gpu_devices:
-    tf.config.experimental.set_memory_growth(device, True)
+if TYPE_CHECKING:
+    from inaSpeechSegmenter import Segmenter
 
-seg = Segmenter()
 np.seterr(invalid='ignore')
-sgs_config.time_step = 0.01
+
+# Sample rate of the Segmenter networks
+SEGMENTER_SR = 16000
 
 
-def b64(nd: np.ndarray) -> dict[str, any]:
-    return {'bytes': base64.b64encode(nd.tobytes()).decode(), 'shape': nd.shape}
+@lru_cache(maxsize=None)
+def load() -> Segmenter | None:
+    """
+    Import the model stack and load the Segmenter, once per process.
 
+    TensorFlow takes seconds to import and gigabytes of memory, so it is only loaded by the processes
+    that run tasks (see utils.task_pool), never when this module is imported.
 
-class RawComputeResults(NamedTuple):
-    result: dict
-    freq_array: np.ndarray
-    ml: list
-    mel_spectrogram: np.ndarray
-    sr: int
-    audio_dur: float
+    :return: Segmenter, or None if segmentation is batched in another process (see utils.batching)
+    """
+    import tensorflow as tf
+    from inaSpeechSegmenter import Segmenter
 
-    def to_json_dict(self) -> dict:
-        return {'result': self.result, 'ml': self.ml, 'freq_array': b64(self.freq_array.T),
-                'spec': b64(self.mel_spectrogram), 'spec_sr': self.sr}
+    for device in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(device, True)
 
-    def to_bdict(self) -> bytes:
-        j = {'result': self.result, 'ml': self.ml, 'spec_sr': self.sr,
-             'spec_rows': self.mel_spectrogram.shape[0], 'audio_dur': self.audio_dur}
-        bd = {'freq_array': self.freq_array.T.tobytes(), 'spec': self.mel_spectrogram.tobytes(),
-              'json': json.dumps(j)}
-        return bdict_encode(bd)
+    if batching.connected():
+        return None
+    return Segmenter()
 
 
-def write_file(file: bytes, file_name: str) -> Path:
+def predict_batch(dnn, mspecs: list[np.ndarray], lsegs: list, difflens: list[int]) -> list:
     """
-    Write bytes
+    Run one network of the segmenter on several files with a single forward pass, like
+    DnnSegmenter.__call__ does for one file
+
+    :param dnn: Network of the segmenter (seg.vad or seg.gender)
+    :param mspecs: Mel spectrogram of each file
+    :param lsegs: Segments of each file from the previous stage, or the exception raised for it
+    :param difflens: Padding of each file
+    :return: Segments of each file, or the exception raised for it
     """
-    tmp_file = Path(datetime.datetime.now().strftime(f'%Y-%m-%d %H-%M-%S {Path(file_name).suffix}'))
-    tmp_file = Path(f'audio_tmp/{tmp_file}')
-    tmp_file.parent.mkdir(parents=True, exist_ok=True)
-    tmp_file.write_bytes(file)
+    from inaSpeechSegmenter.constants import ResultFrame
+    from inaSpeechSegmenter.segmenter import _get_patches, _bin_labels_to_segments
+    from inaSpeechSegmenter.util.pyannote_viterbi import viterbi_decoding_simple
+    from inaSpeechSegmenter.viterbi_utils import diag_trans_exp
+
+    lsegs = list(lsegs)
+
+    # Windows of each file that go through the network, and which of their frames are finite
+    inputs: dict[int, tuple[list[np.ndarray], np.ndarray]] = {}
+    for i, lseg in enumerate(lsegs):
+        if isinstance(lseg, Exception):
+            continue
+        try:
+            mspec = mspecs[i][:, :dnn.num_mel].copy() if dnn.num_mel < 24 else mspecs[i]
+            patches, finite = _get_patches(mspec, 68, 2)
+            if difflens[i] > 0:
+                patches = patches[:-int(difflens[i] / 2), :, :]
+                finite = finite[:-int(difflens[i] / 2)]
+            windows = [patches[cur.start:cur.end, :] for cur in lseg if cur.label == dnn.in_label]
+
+            # Nothing to batch, the network handles the file the way the segmenter would
+            if not windows:
+                lsegs[i] = dnn(mspecs[i], lseg, difflens[i])
+                continue
+            inputs[i] = (windows, finite)
+        except Exception as e:
+            lsegs[i] = e
+
+    if not inputs:
+        return lsegs
+
+    pred = dnn.nn.predict(np.concatenate([w for windows, _ in inputs.values() for w in windows]),
+                          batch_size=dnn.batch_size)
+
+    # Split the predictions back into files, in the order they were concatenated
+    transitions = diag_trans_exp(dnn.viterbi_arg, len(dnn.out_labels))
+    for i, (_, finite) in inputs.items():
+        ret = []
+        for cur in lsegs[i]:
+            if cur.label != dnn.in_label:
+                ret.append(cur)
+                continue
 
-    return tmp_file
+            r = pred[:cur.end - cur.start]
+            pred = pred[cur.end - cur.start:]
+            r[~finite[cur.start:cur.end], :] = 0.5
+            for label, start, stop in _bin_labels_to_segments(viterbi_decoding_simple(np.log(r), transitions)):
+                label = int(label)
+                ret.append(ResultFrame(dnn.out_labels[label], start + cur.start, stop + cur.start,
+                                       float(np.mean(r[start:stop, label]))))
+        lsegs[i] = ret
 
+    return lsegs
 
-def compute_audio_raw(file: Path) -> RawComputeResults:
+
+def segment_batch(seg: Segmenter, feats: list[tuple[np.ndarray, np.ndarray, int]]) -> list:
     """
-    Compute user request
+    Segment several files like Segmenter.segment_feats, with one forward pass per network for all
+    of them. Small per-file passes don't amortize the overhead of the networks, especially on CPUs.
 
-    :param file: Audio file
-    :return: Computation result
+    :param seg: Segmenter
+    :param feats: (mspec, loge, difflen) of each file, see inaSpeechSegmenter.features.media2feats
+    :return: Segments of each file in seconds, or the exception raised for it
     """
-    timer = Timer()
+    from inaSpeechSegmenter.constants import ResultFrame
+    from inaSpeechSegmenter.segmenter import _energy_activity, _bin_labels_to_segments
+
+    # Energy-based activity detection
+    lsegs = []
+    for mspec, loge, difflen in feats:
+        try:
+            activity = _energy_activity(loge, seg.energy_ratio)[::2]
+            lsegs.append([ResultFrame('energy' if label else 'noEnergy', start, stop)
+                          for label, start, stop in _bin_labels_to_segments(activity)])
+        except Exception as e:
+            lsegs.append(e)
+
+    # Voice activity detection, then gender segmentation of speech segments
+    mspecs, difflens = [f[0] for f in feats], [f[2] for f in feats]
+    lsegs = predict_batch(seg.vad, mspecs, lsegs, difflens)
+    if seg.detect_gender:
+        lsegs = predict_batch(seg.gender, mspecs, lsegs, difflens)
 
-    # Read file
-    wav_full = to_wav(file, sr=None)
-    y, sr, _ = read_wav(wav_full)
-    sound = parselmouth.Sound(y, sr)
-    timer.log('File read.')
+    # Convert bins to seconds
+    return [lseg if isinstance(lseg, Exception) else
+            [(lab, start * .02, stop * .02, conf) for lab, start, stop, conf in lseg] for lseg in lsegs]
+
+
+def segment_features(audio: Audio) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Compute the Segmenter features of decoded audio, like inaSpeechSegmenter.features.media2feats
+    does for a file after converting it to 16 kHz mono WAV
+
+    :return: (mspec, loge, difflen)
+    """
+    from inaSpeechSegmenter.tf_mfcc import mel_spect
+
+    y = audio.resample(SEGMENTER_SR).y
+    with np.errstate(divide='ignore'):
+        loge, mspec = mel_spect(y)
+
+    # Pad short files to the size of one window of the networks
+    difflen = 0
+    if len(loge) < 68:
+        difflen = 68 - len(loge)
+        mspec = np.concatenate((mspec, np.ones((difflen, 24)) * np.min(mspec)))
+
+    return mspec, loge, difflen
+
+
+def segment(audio: Audio) -> list:
+    """
+    Segment decoded audio with the Segmenter, batched with the files of concurrent tasks if the
+    worker runs a batch process
+    """
+    feats = segment_features(audio)
+    if batching.connected():
+        return batching.submit(feats)
+
+    ml = segment_batch(load(), [feats])[0]
+    if isinstance(ml, Exception):
+        raise ml
+    return ml
+
+
+def praat(audio: Audio, vad: np.ndarray | None = None) -> tuple[dict, np.ndarray]:
+    """
+    Praat feature classification
+
+    :param vad: Speech regions to restrict the analysis to (see utils.vad), None for the whole audio
+    :return: Statistics of the features, and the frequency array (pitch, F1, F2, F3 of each frame)
+    """
+    if vad is not None:
+        # Each region is analyzed on its own so that no track runs across the gaps between regions, the
+        # statistics are merged like those of the windows of a long recording
+        regions = row_regions(vad, audio.sr, FREQ_STEP)
+        parts = [praat(Audio(audio.y[a:b], audio.sr)) for a, b in regions]
+        if not any(len(freq) for _, freq in parts):
+            return {}, np.zeros((0, 4), np.float32)
+
+        freq_array = place_rows([freq for _, freq in parts], regions, len(audio.y), audio.sr, FREQ_STEP)
+        tilts = [(r['means']['tilt'], (b - a) / audio.sr) for (r, _), (a, b) in zip(parts, regions)
+                 if r.get('means', {}).get('tilt') is not None]
+        means = feature_means(freq_array, tilts)
+        return {'means': means, 'fem_prob': classify(means)}, freq_array
+
+    import parselmouth
+    import sgs
+    from sgs.config import sgs_config
+
+    sgs_config.time_step = FREQ_STEP
 
-    # Calculate features
     try:
-        result, freq_array = sgs.api.calculate_feature_classification(sound)
-        result = {k: {x: result[k][x] for x in result[k] if not np.isnan(result[k][x])} for k in result}
-        timer.log('Features calculated')
+        result, freq_array = sgs.api.calculate_feature_classification(parselmouth.Sound(audio.y, audio.sr))
+        return {k: {x: v for x, v in result[k].items() if v is not None and not np.isnan(v)} for k in result}, \
+            freq_array
     except IndexError as e:
         # If the audio is too short, an IndexError: index -1 is out of bounds for axis 0 with size 0 will be raised
-        result = {}
-        freq_array = np.ndarray((0, 4), 'float32')
-        timer.log(f'Features calculation failed - IndexError: {e}')
+        print(f'> [-] Features calculation failed - IndexError: {e}')
+        return {}, np.ndarray((0, 4), 'float32')
+
 
-    # Calculate ML
-    ina_config.auto_convert = sr != 16000
+def segmenter(audio: Audio) -> list:
+    """Segmenter results, empty if the audio is too short"""
     try:
-        ml = seg(wav_full)
-        timer.log('ML Segmented')
+        return segment(audio)
     except KeyError as e:
         # If the audio is too short, a KeyError: 'pop from an empty set' might be raised
-        ml = []
-        timer.log(f'ML Segment Failed - KeyError: {e}')
+        print(f'> [-] ML Segment Failed - KeyError: {e}')
+        return []
+
+
+def mel(audio: Audio, vad: np.ndarray | None = None) -> np.ndarray:
+    """
+    Mel spectrogram, see utils.mel for the backends
 
-    # Calculate mel spectrogram
-    t = tfio.audio.spectrogram(y, 2048, 2048, 512)
-    mel_spectrogram = tfio.audio.melscale(t, rate=sr, mels=128, fmin=0, fmax=8000).numpy()
+    :param vad: Speech regions (see utils.vad) starting at multiples of the stride, the frames of the
+        rest of the audio are zero. None for the whole audio.
+    """
+    if vad is None:
+        return mel_spectrogram(audio.y, audio.sr, 2048, 2048, MEL_STRIDE, mels=128, fmin=0, fmax=8000)
+
+    # Each frame of a region is computed from the same samples as in the spectrogram of the whole audio
+    out = np.zeros((frame_count(len(audio.y), MEL_STRIDE), 128), np.float32)
+    for a, b in vad:
+        first, stop = a // MEL_STRIDE, frame_count(b, MEL_STRIDE)
+        y = audio.y[a:stop * MEL_STRIDE + 2048 - MEL_STRIDE]
+        out[first:stop] = mel(Audio(y, audio.sr))[:stop - first]
+    return out
+
+
+def vad(audio: Audio) -> np.ndarray | None:
+    """Speech regions of the audio that the Praat and mel stages analyze, see utils.vad"""
+    return speech(audio, MEL_STRIDE)
+
+
+# Stages of compute_audio_raw after decoding, they run concurrently once their inputs are ready
+ANALYSIS_STAGES = [
+    Stage('vad', vad, ('audio',)),
+    Stage('praat', praat, ('audio', 'vad')),
+    Stage('segmenter', segmenter, ('audio',)),
+    Stage('mel', mel, ('audio', 'vad')),
+]
+
+# Components (see utils.results.COMPONENTS) that need each stage, stages that no requested component
+# needs are skipped
+STAGE_COMPONENTS = {
+    'vad': FEATURE_COMPONENTS,
+    'praat': FEATURE_COMPONENTS,
+    'segmenter': ('ml',),
+    'mel': ('spect',),
+}
+
+
+def analysis_stages(components: Iterable[str]) -> list[Stage]:
+    """Stages that compute the given components"""
+    components = set(components)
+    return [s for s in ANALYSIS_STAGES if components & set(STAGE_COMPONENTS[s.name])]
+
+
+def classify(means: dict[str, float]) -> dict[str, float]:
+    """Probability of each feature mean sounding feminine, like sgs.api.calculate_feature_classification"""
+    from sgs.api import _calculate_fem_prob
+
+    return {k: float(_calculate_fem_prob(k, v)) for k, v in means.items()}
+
+
+def analyze(audio: Audio, components: tuple[str, ...] = COMPONENTS) -> RawComputeResults:
+    """
+    Run the analysis stages of some components on decoded audio. The Praat features are kept for all
+    components that need them, see RawComputeResults.select() to drop them.
+    """
+    out = run_stages(analysis_stages(components), audio=audio)
+    result, freq_array = out.get('praat', ({}, np.zeros((0, 4), np.float32)))
+    spec = out.get('mel', np.zeros((0, 0), np.float32))
+    return RawComputeResults(result, freq_array, out.get('segmenter', []), spec, audio.sr, audio.duration, {},
+                             components)
+
+
+def analyze_window(audio: Audio, s: Span, components: tuple[str, ...] = COMPONENTS) -> RawComputeResults:
+    """Analyze the audio read for a window of a long recording, cut to the part that the window keeps"""
+    if s.keep == 0:
+        return RawComputeResults({}, np.zeros((0, 4), np.float32), [], np.zeros((0, 0), np.float32), audio.sr, 0, {},
+                                 components)
+    return cut(analyze(audio, components), s, MEL_STRIDE)
+
+
+def compute_audio_raw(file: bytes | Audio, components: Iterable[str] | str | None = None) -> RawComputeResults:
+    """
+    Compute user request.
+
+    Only the stages of the requested components run, the parts of other components are left empty in
+    the result. Recordings longer than CHUNK_THRESHOLD are decoded and analyzed in overlapping windows
+    whose results are stitched, so memory doesn't grow with their length (see utils.chunking).
+
+    :param file: File content, or audio that is already decoded
+    :param components: Components to compute (see utils.results.COMPONENTS), all of them by default
+    :return: Computation result
+    :raises ValueError: If the components are invalid
+    """
+    components = parse_components(components)
+    stages = analysis_stages(components)
+    if any(s.name == 'segmenter' for s in stages):
+        load()
+    timer = Timer()
+
+    with collect_stages(collected()) as timings:
+        # Decode file, every stage works on the same PCM
+        with stage('decode'):
+            stream = open_audio(file)
+            head = stream.read(int(CHUNK_THRESHOLD * stream.sr) + 1)
+
+        with stream:
+            if len(head) <= CHUNK_THRESHOLD * stream.sr:
+                timer.log('File decoded.')
+                results = analyze(Audio(head, stream.sr), components)
+            else:
+                parts = []
+                chunks = windows(stream, MEL_STRIDE, head)
+                del head
+                while True:
+                    with stage('decode'):
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    parts.append(analyze_window(*chunk, components))
+                    timer.log(f'Window {len(parts)} analyzed.')
+
+                results = stitch(parts)
+                if 'stats' in components:
+                    fem_prob = classify(results.result['means'])
+                    results = results._replace(result={**results.result, 'fem_prob': fem_prob})
+
+        timer.log(f'Analysis done: {", ".join(f"{s.name} {timings.get(s.name, 0):.2f}s" for s in stages)}')
+
+    return results.select(components)._replace(timings=dict(timings))
+
+
+def compute_audio(file: bytes, file_name: str, components: list[str] | None = None) -> bytes:
+    """
+    Task of the workers
+
+    :param file: File content
+    :param file_name: Name of the uploaded file, the format is detected from the content
+    :param components: Components to compute, all of them by default
+    """
+    results = compute_audio_raw(file, components)
+    with stage('encode'):
+        return results.to_bdict()
+
+
+def compute_window(file: bytes, file_name: str, start: float, stop: float | None, overlap: float,
+                   components: list[str] | None = None, offset: int = 0) -> bytes:
+    """
+    Task of the workers for one window of a long recording, the coordinator stitches the results of
+    the windows (see utils.chunking)
+
+    :param file: File content, the whole recording or a segment of it that holds the window
+    :param file_name: Name of the uploaded file
+    :param start: Start of the window in seconds
+    :param stop: End of the window in seconds, None for the rest of the recording
+    :param overlap: Seconds of context on both sides
+    :param components: Components to compute, all of them by default. The Praat features of the
+        window are kept for all components that need them, the stitched result is selected instead.
+    :param offset: Sample of the recording that `file` starts at, if it is a segment
+    """
+    components = parse_components(components)
+    if any(s.name == 'segmenter' for s in analysis_stages(components)):
+        load()
+    with collect_stages(collected()):
+        with stage('decode'):
+            stream = open_audio(file)
+        with stream:
+            with stage('decode'):
+                audio, s = read_span(stream, span(Window(start, stop, overlap), stream.sr, MEL_STRIDE), offset)
+            results = analyze_window(audio, s, components)
 
-    return RawComputeResults(result, freq_array, ml, mel_spectrogram, sr, sound.duration)
+        with stage('encode'):
+            return results.to_bdict()
 
 
-def compute_audio(file: bytes, file_name: str) -> bytes:
-    return compute_audio_raw(write_file(file, file_name)).to_bdict()
+def classify_features(means: dict[str, float]) -> bytes:
+    """Task of the workers that classifies the stitched feature means of a long recording"""
+    return json.dumps(classify(means)).encode()
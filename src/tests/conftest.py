@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# The coordinator connects these when it is imported
+os.environ.setdefault('MYSQL_URL', 'sqlite://:memory:')
+os.environ.setdefault('SPOOL_DIR', tempfile.mkdtemp(prefix='spool-'))
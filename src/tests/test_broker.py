@@ -0,0 +1,76 @@
+import asyncio
+
+from utils.broker import RemoteResult, SqliteBroker
+
+HEADER = ['compute_audio', {}]
+
+
+def run(coro) -> None:
+    asyncio.run(coro)
+
+
+def test_claim_exclusive(tmp_path):
+    async def main():
+        a, b, c = (SqliteBroker(tmp_path / 'broker.db') for _ in range(3))
+        for i in range(10):
+            await a.submit('a', f't{i}', HEADER, None)
+
+        # Nodes claiming at once never get the same task, and never their own offers
+        claims = await asyncio.gather(*[broker.claim_next(node, 4) for broker, node in [(b, 'b'), (c, 'c')] * 2])
+        ids = [o.id for claimed in claims for o in claimed]
+        assert sorted(ids) == sorted(f't{i}' for i in range(10))
+        assert not await a.claim_next('a', 10)
+
+        # The origin can't dispatch a task that another node claimed
+        claimed_by_b = {o.id for o in claims[0] + claims[2]}
+        id = next(iter(claimed_by_b))
+        assert not await a.claim(id, 'a')
+        assert await b.claim(id, 'b')
+
+    run(main())
+
+
+def test_claim_own_offer(tmp_path):
+    async def main():
+        a, b = SqliteBroker(tmp_path / 'broker.db'), SqliteBroker(tmp_path / 'broker.db')
+        await a.submit('a', 't', HEADER, None)
+        assert await a.claim('t', 'a')
+        assert not await b.claim_next('b', 1)
+        assert not await b.claim('t', 'b')
+
+    run(main())
+
+
+def test_result_routing(tmp_path):
+    async def main():
+        a, b, c = (SqliteBroker(tmp_path / 'broker.db') for _ in range(3))
+        await b.publish_result('a', RemoteResult('t1', b'result', None))
+        await c.publish_result('a', RemoteResult('t2', None, ('RuntimeError', 'failed')))
+        await c.publish_result('b', RemoteResult('t3', b'other', None))
+
+        results = {r.id: r for r in await a.poll_results('a')}
+        assert results == {'t1': RemoteResult('t1', b'result', None),
+                           't2': RemoteResult('t2', None, ('RuntimeError', 'failed'))}
+        assert not await a.poll_results('a')
+        assert [r.id for r in await b.poll_results('b')] == ['t3']
+
+    run(main())
+
+
+def test_fetch_audio(tmp_path):
+    async def main():
+        a, b = SqliteBroker(tmp_path / 'broker.db'), SqliteBroker(tmp_path / 'broker.db')
+        spooled = tmp_path / 'spool-a'
+        spooled.write_bytes(b'audio' * 1000)
+        await a.submit('a', 't', HEADER, spooled)
+        await b.claim_next('b', 1)
+
+        dest = tmp_path / 'spool-b'
+        await b.fetch_audio('t', dest)
+        assert dest.read_bytes() == spooled.read_bytes()
+
+        # The origin releasing its file doesn't affect the copy
+        spooled.unlink()
+        assert dest.read_bytes() == b'audio' * 1000
+
+    run(main())
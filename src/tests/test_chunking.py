@@ -0,0 +1,31 @@
+import io
+
+import numpy as np
+import pytest
+
+from utils.chunking import Window, read_span, segment, span
+from utils.decode import open_audio
+from utils.mel import MEL_STRIDE
+
+soundfile = pytest.importorskip('soundfile')
+
+
+def test_segment(tmp_path):
+    sr = 8000
+    y = (np.random.default_rng(0).standard_normal(sr * 30) * 0.1).astype(np.float32)
+    file = tmp_path / 'a.wav'
+    soundfile.write(file, y, sr, subtype='PCM_16')
+
+    for w in [Window(0, 10, 1), Window(10, 20, 1), Window(20, None, 1)]:
+        data, offset = segment(file, w, MEL_STRIDE)
+        assert offset == span(w, sr, MEL_STRIDE).start
+        assert soundfile.info(io.BytesIO(data)).format == 'FLAC'
+
+        # The window reads the same samples from its segment as from the whole recording
+        s = span(w, sr, MEL_STRIDE)
+        with open_audio(file.read_bytes()) as stream:
+            whole, s_whole = read_span(stream, s)
+        with open_audio(data) as stream:
+            part, s_part = read_span(stream, s, offset)
+        assert s_whole == s_part
+        assert np.array_equal(whole.y, part.y)
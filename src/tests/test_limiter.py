@@ -0,0 +1,91 @@
+from utils.limiter import AimdLimiter, LatencyTracker
+
+
+def window(limiter: AimdLimiter, latency: float, saturated: bool = True, cost: float = 1.0) -> int:
+    """Complete one window of `limit` tasks"""
+    if saturated:
+        limiter.mark_busy(limiter.limit)
+    for _ in range(limiter.limit - 1):
+        limiter.observe(latency * cost, cost)
+    return limiter.observe(latency * cost, cost)
+
+
+def test_additive_increase():
+    limiter = AimdLimiter(2, max_limit=5)
+    assert [window(limiter, 1.0) for _ in range(5)] == [3, 4, 5, 5, 5]
+    assert [c.reason for c in limiter.history] == ['initial', 'probe', 'probe', 'probe']
+
+
+def test_no_increase_without_saturation():
+    limiter = AimdLimiter(2, max_limit=5)
+    limiter.mark_busy(1)
+    assert window(limiter, 1.0, saturated=False) == 2
+
+
+def test_limit_changes_only_at_window_end():
+    limiter = AimdLimiter(3, max_limit=5)
+    limiter.mark_busy(3)
+    assert limiter.observe(1.0) == 3
+    assert limiter.observe(1.0) == 3
+    assert limiter.observe(1.0) == 4
+
+
+def test_multiplicative_decrease():
+    limiter = AimdLimiter(8, max_limit=16)
+    window(limiter, 1.0, saturated=False)
+    assert limiter.baseline == 1.0
+
+    # Above tolerance times the baseline
+    assert window(limiter, 2.0) == 6
+    assert limiter.history[-1].reason == 'latency'
+
+    # Within tolerance, but not saturated: unchanged
+    assert window(limiter, 1.4, saturated=False) == 6
+
+
+def test_floor():
+    limiter = AimdLimiter(3, max_limit=8, min_limit=2)
+    window(limiter, 1.0, saturated=False)
+    assert [window(limiter, 10.0) for _ in range(3)] == [2, 2, 2]
+
+    limiter = AimdLimiter(1, max_limit=8)
+    window(limiter, 1.0, saturated=False)
+    assert window(limiter, 10.0) == 1
+
+
+def test_latency_normalized_by_cost():
+    limiter = AimdLimiter(2, max_limit=4)
+    window(limiter, 1.0, saturated=False)
+
+    # Larger tasks take longer at the same speed, that is not contention
+    assert window(limiter, 1.0, cost=20) == 3
+
+
+def test_baseline_follows_recent_windows():
+    limiter = AimdLimiter(1, max_limit=1, baseline_windows=3)
+    window(limiter, 1.0)
+    for _ in range(3):
+        window(limiter, 2.0)
+    assert limiter.baseline == 2.0
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(size=100)
+    for i in range(19):
+        tracker.observe(i)
+    assert tracker.percentile(0.5) is None
+
+    tracker.observe(19)
+    assert tracker.percentile(0) == 0
+    assert tracker.percentile(0.5) == 10
+    assert tracker.percentile(1) == 19
+
+    # Normalized by cost, and the cached percentiles follow new samples
+    for _ in range(20):
+        tracker.observe(400, cost=10)
+    assert tracker.percentile(1) == 40
+
+    # Only the last `size` samples count
+    for _ in range(100):
+        tracker.observe(1)
+    assert tracker.percentile(1) == 1
@@ -0,0 +1,51 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from utils.mel import frame_count, mel_filterbank, mel_spectrogram, spectrogram
+
+# Filterbank and spectrograms of tf.signal / tfio for a 0.3 s chirp at 16 kHz with the analysis parameters,
+# regenerate with `python -m benchmarks.mel --reference`
+REFERENCE = np.load(Path(__file__).parent / 'data' / 'mel_reference.npz')
+SR = 16000
+TOLERANCE = 1e-4
+
+
+def assert_close(actual: np.ndarray, expected: np.ndarray):
+    assert actual.shape == expected.shape
+    assert np.abs(actual - expected).max() <= TOLERANCE * np.abs(expected).max()
+
+
+def test_filterbank():
+    fb = mel_filterbank(SR, 2048, 128, 0, 8000)
+    assert fb.dtype == np.float32
+    assert not fb[0].any()
+    assert_close(fb, REFERENCE['filterbank'])
+
+
+def test_spectrogram():
+    y = REFERENCE['y']
+    assert frame_count(len(y), 512) == len(REFERENCE['spectrogram'])
+    assert_close(spectrogram(y, 2048, 2048, 512), REFERENCE['spectrogram'])
+
+
+@pytest.mark.parametrize('block', [1, 3, 1024])
+def test_mel_spectrogram(monkeypatch, block: int):
+    # Frames are transformed in blocks, the result must not depend on the block size
+    monkeypatch.setattr('utils.mel.MEL_BLOCK_FRAMES', block)
+    mel = mel_spectrogram(REFERENCE['y'], SR, backend='numpy')
+    assert mel.dtype == np.float32
+    assert_close(mel, REFERENCE['mel'])
+
+
+def test_short_signal():
+    # Shorter than one frame: a single zero-padded frame
+    y = REFERENCE['y'][:300]
+    assert mel_spectrogram(y, SR, backend='numpy').shape == (1, 128)
+    assert mel_spectrogram(y[:0], SR, backend='numpy').shape == (0, 128)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        mel_spectrogram(REFERENCE['y'], SR, backend='librosa')
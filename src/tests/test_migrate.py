@@ -0,0 +1,67 @@
+import asyncio
+
+from tortoise import Tortoise
+
+from database.db import Worker
+from database.migrate import migrate
+from utils.approval import token_digest
+
+# Worker table as generate_schemas() created it before token digests and trust levels
+LEGACY_SCHEMA = '''
+CREATE TABLE worker (
+    id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    token VARCHAR(2048) NOT NULL,
+    approved INT NOT NULL DEFAULT 1,
+    trusted INT NOT NULL DEFAULT 0,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    nickname VARCHAR(255) NOT NULL DEFAULT ''
+)
+'''
+
+
+def run(tmp_path, body) -> None:
+    async def main():
+        await Tortoise.init(db_url=f'sqlite://{tmp_path / "db.sqlite3"}', modules={'models': ['database.db']})
+        try:
+            await body(Tortoise.get_connection('default'))
+        finally:
+            await Tortoise.close_connections()
+    asyncio.run(main())
+
+
+def test_migrate_legacy_workers(tmp_path):
+    async def body(conn):
+        await conn.execute_script(LEGACY_SCHEMA)
+        await conn.execute_script("INSERT INTO worker (token, approved, trusted) VALUES "
+                                  "('a', 1, 1), ('b', 1, 0), ('a', 0, 1), ('c', 1, 1)")
+        await migrate(conn)
+
+        workers = {w.token_digest: w for w in await Worker.all()}
+        assert set(workers) == {token_digest(t) for t in 'abc'}
+
+        # Duplicates of a token are merged, a ban of any of them is kept
+        a = workers[token_digest('a')]
+        assert (a.id, a.approved, a.trusted, a.trusted_level) == (1, False, True, 0)
+        assert workers[token_digest('c')].trusted
+
+        # Trust levels are saved, new workers are created by digest
+        a.trusted_level = 0.5
+        await a.save(update_fields=['trusted_level'])
+        await Worker.create(token_digest=token_digest('d'))
+        assert (await Worker.get(token_digest=token_digest('a'))).trusted_level == 0.5
+
+        # Running it again changes nothing
+        await migrate(conn)
+        assert await Worker.all().count() == 4
+
+    run(tmp_path, body)
+
+
+def test_migrate_new_database(tmp_path):
+    async def body(conn):
+        await Tortoise.generate_schemas()
+        await Worker.create(token_digest=token_digest('a'))
+        await migrate(conn)
+        assert await Worker.all().count() == 1
+
+    run(tmp_path, body)
@@ -0,0 +1,155 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import coordinator
+from coordinator import QueueFullError, WorkerPool
+from utils.models import ConnectedWorker, Task, TaskState
+
+
+def worker(name: str, speed: float = 1.0, max_tasks: int = 1) -> ConnectedWorker:
+    sent = []
+
+    async def send_bytes(data: bytes):
+        sent.append(data)
+
+    ws = SimpleNamespace(client=SimpleNamespace(host=name), send_bytes=send_bytes, sent=sent)
+    return ConnectedWorker(None, SimpleNamespace(id=name, trusted=False), ws, max_tasks, speed=speed)
+
+
+def pool_of(*workers: ConnectedWorker) -> WorkerPool:
+    pool = WorkerPool('test')
+    for w in workers:
+        pool.pool.append(w)
+        pool.slots.add(w)
+    return pool
+
+
+def task(id: str, duration: float = 10) -> TaskState:
+    return TaskState(Task(id, 'compute_audio', {}, duration, 0, None), asyncio.get_running_loop().create_future())
+
+
+def run(coro) -> None:
+    asyncio.run(coro)
+
+
+def test_expired_head_does_not_block_queue():
+    async def main():
+        w = worker('w')
+        pool = pool_of(w)
+        head, second = task('head'), task('second')
+        head.expired.add(w)
+        pool.enqueue(head)
+        pool.enqueue(second)
+
+        await pool.check_queue()
+        assert list(pool.running_tasks) == ['second']
+        assert list(pool.queued_tasks) == [head]
+
+        # The slot that no task could take is still free
+        assert w.running == 1 and len(pool.slots) == 0
+
+    run(main())
+
+
+def test_expired_head_goes_to_another_worker():
+    async def main():
+        fast, slow = worker('fast', speed=4), worker('slow')
+        pool = pool_of(fast, slow)
+        head, second = task('head'), task('second')
+        head.expired.add(fast)
+        pool.enqueue(head)
+        pool.enqueue(second)
+
+        await pool.check_queue()
+        assert not pool.queued_tasks
+        assert set(second.dispatches) == {fast} and set(head.dispatches) == {slow}
+
+    run(main())
+
+
+def test_passed_workers_are_released():
+    async def main():
+        w = worker('w', max_tasks=2)
+        pool = pool_of(w)
+        ts = task('t')
+        ts.expired.add(w)
+        pool.enqueue(ts)
+
+        await pool.check_queue()
+        assert w.running == 0 and len(pool.slots) == 1
+
+    run(main())
+
+
+def test_admit_ignores_resolved_tasks(monkeypatch):
+    async def main():
+        monkeypatch.setattr(coordinator, 'QUEUE_MAX_DEPTH', 3)
+        pool = pool_of(worker('w'))
+        queued = [task(str(i)) for i in range(3)]
+        for ts in queued:
+            pool.enqueue(ts)
+        with pytest.raises(QueueFullError):
+            pool.admit(0)
+
+        # Resolved behind the front of the queue, e.g. cancelled windows of a recording
+        queued[1].future.cancel()
+        queued[2].future.cancel()
+        pool.admit(0, 2)
+        assert list(pool.queued_tasks) == [queued[0]]
+
+    run(main())
+
+
+def test_deadline_requeues_then_fails(monkeypatch):
+    async def main():
+        monkeypatch.setattr(coordinator, 'SPECULATE_PERCENTILE', 0)
+        workers = [worker(f'w{i}') for i in range(coordinator.MAX_ATTEMPTS)]
+        pool = pool_of(*workers)
+        ts = task('t')
+        pool.enqueue(ts)
+
+        for attempt in range(1, coordinator.MAX_ATTEMPTS + 1):
+            await pool.check_queue()
+            assert ts.attempts == attempt and not pool.queued_tasks
+            w = next(iter(set(ts.dispatches) - ts.expired))
+
+            # Within the deadline, nothing happens
+            await pool.check_deadlines()
+            assert not pool.queued_tasks and w not in ts.expired
+
+            ts.dispatches[w] -= pool.deadline(ts.task) + 1
+            await pool.check_deadlines()
+            assert w in ts.expired
+
+            if attempt < coordinator.MAX_ATTEMPTS:
+                # Back at the front of the queue, never given to an expired worker again
+                assert pool.queued_tasks[0] is ts
+
+        assert isinstance(ts.future.exception(), asyncio.TimeoutError)
+        assert 't' not in pool.running_tasks
+
+    run(main())
+
+
+def test_retry_waits_for_other_dispatches():
+    async def main():
+        a, b = worker('a'), worker('b')
+        pool = pool_of(a, b)
+        ts = task('t')
+        now = time.monotonic()
+        ts.dispatches = {a: now, b: now}
+        ts.attempts = 2
+        ts.expired.add(a)
+
+        # b is still within its deadline
+        pool.retry(ts, 'Deadline exceeded')
+        assert not pool.queued_tasks and not ts.future.done()
+
+        ts.expired.add(b)
+        pool.retry(ts, 'Deadline exceeded')
+        assert pool.queued_tasks[0] is ts
+
+    run(main())
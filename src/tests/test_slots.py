@@ -0,0 +1,153 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from coordinator import SlotPool, WorkerPool
+from utils.models import ConnectedWorker, Task, TaskState
+
+loop = asyncio.new_event_loop()
+
+
+def worker(max_tasks: int = 2, speed: float = 1.0, rtt: float | None = None, trusted: bool = False) -> ConnectedWorker:
+    return ConnectedWorker(None, SimpleNamespace(id=id(object()), trusted=trusted), None, max_tasks, speed=speed,
+                           rtt=rtt)
+
+
+def queued(duration: float, queued_at: float | None = None) -> TaskState:
+    ts = TaskState(Task(str(duration), 'compute_audio', {}, duration, 0, None), loop.create_future())
+    ts.queued_at = time.monotonic() if queued_at is None else queued_at
+    return ts
+
+
+def test_fastest_then_least_loaded_then_closest():
+    slots = SlotPool()
+    slow = worker(speed=1)
+    fast, busy, far = worker(speed=4, rtt=0.01), worker(speed=4, rtt=0.1), worker(speed=4, rtt=0.2)
+    busy.running = 1
+    for w in (slow, far, busy, fast):
+        slots.add(w)
+
+    # Idle fast workers by distance, then the half-loaded ones by distance, the slow one last
+    assert [slots.acquire() for _ in range(7)] == [fast, far, fast, busy, far, slow, slow]
+    assert slots.acquire() is None and len(slots) == 0
+
+
+def test_speed_resolution():
+    # Speeds within one step of SPEED_RESOLUTION are equal, the least-loaded is picked
+    slots = SlotPool()
+    a, b = worker(speed=1.0), worker(speed=1.05)
+    b.running = 1
+    slots.add(a)
+    slots.add(b)
+    assert slots.acquire() is a
+
+
+def test_release_and_stale_entries():
+    slots = SlotPool()
+    a, b = worker(max_tasks=1), worker(max_tasks=1)
+    slots.add(a)
+    slots.add(b)
+    assert {slots.acquire(), slots.acquire()} == {a, b}
+    assert slots.acquire() is None
+
+    # Superseded entries are skipped, a released slot is handed out once
+    for _ in range(200):
+        slots.update(a)
+    slots.release(a)
+    slots.release(a)
+    assert a.running == 0 and len(slots) == 1
+    assert slots.acquire() is a
+    assert slots.acquire() is None
+
+    # The heaps are compacted instead of growing with every update
+    assert len(slots.heap) <= 4 * len(slots.entries) + 64
+
+
+def test_capacity_change():
+    slots = SlotPool()
+    a = worker(max_tasks=1)
+    slots.add(a)
+    assert slots.acquire() is a
+    a.max_tasks = 2
+    slots.update(a)
+    assert slots.acquire() is a
+    a.max_tasks = 1
+    slots.release(a)
+    assert slots.acquire() is None
+
+
+def test_exclude():
+    slots = SlotPool()
+    a, b = worker(speed=4), worker(speed=1)
+    slots.add(a)
+    slots.add(b)
+    assert slots.acquire(exclude={a}) is b
+    assert slots.acquire(exclude={a, b}) is None
+
+    # Skipped workers stay available
+    assert slots.acquire() is a
+    assert slots.acquire() is a
+    assert slots.acquire() is b
+    assert slots.acquire() is None
+
+
+def test_trusted_heap():
+    slots = SlotPool()
+    untrusted, trusted = worker(speed=4), worker(speed=1, trusted=True)
+    slots.add(untrusted)
+    slots.add(trusted)
+    assert slots.trusted_members == 1
+
+    assert slots.acquire(trusted=True) is trusted
+    assert slots.acquire() is untrusted
+    assert slots.acquire(trusted=True) is trusted
+    assert slots.acquire(trusted=True) is None
+    assert slots.acquire() is untrusted
+
+    slots.release(trusted)
+    slots.remove(trusted)
+    assert slots.trusted_members == 0
+    assert slots.acquire(trusted=True) is None
+
+
+def test_remove():
+    slots = SlotPool()
+    a, b = worker(), worker()
+    slots.add(a)
+    slots.add(b)
+    slots.remove(a)
+    slots.update(a)
+    assert slots.acquire() is b
+    assert slots.acquire() is b
+    assert slots.acquire() is None
+
+
+def test_place_largest_in_window():
+    pool = WorkerPool('test')
+    s = worker()
+    pool.queued_tasks.extend(queued(d) for d in (5, 30, 20, 60))
+    assert pool.place(s, 3) == 1
+    assert pool.place(s, 4) == 3
+    assert pool.place(s, 0) == 0
+
+    # Resolved tasks and tasks that expired on the worker are skipped, and don't count towards the window
+    pool.queued_tasks[1].future.cancel()
+    pool.queued_tasks[2].expired.add(s)
+    assert pool.place(s, 1) == 0
+    assert pool.place(s, 2) == 3
+
+
+def test_place_waits_for_faster_worker():
+    pool = WorkerPool('test')
+    slow, fast = worker(speed=1), worker(speed=10)
+    fast.running = fast.max_tasks
+    fast.finishes = {'x': time.monotonic() + 5}
+    pool.pool = [slow, fast]
+    pool.queued_tasks.extend([queued(600), queued(2)])
+
+    # The long task waits for the fast worker, the short one takes the slow slot
+    assert pool.place(slow, 2) == 1
+
+    # Unless it waited for long already
+    pool.queued_tasks[0].queued_at -= 1000
+    assert pool.place(slow, 2) == 0
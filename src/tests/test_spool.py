@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from utils.spool import AudioStore
+
+
+class Upload:
+    """Upload stream that fails after some chunks, like a client that disconnects"""
+
+    def __init__(self, chunks: list[bytes], fail: bool):
+        self.chunks = chunks
+        self.fail = fail
+
+    async def read(self, size: int) -> bytes:
+        if self.chunks:
+            return self.chunks.pop(0)
+        if self.fail:
+            raise ConnectionResetError('Client disconnected')
+        return b''
+
+
+def test_failed_upload_leaves_no_file(tmp_path):
+    store = AudioStore(tmp_path)
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(store.save(Upload([b'a' * 100, b'b' * 100], fail=True)))
+    assert not any(tmp_path.iterdir()) and not store.refs
+
+
+def test_identical_uploads_share_a_file(tmp_path):
+    store = AudioStore(tmp_path)
+    a = asyncio.run(store.save(Upload([b'not audio'], fail=False)))
+    b = asyncio.run(store.save(Upload([b'not audio'], fail=False)))
+    assert a.sha == b.sha and a.size == 9 and not a.probed
+    assert [f.name for f in tmp_path.iterdir()] == [a.sha] and store.refs[a.sha] == 2
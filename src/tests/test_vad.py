@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from utils.decode import Audio
+from utils.vad import place_rows, row_regions, speech_regions
+
+STEP = 0.01
+
+
+def analysis(y: np.ndarray, sr: int) -> np.ndarray:
+    """Stand-in for a frame-by-frame analysis: one row per step, holding the value at its start"""
+    return y[np.round(np.arange(int(len(y) / (STEP * sr))) * STEP * sr).astype(int)][:, None]
+
+
+@pytest.mark.parametrize('sr', [16000, 22050, 44100])
+def test_place_rows(sr):
+    # A signal whose value is its own time, so each row says where it was computed
+    samples = 5 * sr
+    t = np.arange(samples) / sr
+    regions = np.array([[int(0.512 * sr), int(1.3 * sr)], [int(2.001 * sr), int(3.5 * sr)], [int(4.2 * sr), samples]])
+
+    aligned = row_regions(regions, sr, STEP)
+    assert (aligned[:, 0] <= regions[:, 0]).all() and (regions[:, 0] - aligned[:, 0] < STEP * sr).all()
+
+    rows = place_rows([analysis(t[a:b], sr) for a, b in aligned], aligned, samples, sr, STEP)
+    assert len(rows) == round(samples / (STEP * sr))
+
+    # Every row computed on a region lands on the row of the whole recording at the same time
+    placed = ~np.isnan(rows[:, 0])
+    np.testing.assert_allclose(rows[placed, 0], np.flatnonzero(placed) * STEP, atol=1 / sr)
+
+    # Rows outside the regions stay empty
+    inside = np.zeros(len(rows), bool)
+    for a, b in aligned:
+        inside[round(a / (STEP * sr)): round(b / (STEP * sr))] = True
+    assert not placed[~inside].any()
+    assert placed[inside].mean() > 0.99
+
+
+def test_speech_regions():
+    sr = 16000
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal(6 * sr).astype(np.float32) * 1e-4
+    y[sr: 2 * sr] = rng.standard_normal(sr) * 0.3
+    y[4 * sr: 5 * sr] = rng.standard_normal(sr) * 0.3
+
+    regions = speech_regions(Audio(y, sr), 512)
+    assert len(regions) == 2
+    assert (regions[:, 0] % 512 == 0).all()
+    assert (regions[:, 0] <= [sr, 4 * sr]).all() and (regions[:, 1] >= [2 * sr, 5 * sr]).all()
@@ -0,0 +1,47 @@
+import json
+
+import numpy as np
+
+from utils.results import RawComputeResults
+from utils.verification import Tolerance, compare_results, segment_agreement
+
+# Segments as tasks.segment_batch returns them: (label, start, end, confidence)
+ML = [('noEnergy', 0.0, 0.5, None), ('female', 0.5, 3.0, 0.91), ('male', 3.0, 4.0, 0.67)]
+
+
+def result(ml: list, scale: float = 1) -> bytes:
+    freq = np.full((400, 4), 200 * scale, np.float32)
+    spec = np.ones((125, 128), np.float32) * scale
+    return RawComputeResults({'means': {'pitch': 200 * scale}}, freq, ml, spec, 16000, 4.0, {}).to_bdict()
+
+
+def test_segment_agreement():
+    assert segment_agreement(ML, ML) == 1
+    assert segment_agreement([], []) == 1
+
+    # Confidences don't matter, labels do
+    assert segment_agreement(ML, [(l, s, e, 0.5) for l, s, e, _ in ML]) == 1
+    assert segment_agreement(ML, [('male', 0.0, 4.0, 0.8)]) == 0.25
+
+
+def test_compare_results():
+    tol = Tolerance()
+    assert compare_results(result(ML), result(ML), tol) is None
+    assert compare_results(result(ML), result(ML, 1 + 1e-5), tol) is None
+    assert 'ml' in compare_results(result(ML), result([('male', 0.0, 4.0, 0.8)]), tol)
+    assert compare_results(result(ML), result(ML, 1.1), tol) is not None
+
+
+def test_compare_json_results():
+    tol = Tolerance()
+    a = json.dumps({'pitch': 0.8, 'f1': 0.6}).encode()
+    assert compare_results(a, json.dumps({'pitch': 0.8 + 1e-6, 'f1': 0.6}).encode(), tol, 'json') is None
+    assert compare_results(a, json.dumps({'pitch': 0.2, 'f1': 0.6}).encode(), tol, 'json') is not None
+
+
+def test_timings_not_in_result():
+    # Runs of the same task take different times, their results must still match
+    freq, spec = np.zeros((10, 4), np.float32), np.zeros((4, 128), np.float32)
+    a = RawComputeResults({}, freq, ML, spec, 16000, 0.1, {'decode': 0.101}).to_bdict()
+    b = RawComputeResults({}, freq, ML, spec, 16000, 0.1, {'decode': 0.12}).to_bdict()
+    assert compare_results(a, b, Tolerance()) is None
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import time
+from asyncio import Future
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+
+from database.db import Worker
+
+
+def token_digest(token: str) -> str:
+    """Fixed-size digest under which a worker token is stored and looked up"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+@dataclass()
+class ApprovalStats:
+    hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    invalidations: int = 0
+
+
+class ApprovalCache:
+    """
+    Worker rows by token digest, so that reconnecting workers don't need a database round trip.
+
+    Entries expire `ttl` seconds after they were loaded, so approval changes made directly in the
+    database take effect within that time; changes made by the coordinator call invalidate().
+    warm() loads the most recent workers in one query, which absorbs the reconnect storm after a
+    restart. Concurrent lookups of a missing digest share one query.
+    """
+    entries: OrderedDict[str, tuple[Worker, float]]
+    inflight: dict[str, Future]
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.stats = ApprovalStats()
+
+    def put(self, worker: Worker) -> None:
+        self.entries[worker.token_digest] = (worker, time.monotonic())
+        self.entries.move_to_end(worker.token_digest)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, digest: str | None = None) -> None:
+        """Drop one worker, or every worker if digest is None"""
+        self.stats.invalidations += 1
+        if digest is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(digest, None)
+
+    async def warm(self) -> int:
+        """
+        Load the most recently created workers
+
+        :return: Number of workers loaded
+        """
+        workers = await Worker.all().order_by('-id').limit(self.max_entries)
+        for w in reversed(workers):
+            self.put(w)
+        return len(workers)
+
+    async def get(self, digest: str) -> tuple[Worker, bool]:
+        """
+        Look up a worker by token digest, registering it if it is new
+
+        :return: (worker, whether it was created)
+        """
+        entry = self.entries.get(digest)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self.stats.hits += 1
+            return entry[0], False
+
+        future = self.inflight.get(digest)
+        if future is not None:
+            self.stats.coalesced += 1
+            worker, _ = await asyncio.shield(future)
+            return worker, False
+
+        self.stats.misses += 1
+        future = asyncio.ensure_future(Worker.get_or_create(token_digest=digest))
+        self.inflight[digest] = future
+        try:
+            worker, created = await asyncio.shield(future)
+        finally:
+            self.inflight.pop(digest, None)
+        self.put(worker)
+        return worker, created
+
+    def to_dict(self) -> dict:
+        return {**asdict(self.stats), 'entries': len(self.entries), 'ttl': self.ttl}
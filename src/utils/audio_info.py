@@ -0,0 +1,38 @@
+import wave
+from pathlib import Path
+
+# Bitrate assumed for compressed uploads when estimating their duration. Telegram voice notes are
+# opus at around 32 kbps, higher-bitrate files will be overestimated, which is the safe direction.
+ASSUMED_BITRATE = 32_000
+
+
+def probe_duration(file: Path) -> float | None:
+    """
+    Read the duration of an audio file from its header, without decoding it
+
+    :param file: Audio file
+    :return: Duration in seconds, or None if the format can't be probed
+    """
+    try:
+        with wave.open(str(file)) as w:
+            return w.getnframes() / w.getframerate()
+    except (wave.Error, EOFError):
+        pass
+
+    # FLAC, OGG and MP3 through libsndfile
+    try:
+        import soundfile
+        info = soundfile.info(str(file))
+    except (RuntimeError, ImportError):
+        return None
+    return info.frames / info.samplerate if info.samplerate else None
+
+
+def estimate_duration(size: int) -> float:
+    """
+    Estimate the duration of an audio file that can't be probed from its size
+
+    :param size: Size of the file in bytes
+    :return: Duration in seconds
+    """
+    return size * 8 / ASSUMED_BITRATE
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import itertools
+import pickle
+import queue
+import time
+import traceback
+from dataclasses import dataclass
+from multiprocessing.context import BaseContext
+from multiprocessing.queues import Queue
+from multiprocessing.synchronize import Event
+from typing import Any
+
+import psutil
+
+from utils import registry
+
+
+class BatchProcessDied(Exception):
+    """Raised in a task process when the batch process died while the task was waiting for it"""
+
+
+@dataclass()
+class Client:
+    """Connection of a task process to the batch process"""
+    requests: Queue
+    responses: Queue
+
+    # Index of this process' response queue, sent with every request
+    index: int
+
+    # Pid of the batch process
+    server: int
+
+
+# Connection of this process, set by connect() in task processes of a batching pool
+_client: Client | None = None
+_seq = itertools.count()
+
+
+def connect(requests: Queue, responses: list[Queue], slots: Queue, server: int) -> None:
+    """Initializer of the task processes: take a free response queue, then warm up the tasks"""
+    global _client
+    index = slots.get()
+    _client = Client(requests, responses[index], index, server)
+    registry.warm()
+
+
+def connected() -> bool:
+    """Whether this process hands the batched stage to a batch process"""
+    return _client is not None
+
+
+def submit(payload: Any) -> Any:
+    """
+    Add an input to the next batch, and wait for its output
+
+    :raises BatchProcessDied: If the batch process died
+    :raises Exception: The exception that the batched function returned for this input
+    """
+    seq = next(_seq)
+    _client.requests.put((_client.index, seq, payload))
+    while True:
+        try:
+            response_seq, output = _client.responses.get(timeout=1)
+        except queue.Empty:
+            if not psutil.pid_exists(_client.server):
+                raise BatchProcessDied('Batch process died')
+            continue
+
+        # Response to a request that this process gave up on
+        if response_seq != seq:
+            continue
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+
+def picklable(output: Any) -> Any:
+    """Replace an exception that can't be sent back by a generic one, so that its task doesn't hang"""
+    if not isinstance(output, Exception):
+        return output
+    try:
+        pickle.dumps(output)
+        return output
+    except Exception:
+        return RuntimeError(f'{type(output).__name__}: {output}')
+
+
+def serve(load: str, fn: str, requests: Queue, responses: list[Queue], ready: Event, size: int, window: float):
+    """
+    Main loop of the batch process: gather inputs of concurrent tasks into batches of up to `size`,
+    waiting at most `window` seconds after the first input, and run them together
+
+    :param load: Import path of a function that loads the model, called once
+    :param fn: Import path of the batched function, fn(model, inputs) returns one output or exception
+        per input
+    """
+    model = registry.load_target(load)()
+    batch = registry.load_target(fn)
+    ready.set()
+
+    while True:
+        items = [requests.get()]
+        deadline = time.monotonic() + window
+        while len(items) < size:
+            try:
+                items.append(requests.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+
+        inputs = [payload for _, _, payload in items]
+        try:
+            outputs = batch(model, inputs)
+        except Exception:
+            # Run the inputs one by one, so that one bad input only fails its own task
+            traceback.print_exc()
+            outputs = []
+            for payload in inputs:
+                try:
+                    outputs.append(batch(model, [payload])[0])
+                except Exception as e:
+                    outputs.append(e)
+
+        for (index, seq, _), output in zip(items, outputs):
+            responses[index].put((seq, picklable(output)))
+
+
+class BatchProcess:
+    """
+    Process that runs one stage of the tasks of a worker's task processes in batches.
+
+    Task processes send their inputs through a shared request queue, and each of them receives its
+    outputs through its own response queue, which it takes from `slots` when it starts.
+    """
+
+    def __init__(self, context: BaseContext, clients: int, load: str, fn: str, size: int, window: float):
+        self.requests = context.Queue()
+        self.responses = [context.Queue() for _ in range(clients)]
+        self.slots = context.Queue()
+        for i in range(clients):
+            self.slots.put(i)
+
+        self.ready = context.Event()
+        self.process = context.Process(target=serve, daemon=True, args=(
+            load, fn, self.requests, self.responses, self.ready, size, window))
+        self.process.start()
+
+    def initargs(self) -> tuple:
+        """Arguments of connect() for the task processes"""
+        return self.requests, self.responses, self.slots, self.process.pid
+
+    def wait(self) -> None:
+        """Block until the model is loaded"""
+        while not self.ready.wait(1):
+            if not self.process.is_alive():
+                raise BatchProcessDied(f'Batch process exited with code {self.process.exitcode}')
+
+    def stop(self) -> None:
+        self.process.kill()
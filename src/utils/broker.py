@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+# Nodes that haven't sent a heartbeat for this many seconds are not counted in the fleet
+NODE_TIMEOUT = 10
+
+
+@dataclass()
+class Offer:
+    """A task that a coordinator could not dispatch to its own workers"""
+    id: str
+    origin: str
+
+    # Task.to_header() of the task
+    header: list
+
+
+@dataclass()
+class RemoteResult:
+    id: str
+    result: bytes | None
+
+    # (exception class name, message) if the task failed
+    error: tuple[str, str] | None
+
+
+class Broker(ABC):
+    """
+    Shared queue and result routing between coordinator instances (nodes).
+
+    Each node only holds the websockets of its own workers. Tasks that a node cannot dispatch
+    locally are offered to the broker, any node with idle workers may claim them, and the result
+    is routed back to the node that holds the request (the origin). A task is dispatched by exactly
+    one node: the origin claims its own offers before dispatching them, too.
+    """
+
+    @abstractmethod
+    async def submit(self, origin: str, id: str, header: list, audio: Path | None) -> None:
+        """Offer a task to other nodes, `audio` is the spooled file of the task"""
+
+    @abstractmethod
+    async def claim(self, id: str, node: str) -> bool:
+        """
+        Claim an offered task for dispatch
+
+        :return: False if another node already claimed it
+        """
+
+    @abstractmethod
+    async def claim_next(self, node: str, n: int) -> list[Offer]:
+        """Claim up to n of the oldest unclaimed tasks offered by other nodes"""
+
+    @abstractmethod
+    async def fetch_audio(self, id: str, dest: Path) -> None:
+        """Write the audio of a claimed task to dest"""
+
+    @abstractmethod
+    async def withdraw(self, id: str) -> None:
+        """Remove an offer and its audio, after the origin got a result or gave up"""
+
+    @abstractmethod
+    async def publish_result(self, origin: str, result: RemoteResult) -> None:
+        """Send the result of a claimed task to its origin"""
+
+    @abstractmethod
+    async def poll_results(self, node: str) -> list[RemoteResult]:
+        """Take the results routed to a node"""
+
+    @abstractmethod
+    async def heartbeat(self, node: str, workers: int) -> int:
+        """
+        Report the number of workers connected to a node
+
+        :return: Number of workers connected to all live nodes
+        """
+
+
+def link_or_copy(src: Path, dest: Path) -> None:
+    """
+    Make a spooled file available at dest without reading it into memory: hard link it, spooled
+    files are never modified, or copy it if it is on another file system
+    """
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class InProcessBroker(Broker):
+    """Broker for nodes in one process. With a single node, no offer is ever claimed remotely."""
+    offers: OrderedDict[str, tuple[Offer, Path | None, str | None]]
+    results: dict[str, list[RemoteResult]]
+    nodes: dict[str, tuple[int, float]]
+
+    def __init__(self):
+        self.offers = OrderedDict()
+        self.results = {}
+        self.nodes = {}
+
+    async def submit(self, origin: str, id: str, header: list, audio: Path | None) -> None:
+        self.offers[id] = (Offer(id, origin, header), audio, None)
+
+    async def claim(self, id: str, node: str) -> bool:
+        if id not in self.offers:
+            return True
+        offer, audio, claimed = self.offers[id]
+        if claimed is not None:
+            return claimed == node
+        self.offers[id] = (offer, audio, node)
+        return True
+
+    async def claim_next(self, node: str, n: int) -> list[Offer]:
+        claimed = []
+        for id, (offer, audio, by) in self.offers.items():
+            if len(claimed) >= n:
+                break
+            if by is None and offer.origin != node:
+                self.offers[id] = (offer, audio, node)
+                claimed.append(offer)
+        return claimed
+
+    async def fetch_audio(self, id: str, dest: Path) -> None:
+        _, audio, _ = self.offers[id]
+        if audio != dest:
+            await asyncio.to_thread(link_or_copy, audio, dest)
+
+    async def withdraw(self, id: str) -> None:
+        self.offers.pop(id, None)
+
+    async def publish_result(self, origin: str, result: RemoteResult) -> None:
+        self.results.setdefault(origin, []).append(result)
+
+    async def poll_results(self, node: str) -> list[RemoteResult]:
+        return self.results.pop(node, [])
+
+    async def heartbeat(self, node: str, workers: int) -> int:
+        now = time.monotonic()
+        self.nodes[node] = (workers, now)
+        return sum(w for w, t in self.nodes.values() if now - t < NODE_TIMEOUT)
+
+
+class SqliteBroker(Broker):
+    """
+    Broker in an SQLite database, for coordinator processes on one host (e.g. uvicorn --workers).
+
+    Claims are atomic because every operation runs in its own IMMEDIATE transaction. Offers only
+    hold the path of the spooled audio, nodes read it from the spool of the origin, which keeps the
+    file until the task is resolved or withdrawn.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS offers (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT UNIQUE NOT NULL,
+            origin TEXT NOT NULL,
+            header TEXT NOT NULL,
+            audio TEXT,
+            claimed_by TEXT
+        );
+        CREATE INDEX IF NOT EXISTS offers_unclaimed ON offers (claimed_by, seq);
+        CREATE TABLE IF NOT EXISTS results (
+            id TEXT PRIMARY KEY,
+            origin TEXT NOT NULL,
+            result BLOB,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS results_origin ON results (origin);
+        CREATE TABLE IF NOT EXISTS nodes (
+            node TEXT PRIMARY KEY,
+            workers INTEGER NOT NULL,
+            updated REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+
+    def transaction(self, fn, *args):
+        """Run fn(cursor, *args) in an IMMEDIATE transaction"""
+        with self.lock:
+            cur = self.db.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                r = fn(cur, *args)
+                cur.execute('COMMIT')
+                return r
+            except BaseException:
+                cur.execute('ROLLBACK')
+                raise
+
+    async def run(self, fn, *args):
+        return await asyncio.to_thread(self.transaction, fn, *args)
+
+    async def submit(self, origin: str, id: str, header: list, audio: Path | None) -> None:
+        path = str(audio.resolve()) if audio else None
+        await self.run(lambda c: c.execute('INSERT OR IGNORE INTO offers (id, origin, header, audio) VALUES (?, ?, ?, ?)',
+                                           (id, origin, json.dumps(header), path)))
+
+    async def claim(self, id: str, node: str) -> bool:
+        def claim(c: sqlite3.Cursor) -> bool:
+            row = c.execute('SELECT claimed_by FROM offers WHERE id = ?', (id,)).fetchone()
+            if row is None:
+                return True
+            if row[0] is not None:
+                return row[0] == node
+            c.execute('UPDATE offers SET claimed_by = ? WHERE id = ?', (node, id))
+            return True
+        return await self.run(claim)
+
+    async def claim_next(self, node: str, n: int) -> list[Offer]:
+        def claim_next(c: sqlite3.Cursor) -> list[Offer]:
+            rows = c.execute('SELECT id, origin, header FROM offers WHERE claimed_by IS NULL AND origin != ? '
+                             'ORDER BY seq LIMIT ?', (node, n)).fetchall()
+            c.executemany('UPDATE offers SET claimed_by = ? WHERE id = ?', [(node, r[0]) for r in rows])
+            return [Offer(id, origin, json.loads(header)) for id, origin, header in rows]
+        return await self.run(claim_next)
+
+    async def fetch_audio(self, id: str, dest: Path) -> None:
+        row = await self.run(lambda c: c.execute('SELECT audio FROM offers WHERE id = ?', (id,)).fetchone())
+        if row is None or row[0] is None:
+            raise FileNotFoundError(f'Audio of task {id} is not in the broker')
+        await asyncio.to_thread(link_or_copy, Path(row[0]), dest)
+
+    async def withdraw(self, id: str) -> None:
+        await self.run(lambda c: c.execute('DELETE FROM offers WHERE id = ?', (id,)))
+
+    async def publish_result(self, origin: str, result: RemoteResult) -> None:
+        error = json.dumps(result.error) if result.error else None
+        await self.run(lambda c: c.execute('INSERT OR REPLACE INTO results (id, origin, result, error) VALUES (?, ?, ?, ?)',
+                                           (result.id, origin, result.result, error)))
+
+    async def poll_results(self, node: str) -> list[RemoteResult]:
+        def poll(c: sqlite3.Cursor) -> list[RemoteResult]:
+            rows = c.execute('SELECT id, result, error FROM results WHERE origin = ?', (node,)).fetchall()
+            c.execute('DELETE FROM results WHERE origin = ?', (node,))
+            return [RemoteResult(id, result, tuple(json.loads(error)) if error else None) for id, result, error in rows]
+        return await self.run(poll)
+
+    async def heartbeat(self, node: str, workers: int) -> int:
+        def heartbeat(c: sqlite3.Cursor) -> int:
+            now = time.time()
+            c.execute('INSERT OR REPLACE INTO nodes (node, workers, updated) VALUES (?, ?, ?)', (node, workers, now))
+            return c.execute('SELECT COALESCE(SUM(workers), 0) FROM nodes WHERE updated > ?',
+                             (now - NODE_TIMEOUT,)).fetchone()[0]
+        return await self.run(heartbeat)
+
+
+def connect_broker(url: str | None) -> Broker:
+    """
+    Create a broker from a url
+
+    :param url: None for an in-process broker, or sqlite:///path/to/broker.db
+    """
+    if not url:
+        return InProcessBroker()
+    if url.startswith('sqlite:///'):
+        return SqliteBroker(Path(url[len('sqlite:///'):]))
+    raise ValueError(f'Unsupported broker url {url}')
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+from asyncio import Future
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable
+
+import aiofiles
+
+from utils import registry
+
+
+def cache_key(file_sha: str, fn: str, options: dict) -> str:
+    """
+    Content address of a computation: the uploaded file, the task and its options
+
+    :param file_sha: SHA-256 hex digest of the uploaded file
+    :param fn: Registered task name, its version is part of the key
+    :param options: Options that change the result
+    :return: Hex digest
+    """
+    h = hashlib.sha256(file_sha.encode())
+    h.update(json.dumps({'fn': fn, 'version': registry.TASKS[fn].version, **options}, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+@dataclass()
+class CacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    coalesced: int = 0
+    memory_evictions: int = 0
+    disk_evictions: int = 0
+
+
+class ResultCache:
+    """
+    Size-bounded LRU of result bodies keyed by cache_key(), with an optional disk tier.
+
+    Memory entries are evicted least recently used first once their total size exceeds
+    `memory_bytes`. If `disk_path` is set, results are also written there and evicted the same
+    way once the directory exceeds `disk_bytes`, and disk hits are promoted back to memory.
+
+    Concurrent requests for a key that is being computed share one computation (single-flight).
+    """
+    memory: OrderedDict[str, bytes | memoryview]
+    disk: OrderedDict[str, int]
+    inflight: dict[str, Future]
+
+    def __init__(self, memory_bytes: int, disk_path: Path | None = None, disk_bytes: int = 0):
+        self.memory = OrderedDict()
+        self.memory_bytes = memory_bytes
+        self.memory_used = 0
+
+        self.disk = OrderedDict()
+        self.disk_path = disk_path
+        self.disk_bytes = disk_bytes
+        self.disk_used = 0
+
+        self.inflight = {}
+        self.stats = CacheStats()
+
+        # Index existing disk entries, oldest first
+        if disk_path:
+            disk_path.mkdir(parents=True, exist_ok=True)
+            for f in sorted(disk_path.glob('*.bdct'), key=os.path.getmtime):
+                size = f.stat().st_size
+                self.disk[f.stem] = size
+                self.disk_used += size
+
+    def put_memory(self, key: str, value: bytes | memoryview) -> None:
+        if len(value) > self.memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_used -= len(self.memory.pop(key))
+
+        self.memory[key] = value
+        self.memory_used += len(value)
+        while self.memory_used > self.memory_bytes:
+            _, v = self.memory.popitem(last=False)
+            self.memory_used -= len(v)
+            self.stats.memory_evictions += 1
+
+    async def put(self, key: str, value: bytes | memoryview) -> None:
+        """Store a result in memory and, if enabled, on disk"""
+        self.put_memory(key, value)
+        await self.put_disk(key, value)
+
+    async def put_disk(self, key: str, value: bytes | memoryview) -> None:
+        if not self.disk_path or key in self.disk or len(value) > self.disk_bytes:
+            return
+
+        # Write to a temporary file first so that readers never see a partial result
+        tmp = self.disk_path / f'{key}.part'
+        async with aiofiles.open(tmp, 'wb') as f:
+            await f.write(value)
+        os.replace(tmp, self.disk_path / f'{key}.bdct')
+        self.disk[key] = len(value)
+        self.disk_used += len(value)
+
+        while self.disk_used > self.disk_bytes:
+            k, size = self.disk.popitem(last=False)
+            self.disk_used -= size
+            self.stats.disk_evictions += 1
+            (self.disk_path / f'{k}.bdct').unlink(missing_ok=True)
+
+    def invalidate(self, key: str) -> None:
+        """Drop a result from both tiers"""
+        if key in self.memory:
+            self.memory_used -= len(self.memory.pop(key))
+        if key in self.disk:
+            self.disk_used -= self.disk.pop(key)
+            (self.disk_path / f'{key}.bdct').unlink(missing_ok=True)
+
+    async def get(self, key: str) -> bytes | memoryview | None:
+        """Look up a result, or None on a miss"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats.hits += 1
+            return self.memory[key]
+
+        if key in self.disk:
+            try:
+                async with aiofiles.open(self.disk_path / f'{key}.bdct', 'rb') as f:
+                    value = await f.read()
+            except FileNotFoundError:
+                self.disk_used -= self.disk.pop(key)
+            else:
+                self.disk.move_to_end(key)
+                self.put_memory(key, value)
+                self.stats.hits += 1
+                self.stats.disk_hits += 1
+                return value
+
+        self.stats.misses += 1
+        return None
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Future]) -> bytes | memoryview:
+        """
+        Return a cached result, join a running computation of the same key, or start a new one
+
+        :param key: Cache key
+        :param compute: Function that starts the computation and returns its future
+        :return: Result
+        """
+        hit = await self.get(key)
+        if hit is not None:
+            return hit
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.stats.coalesced += 1
+        else:
+            future = compute()
+            self.inflight[key] = future
+
+            def done(f: Future):
+                self.inflight.pop(key, None)
+                if not f.cancelled() and f.exception() is None:
+                    self.put_memory(key, f.result())
+                    asyncio.create_task(self.put_disk(key, f.result()))
+
+            future.add_done_callback(done)
+
+        # Shield the shared future so that one cancelled request doesn't cancel the others
+        return await asyncio.shield(future)
+
+    def to_dict(self) -> dict:
+        return {**asdict(self.stats), 'memory_entries': len(self.memory), 'memory_used': self.memory_used,
+                'disk_entries': len(self.disk), 'disk_used': self.disk_used}
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import io
+import itertools
+import math
+import os
+from dataclasses import dataclass, asdict, replace
+from math import gcd
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from utils.decode import Audio, AudioStream, mono
+from utils.results import FEATURE_COMPONENTS, RawComputeResults
+
+# Recordings longer than CHUNK_THRESHOLD seconds are analyzed in windows of CHUNK_SECONDS, each read
+# with CHUNK_OVERLAP seconds of context on both sides that is cut off when the results are stitched.
+# The coordinator sends the windows of uploads that are longer, by the duration in their header, to
+# workers as separate tasks, each with only the audio of its window (see segment()).
+CHUNK_THRESHOLD = float(os.environ.get('CHUNK_THRESHOLD', 900))
+CHUNK_SECONDS = float(os.environ.get('CHUNK_SECONDS', 300))
+CHUNK_OVERLAP = float(os.environ.get('CHUNK_OVERLAP', 5))
+
+# Seconds per row of freq_array (sgs_config.time_step), and per bin of the Segmenter
+FREQ_STEP = 0.01
+SEGMENT_STEP = 0.02
+
+
+@dataclass(frozen=True)
+class Window:
+    """Part of a recording that is analyzed on its own, in seconds"""
+    start: float
+
+    # End of the part, None for the rest of the recording
+    stop: float | None
+
+    overlap: float = CHUNK_OVERLAP
+
+    def to_params(self) -> dict:
+        return asdict(self)
+
+
+@dataclass(frozen=True)
+class Span:
+    """A window in samples: the audio read from `start`, and the part of it that is kept"""
+    start: int
+
+    # Samples of context before the kept part
+    lead: int
+
+    # Kept samples, and samples of context after them
+    keep: int
+    trail: int
+
+    # Whether the kept part runs to the end of the recording
+    last: bool = False
+
+
+def plan(duration: float, seconds: float = CHUNK_SECONDS, overlap: float = CHUNK_OVERLAP) -> list[Window]:
+    """
+    Split a recording into windows. The last window runs to the end of the recording, so an
+    estimated duration that is too short doesn't lose audio.
+
+    :param duration: Estimated duration in seconds
+    """
+    n = max(int(duration / seconds + 0.5), 1)
+    return [Window(i * seconds, (i + 1) * seconds if i < n - 1 else None, overlap) for i in range(n)]
+
+
+def grid(sr: int, stride: int) -> int:
+    """
+    Samples that window boundaries are aligned to: a multiple of the spectrogram stride, the
+    freq_array step and the Segmenter bins, so that the frames of a window are exactly frames of the
+    whole recording
+    """
+    step = sr // gcd(sr, round(1 / SEGMENT_STEP))
+    return stride * step // gcd(stride, step)
+
+
+def span(w: Window, sr: int, stride: int) -> Span:
+    """Samples of a window, with boundaries aligned to grid() that neighbouring windows agree on"""
+    g = grid(sr, stride)
+    start = int(w.start * sr) // g * g
+    context = math.ceil(w.overlap * sr / g) * g
+    lead = min(context, start)
+    if w.stop is None:
+        return Span(start - lead, lead, 0, 0, True)
+    return Span(start - lead, lead, int(w.stop * sr) // g * g - start, context)
+
+
+def read_span(stream: AudioStream, s: Span, offset: int = 0) -> tuple[Audio, Span]:
+    """
+    Read the audio of a window from the start of a stream
+
+    :param offset: Sample of the recording that the stream starts at, for a segment() of it
+    :return: Audio, and the span with the kept part cut to the end of the recording if it ends early
+    """
+    if stream.skip(s.start - offset) < s.start - offset:
+        return Audio(np.zeros(0, np.float32), stream.sr), replace(s, lead=0, keep=0, trail=0, last=True)
+    return fit(Audio(stream.read(-1 if s.last else s.lead + s.keep + s.trail), stream.sr), s)
+
+
+def segment(file: Path, w: Window, stride: int) -> tuple[bytes, int]:
+    """
+    Cut the audio of a window out of a recording, so that the task of the window doesn't need the
+    whole file. Only the window is decoded, the recording is seeked to its start.
+
+    The samples are stored as 24-bit FLAC, which keeps 16 and 24-bit sources exact and float sources
+    within 2^-23 of the decoded value.
+
+    :param file: Recording in a format of libsndfile that can be seeked
+    :param w: Window
+    :param stride: Spectrogram stride
+    :return: FLAC file of the window, and the sample of the recording that it starts at
+    :raises RuntimeError: If the recording can't be cut
+    """
+    import soundfile
+
+    with soundfile.SoundFile(str(file)) as f:
+        if not f.seekable():
+            raise RuntimeError(f'{f.format} can\'t be seeked')
+        s = span(w, f.samplerate, stride)
+        f.seek(min(s.start, f.frames))
+        y = mono(f.read(-1 if s.last else s.lead + s.keep + s.trail, dtype='float32', always_2d=True))
+
+    out = io.BytesIO()
+    soundfile.write(out, np.clip(y, -1, 1), f.samplerate, format='FLAC', subtype='PCM_24')
+    return out.getvalue(), s.start
+
+
+def fit(audio: Audio, s: Span) -> tuple[Audio, Span]:
+    """Adjust a span to the audio that was read for it, which is shorter at the end of the recording"""
+    n = len(audio.y)
+    if s.last or n <= s.lead + s.keep:
+        return audio, replace(s, lead=min(s.lead, n), keep=max(n - s.lead, 0), trail=0, last=True)
+    return audio, replace(s, trail=n - s.lead - s.keep)
+
+
+def windows(stream: AudioStream, stride: int, head: np.ndarray | None = None,
+            seconds: float = CHUNK_SECONDS, overlap: float = CHUNK_OVERLAP) -> Iterator[tuple[Audio, Span]]:
+    """
+    Read consecutive windows of a stream. Only the current window is in memory, the context it
+    shares with the previous window is kept instead of being decoded again.
+
+    :param head: Samples already read from the stream
+    """
+    buf, pos = (np.zeros(0, np.float32) if head is None else head), 0
+    for i in itertools.count():
+        s = span(Window(i * seconds, (i + 1) * seconds, overlap), stream.sr, stride)
+        buf, pos = buf[s.start - pos:], s.start
+
+        need = s.lead + s.keep + s.trail
+        if len(buf) < need:
+            buf = np.concatenate([buf, stream.read(need - len(buf))])
+
+        audio, s = fit(Audio(buf, stream.sr), s)
+        yield audio, s
+        if s.last:
+            return
+
+
+def cut(r: RawComputeResults, s: Span, stride: int) -> RawComputeResults:
+    """
+    Cut the results of a window to its kept part, in the time of the whole recording
+
+    :param r: Results of the audio read for the window
+    :param s: Span of the window
+    :param stride: Spectrogram stride
+    """
+    to_rows = round(1 / FREQ_STEP) / r.sr
+    lead, keep = round(s.lead * to_rows), round(s.keep * to_rows)
+    freq = r.freq_array[lead:None if s.last else lead + keep]
+
+    # Praat leaves no rows for windows without voice, which would shift the windows after them
+    if not s.last and len(freq) < keep and set(FEATURE_COMPONENTS) & set(r.components):
+        freq = np.concatenate([freq, np.full((keep - len(freq), 4), np.nan, np.float32)])
+
+    spec = r.mel_spectrogram[s.lead // stride:None if s.last else (s.lead + s.keep) // stride]
+
+    offset = s.start / r.sr
+    lo, hi = (s.start + s.lead) / r.sr, math.inf if s.last else (s.start + s.lead + s.keep) / r.sr
+    ml = [(label, max(start + offset, lo), min(stop + offset, hi), *rest) for label, start, stop, *rest in r.ml
+          if start + offset < hi and stop + offset > lo]
+
+    return r._replace(freq_array=freq, ml=ml, mel_spectrogram=spec, audio_dur=s.keep / r.sr)
+
+
+def merge_segments(ml: list) -> list:
+    """Join consecutive segments of the same label that a window boundary split"""
+    out = []
+    for seg in ml:
+        label, start, stop, *rest = seg
+        if out and out[-1][0] == label and abs(out[-1][2] - start) < 1e-6:
+            prev = out.pop()
+            conf = rest[0] if rest else None
+            if conf is not None and prev[3] is not None:
+                a, b = prev[2] - prev[1], stop - start
+                conf = (prev[3] * a + conf * b) / (a + b) if a + b > 0 else conf
+            seg = (label, prev[1], stop, conf)
+        out.append(tuple(seg))
+    return out
+
+
+def feature_means(freq: np.ndarray, tilts: list[tuple[float, float]]) -> dict[str, float]:
+    """
+    Feature means of a recording that was analyzed in parts, like sgs.api.calculate_feature_means
+
+    :param freq: Frequency array of the whole recording
+    :param tilts: Spectral tilt and duration of each part
+    """
+    means = {k: float(np.nanmean(freq[:, i])) for i, k in enumerate(('pitch', 'f1', 'f2', 'f3'))
+             if np.isfinite(freq[:, i]).any()}
+    if tilts and sum(d for _, d in tilts) > 0:
+        means['tilt'] = float(sum(t * d for t, d in tilts) / sum(d for _, d in tilts))
+    return means
+
+
+def stitch(parts: list[RawComputeResults]) -> RawComputeResults:
+    """
+    Join the cut results of consecutive windows.
+
+    The means of pitch and formants are recomputed over the whole recording, spectral tilt is the
+    duration-weighted mean of the windows. The result only has 'means', 'fem_prob' is classified from
+    them afterwards (see tasks.classify_features).
+    """
+    kept = [p for p in parts if p.audio_dur > 0] or parts[:1]
+    freq = np.concatenate([p.freq_array for p in kept])
+    spec = np.concatenate([p.mel_spectrogram for p in kept if len(p.mel_spectrogram)] or [np.zeros((0, 0), np.float32)])
+
+    tilts = [(p.result['means']['tilt'], p.audio_dur) for p in kept
+             if p.result.get('means', {}).get('tilt') is not None]
+
+    ml = merge_segments([seg for p in kept for seg in p.ml])
+    return RawComputeResults({'means': feature_means(freq, tilts)}, freq, ml, spec, kept[0].sr,
+                             sum(p.audio_dur for p in parts), {}, kept[0].components)
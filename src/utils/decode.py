@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import io
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from math import gcd
+from typing import NamedTuple
+
+import numpy as np
+
+# Frames decoded at a time when skipping audio that can't be seeked
+SKIP_BLOCK = 1 << 20
+
+
+class Audio(NamedTuple):
+    """Decoded audio, mono float32 PCM in [-1, 1]"""
+    y: np.ndarray
+    sr: int
+
+    @property
+    def duration(self) -> float:
+        return len(self.y) / self.sr
+
+    def resample(self, sr: int) -> Audio:
+        """Resample to another sample rate, returns self if it's already at that rate"""
+        if sr == self.sr:
+            return self
+        import scipy.signal
+
+        g = gcd(sr, self.sr)
+        return Audio(scipy.signal.resample_poly(self.y, sr // g, self.sr // g).astype(np.float32), sr)
+
+
+def mono(y: np.ndarray) -> np.ndarray:
+    """Average the channels of (frames, channels) audio"""
+    return y.mean(axis=1, dtype=np.float32) if y.shape[1] > 1 else y[:, 0]
+
+
+class AudioStream(ABC):
+    """Decoded audio of a file, read front to back without holding all of it"""
+    sr: int
+
+    @abstractmethod
+    def read(self, frames: int = -1) -> np.ndarray:
+        """
+        Read the next frames, fewer at the end of the stream
+
+        :param frames: Number of frames, -1 for the rest of the stream
+        :return: Mono float32 PCM
+        """
+
+    def skip(self, frames: int) -> int:
+        """Skip frames, returns how many were skipped (fewer at the end of the stream)"""
+        skipped = 0
+        while skipped < frames:
+            n = len(self.read(min(frames - skipped, SKIP_BLOCK)))
+            if n == 0:
+                break
+            skipped += n
+        return skipped
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> AudioStream:
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class ArrayStream(AudioStream):
+    """Stream over audio that is already decoded"""
+
+    def __init__(self, audio: Audio):
+        self.y, self.sr = audio
+        self.pos = 0
+
+    def read(self, frames: int = -1) -> np.ndarray:
+        end = len(self.y) if frames < 0 else self.pos + frames
+        y = self.y[self.pos:end]
+        self.pos += len(y)
+        return y
+
+    def skip(self, frames: int) -> int:
+        n = min(frames, len(self.y) - self.pos)
+        self.pos += n
+        return n
+
+
+class SoundFileStream(AudioStream):
+    """Decode a format of libsndfile in process"""
+
+    def __init__(self, file: bytes):
+        import soundfile
+
+        self.f = soundfile.SoundFile(io.BytesIO(file))
+        self.sr = self.f.samplerate
+
+    def read(self, frames: int = -1) -> np.ndarray:
+        return mono(self.f.read(frames, dtype='float32', always_2d=True))
+
+    def skip(self, frames: int) -> int:
+        if not self.f.seekable():
+            return super().skip(frames)
+        pos = self.f.tell()
+        target = min(pos + frames, self.f.frames)
+        self.f.seek(target)
+        return target - pos
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class FfmpegStream(AudioStream):
+    """
+    Decode with ffmpeg to float32 WAV on a pipe, at the original sample rate.
+
+    ffmpeg can't seek back to fill in the chunk sizes of a pipe, so the data chunk is read to the end
+    of the stream regardless of its size.
+    """
+
+    def __init__(self, source: str, file: bytes | None = None, remove: bool = False):
+        """
+        :param source: Input of ffmpeg, 'pipe:0' to read `file` from stdin
+        :param remove: Delete the `source` file when the stream is closed
+        """
+        from inaSpeechSegmenter.constants import ina_config
+
+        self.source = source if remove else None
+        args = [ina_config.ffmpeg, '-v', 'error', '-i', source, '-ac', '1', '-c:a', 'pcm_f32le', '-f', 'wav', 'pipe:1']
+        self.p = subprocess.Popen(args, stdin=subprocess.DEVNULL if file is None else subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # Feed the input and drain the errors from threads, ffmpeg blocks on a full pipe otherwise
+        if file is not None:
+            threading.Thread(target=self.feed, args=(file,), daemon=True).start()
+        self.stderr = b''
+        self.drainer = threading.Thread(target=self.drain, daemon=True)
+        self.drainer.start()
+
+        try:
+            self.channels, self.sr = self.read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def feed(self, file: bytes) -> None:
+        try:
+            self.p.stdin.write(file)
+            self.p.stdin.close()
+        except OSError:
+            # ffmpeg exited without reading everything
+            pass
+
+    def drain(self) -> None:
+        for line in self.p.stderr:
+            self.stderr = (self.stderr + line)[-4096:]
+
+    def error(self) -> ValueError:
+        self.p.wait()
+        self.drainer.join(1)
+        return ValueError(f'ffmpeg failed to decode the file: {self.stderr.decode(errors="replace").strip()}')
+
+    def read_exactly(self, n: int) -> bytes:
+        data = self.p.stdout.read(n)
+        if len(data) < n:
+            raise self.error()
+        return data
+
+    def read_header(self) -> tuple[int, int]:
+        """Read the WAV header up to the data chunk, returns (channels, sample rate)"""
+        riff = self.read_exactly(12)
+        if riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError('ffmpeg output is not a WAV stream')
+
+        channels, sr = 1, 0
+        while True:
+            chunk, size = struct.unpack('<4sI', self.read_exactly(8))
+            if chunk == b'data':
+                return channels, sr
+            body = self.read_exactly(size + (size & 1))
+            if chunk == b'fmt ':
+                channels, sr = struct.unpack_from('<HI', body, 2)
+
+    def read(self, frames: int = -1) -> np.ndarray:
+        width = 4 * self.channels
+        data = self.p.stdout.read(-1 if frames < 0 else frames * width)
+        if frames < 0 or len(data) < frames * width:
+            # End of the stream, make sure that it's not because ffmpeg failed
+            if self.p.wait() != 0:
+                raise self.error()
+        y = np.frombuffer(data, '<f4', len(data) // width * self.channels)
+        return mono(y.reshape(-1, self.channels))
+
+    def close(self) -> None:
+        if self.p.poll() is None:
+            self.p.kill()
+        self.p.wait()
+        self.p.stdout.close()
+        if self.source:
+            os.remove(self.source)
+            self.source = None
+
+
+def open_audio(file: bytes | Audio) -> AudioStream:
+    """
+    Open an uploaded file for decoding in memory.
+
+    Formats that libsndfile reads (WAV, FLAC, OGG Vorbis/Opus, MP3 on recent versions) are decoded
+    in process. Other containers go through a single ffmpeg pipe. MP4/M4A files that keep their index
+    at the end can't be demuxed from a pipe, ffmpeg reads those from a temporary file that is removed
+    when the stream is closed.
+
+    :param file: File content, or audio that is already decoded
+    :return: Stream, close it after use
+    """
+    if isinstance(file, Audio):
+        return ArrayStream(file)
+
+    try:
+        return SoundFileStream(file)
+    except (RuntimeError, ImportError):
+        # Not a format of libsndfile, or soundfile is not installed
+        pass
+
+    try:
+        return FfmpegStream('pipe:0', file)
+    except ValueError:
+        fd, path = tempfile.mkstemp(prefix='decode-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(file)
+        try:
+            return FfmpegStream(path, remove=True)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+
+def decode(file: bytes) -> Audio:
+    """
+    Decode a whole uploaded file in memory, see open_audio()
+
+    :param file: File content
+    :return: Decoded audio
+    """
+    with open_audio(file) as stream:
+        return Audio(stream.read(), stream.sr)
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+
+@dataclass()
+class LimitChange:
+    time: float
+    limit: int
+    latency: float
+    throughput: float
+    reason: str
+
+
+class LatencyTracker:
+    """Rolling sample of normalized task latencies across the whole fleet"""
+    samples: deque[float]
+
+    def __init__(self, size: int = 1000):
+        self.samples = deque(maxlen=size)
+        self.cache: dict[float, float] = {}
+
+    def observe(self, latency: float, cost: float = 1.0) -> None:
+        self.samples.append(latency / max(cost, 1e-6))
+        self.cache.clear()
+
+    def percentile(self, p: float) -> float | None:
+        """
+        :param p: Percentile between 0 and 1
+        :return: Normalized latency at that percentile, or None if there are too few samples
+        """
+        if len(self.samples) < 20:
+            return None
+        if p not in self.cache:
+            s = sorted(self.samples)
+            self.cache[p] = s[min(int(p * len(s)), len(s) - 1)]
+        return self.cache[p]
+
+
+class RateMeter:
+    """Events per second over a sliding time window"""
+    events: deque[float]
+
+    def __init__(self, window: float = 60):
+        self.window = window
+        self.events = deque()
+        self.started = time.monotonic()
+
+    def trim(self, now: float) -> None:
+        while self.events and self.events[0] < now - self.window:
+            self.events.popleft()
+
+    def mark(self) -> None:
+        now = time.monotonic()
+        self.events.append(now)
+        self.trim(now)
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        self.trim(now)
+        return len(self.events) / max(min(self.window, now - self.started), 1)
+
+
+@dataclass()
+class AimdLimiter:
+    """
+    Latency-target AIMD controller for the number of tasks a worker runs at the same time.
+
+    Completed task latencies are collected into windows of `limit` samples. At the end of each
+    window, the average latency is compared to the best latency of recent windows (the no-load
+    baseline). If it stays within `tolerance` of the baseline while the worker was saturated,
+    the limit grows by one. If it climbs above, the limit is multiplied by `backoff`.
+    """
+    limit: int
+    max_limit: int
+    min_limit: int = 1
+
+    # Average latency may exceed the baseline by this ratio before we back off
+    tolerance: float = 1.5
+    backoff: float = 0.75
+
+    # The baseline is the best latency of the last few windows, so that it recovers from a single
+    # lucky sample and follows long-term changes of the machine (e.g. thermal throttling)
+    baseline_windows: int = 20
+    bests: deque[float] = field(default_factory=deque)
+
+    history: deque[LimitChange] = field(default_factory=lambda: deque(maxlen=50))
+
+    # Current window
+    window: list[float] = field(default_factory=list)
+    window_start: float = field(default_factory=time.monotonic)
+    saturated: bool = False
+
+    def __post_init__(self):
+        self.history.append(LimitChange(time.time(), self.limit, 0, 0, 'initial'))
+
+    def mark_busy(self, running: int) -> None:
+        """Record the number of running tasks after a dispatch"""
+        if running >= self.limit:
+            self.saturated = True
+
+    def observe(self, latency: float, cost: float = 1.0) -> int:
+        """
+        Record the latency of a completed task
+
+        :param latency: Seconds between dispatch and result
+        :param cost: Relative size of the task, latency is normalized by it
+        :return: New limit
+        """
+        self.window.append(latency / max(cost, 1e-6))
+        if len(self.window) < self.limit:
+            return self.limit
+
+        now = time.monotonic()
+        avg = sum(self.window) / len(self.window)
+        throughput = len(self.window) / max(now - self.window_start, 1e-6)
+        self.bests.append(min(self.window))
+        if len(self.bests) > self.baseline_windows:
+            self.bests.popleft()
+
+        if avg > self.baseline * self.tolerance and self.limit > self.min_limit:
+            self.set_limit(max(self.min_limit, int(self.limit * self.backoff)), avg, throughput, 'latency')
+        elif avg <= self.baseline * self.tolerance and self.saturated and self.limit < self.max_limit:
+            self.set_limit(self.limit + 1, avg, throughput, 'probe')
+
+        self.window = []
+        self.window_start = now
+        self.saturated = False
+        return self.limit
+
+    @property
+    def baseline(self) -> float | None:
+        """Best normalized latency of recent windows, approximating the latency without contention"""
+        return min(self.bests) if self.bests else None
+
+    def set_limit(self, limit: int, latency: float, throughput: float, reason: str) -> None:
+        self.limit = limit
+        self.history.append(LimitChange(time.time(), limit, latency, throughput, reason))
+
+    def to_dict(self) -> dict:
+        return {'limit': self.limit, 'max_limit': self.max_limit, 'baseline': self.baseline,
+                'history': list(self.history)}
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+
+import numpy as np
+import scipy.fft
+
+# Backend of mel_spectrogram(): 'numpy', or 'tfio' for tensorflow_io, which the NumPy backend
+# reproduces (Hann-windowed magnitude STFT padded at the end, HTK mel filterbank without DC)
+MEL_BACKEND = os.environ.get('MEL_BACKEND', 'numpy')
+
+# Frames transformed at once, bounds the memory of the NumPy backend to a few MB for long recordings
+MEL_BLOCK_FRAMES = 1024
+
+# Frame step of the mel spectrogram of the analysis, window boundaries are aligned to it
+MEL_STRIDE = 512
+
+
+@lru_cache(maxsize=None)
+def hann_window(length: int) -> np.ndarray:
+    """Periodic Hann window, like tf.signal.hann_window"""
+    w = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(length) / length)).astype(np.float32)
+    w.flags.writeable = False
+    return w
+
+
+def hz_to_mel(f: np.ndarray | float) -> np.ndarray | float:
+    """HTK mel scale"""
+    return 1127.0 * np.log1p(np.asarray(f, np.float64) / 700.0)
+
+
+@lru_cache(maxsize=None)
+def mel_filterbank(sr: int, n_fft: int, mels: int, fmin: float, fmax: float) -> np.ndarray:
+    """
+    Mel filterbank like tf.signal.linear_to_mel_weight_matrix: triangles that are linear in mel,
+    evenly spaced between fmin and fmax, with the DC bin left out
+
+    :return: Weights of shape (n_fft // 2 + 1, mels), cached and read-only
+    """
+    bins = n_fft // 2 + 1
+    freqs = hz_to_mel(np.linspace(0, sr / 2, bins)[1:])[:, None]
+    edges = np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), mels + 2)
+    lower, center, upper = edges[:-2], edges[1:-1], edges[2:]
+
+    weights = np.maximum(0, np.minimum((freqs - lower) / (center - lower), (upper - freqs) / (upper - center)))
+    fb = np.zeros((bins, mels), np.float32)
+    fb[1:] = weights
+    fb.flags.writeable = False
+    return fb
+
+
+def frame_count(samples: int, stride: int) -> int:
+    """Frames of a signal padded at the end, like tf.signal.stft(pad_end=True)"""
+    return -(-samples // stride)
+
+
+def spectrogram(y: np.ndarray, n_fft: int, window: int, stride: int, fb: np.ndarray | None = None) -> np.ndarray:
+    """
+    Magnitude spectrogram like tfio.audio.spectrogram, projected on a filterbank if there is one.
+    Frames are transformed in blocks so that the frames and spectra of long files never exist at once.
+
+    :param y: Mono audio
+    :param n_fft: FFT size
+    :param window: Frame length
+    :param stride: Frame step
+    :param fb: Filterbank of shape (n_fft // 2 + 1, bands)
+    :return: (frames, n_fft // 2 + 1), or (frames, bands) with a filterbank
+    """
+    y = np.asarray(y, np.float32)
+    n = frame_count(len(y), stride)
+    padded = np.zeros(max(n - 1, 0) * stride + window, np.float32)
+    padded[:len(y)] = y
+    frames = np.lib.stride_tricks.sliding_window_view(padded, window)[::stride]
+    w = hann_window(window)
+
+    # Only the bins under the filterbank need magnitudes, e.g. up to 8 kHz of a 44.1 kHz file
+    lo, hi = 0, n_fft // 2 + 1
+    if fb is not None:
+        rows = np.flatnonzero(fb.any(axis=1))
+        lo, hi = (rows[0], rows[-1] + 1) if len(rows) else (0, 0)
+
+    out = np.zeros((n, hi - lo if fb is None else fb.shape[1]), np.float32)
+    for i in range(0, n, MEL_BLOCK_FRAMES):
+        mag = np.abs(scipy.fft.rfft(frames[i:i + MEL_BLOCK_FRAMES] * w, n_fft, axis=-1)[:, lo:hi])
+        out[i:i + MEL_BLOCK_FRAMES] = mag if fb is None else mag @ fb[lo:hi]
+    return out
+
+
+def mel_spectrogram(y: np.ndarray, sr: int, n_fft: int = 2048, window: int = 2048, stride: int = 512,
+                    mels: int = 128, fmin: float = 0, fmax: float = 8000, backend: str | None = None) -> np.ndarray:
+    """
+    Mel spectrogram of mono audio, equal to tfio.audio.melscale(tfio.audio.spectrogram(...)) within
+    float32 rounding
+
+    :param backend: 'numpy' or 'tfio', MEL_BACKEND by default
+    :return: float32 array of shape (frames, mels)
+    """
+    backend = backend or MEL_BACKEND
+    if backend == 'tfio':
+        import tensorflow_io as tfio
+
+        t = tfio.audio.spectrogram(y, n_fft, window, stride)
+        return tfio.audio.melscale(t, rate=sr, mels=mels, fmin=fmin, fmax=fmax).numpy()
+    if backend != 'numpy':
+        raise ValueError(f'Unknown mel backend {backend}')
+
+    return spectrogram(y, n_fft, window, stride, mel_filterbank(sr, n_fft, mels, fmin, fmax))
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# Pipeline stages that workers time and report with their results
+STAGES = ('decode', 'vad', 'praat', 'segmenter', 'mel', 'encode')
+
+# Default histogram buckets in seconds, from 1 ms to 10 min
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_local = threading.local()
+
+
+@contextmanager
+def collect_stages(timings: dict[str, float] | None = None) -> Iterator[dict[str, float]]:
+    """
+    Collect the durations of stages timed by stage() in this thread, e.g. while running a task
+
+    :param timings: Collect into this dict instead of a new one, e.g. the collected() dict of the
+        thread that handed work to this thread
+    """
+    previous = getattr(_local, 'timings', None)
+    _local.timings = timings = {} if timings is None else timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def collected() -> dict[str, float] | None:
+    """The dict of the collect_stages() of this thread, if there is one"""
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a pipeline stage, the duration is added to the current collect_stages() if there is one"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(v: float) -> str:
+    if math.isinf(v):
+        return '+Inf' if v > 0 else '-Inf'
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class Metric:
+    """A metric family in Prometheus text format, with one child per combination of label values"""
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 fn: Callable[[], float | dict[tuple, float]] | None = None):
+        """
+        :param name: Metric name
+        :param help: Description
+        :param labels: Label names
+        :param fn: Read the value(s) when rendering instead of keeping them. Returns a number, or a
+            dict mapping label values to numbers for labelled metrics
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+
+        # Metrics without labels are exported as 0 before their first update
+        self.values: dict[tuple, float] = {} if labels else {(): 0}
+
+    def key(self, labels: dict[str, str]) -> tuple:
+        return tuple(labels[n] for n in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        values = self.values
+        if self.fn is not None:
+            values = self.fn()
+            if not isinstance(values, dict):
+                values = {(): values}
+        for key, v in values.items():
+            yield f'{self.name}{format_labels(self.labels, key)} {format_value(v)}'
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}', *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.children: dict[tuple, list] = {}
+        if not labels:
+            self.child(())
+
+    def child(self, key: tuple) -> list:
+        """Per-bucket counts (the last one is +Inf) and sum of one combination of label values"""
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        return child
+
+    def observe(self, value: float, **labels: str) -> None:
+        child = self.child(self.key(labels))
+        child[0][bisect.bisect_left(self.buckets, value)] += 1
+        child[1] += value
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in self.children.items():
+            cumulative = 0
+            for le, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = f'le="{format_value(le)}"'
+                yield f'{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}'
+            yield f'{self.name}_count{format_labels(self.labels, key)} {cumulative}'
+
+
+class MetricSet:
+    """Metrics of one process, rendered together by the /metrics endpoint"""
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def add(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = (), fn=None) -> Counter:
+        return self.add(Counter(name, help, labels, fn))
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = (), fn=None) -> Gauge:
+        return self.add(Gauge(name, help, labels, fn))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = TIME_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
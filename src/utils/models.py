@@ -1,12 +1,16 @@
+from __future__ import annotations
+
 import re
-from dataclasses import dataclass
-from typing import Callable
+from asyncio import Future
+from dataclasses import dataclass, field
 
 from fastapi import WebSocket
 
 from database.db import Worker
+from utils import registry
+from utils.limiter import AimdLimiter
 
-version = 1
+version = 6
 TOKEN_RE = re.compile(r'^[A-Z0-9]{2048}$')
 UUID_RE = re.compile('[0-9A-F]{8}-[0-9A-F]{4}-4[0-9A-F]{3}-[89AB][0-9A-F]{3}-[0-9A-F]{12}', re.I)
 
@@ -21,8 +25,22 @@ class WorkerInfo:
     os: str
     cpu: any
 
+    # Supported task names mapped to their versions
+    tasks: dict[str, int] = field(default_factory=dict)
 
-@dataclass()
+    # Number of tasks the worker runs at once (its task processes)
+    capacity: int = 0
+
+    # Result of the calibration benchmark relative to a reference machine, 0 if unknown
+    speed: float = 0
+
+    # Session of the previous connection to resume, and the ids of the tasks of that session that
+    # the worker is still running or has results for
+    session: str | None = None
+    holding: list[str] = field(default_factory=list)
+
+
+@dataclass(eq=False)
 class ConnectedWorker:
     worker: WorkerInfo
     db: Worker
@@ -31,12 +49,109 @@ class ConnectedWorker:
     # Maximum simultaneous tasks that this worker can handle
     max_tasks: int
 
+    # Controller that tunes max_tasks from observed latency
+    limiter: AimdLimiter | None = None
+
+    # Number of tasks currently dispatched to this worker
+    running: int = 0
+
+    # Smoothed heartbeat round-trip time in seconds, None until the first pong
+    rtt: float | None = None
+
+    # Heartbeat that is waiting for a pong (sequence number, time.monotonic when sent), and the
+    # number of heartbeats in a row that were not answered
+    ping: tuple[int, float] | None = None
+    missed: int = 0
+
+    # Session id negotiated at the handshake, a reconnecting worker resumes it to keep its tasks
+    session: str | None = None
+
+    # Task cost (see coordinator.task_cost) that one slot processes per second, estimated from the
+    # calibration benchmark and refined by observed runtimes
+    speed: float = 1.0
+
+    # Expected finish times (time.monotonic) of the tasks dispatched to this worker, by task id
+    finishes: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def name(self) -> str:
+        """Label of the worker in metrics"""
+        return str(self.db.id) if self.db is not None else self.ws.client.host
+
+    @property
+    def trusted(self) -> bool:
+        return self.db is not None and self.db.trusted
+
+    @property
+    def free_slots(self) -> int:
+        return max(self.max_tasks - self.running, 0)
+
+    @property
+    def load(self) -> float:
+        return self.running / self.max_tasks if self.max_tasks else float('inf')
+
 
 @dataclass()
 class Task:
     id: str
-    fn: Callable
+
+    # Registered task name, see utils.registry
+    fn: str
+
+    # Keyword arguments of the task, they must be json serializable
     params: dict
 
+    # Estimated audio duration in seconds, used to derive deadlines
+    duration: float = 0
+
+    # Size of the uploaded file in bytes
+    size: int = 0
+
+    # Digest of the spooled upload. If set, the file is streamed to the worker in chunk frames after
+    # the task and passed to fn as the `file` parameter.
+    audio: str | None = None
+
     def run(self):
-        return self.fn(**self.params)
+        return registry.resolve(self.fn)(**self.params)
+
+    def to_header(self) -> list:
+        """Fields in declaration order, the compact header of a COMPUTE message"""
+        return list(vars(self).values())
+
+    @classmethod
+    def from_header(cls, header: list) -> "Task":
+        return cls(*header)
+
+
+@dataclass()
+class TaskState:
+    """Coordinator-side bookkeeping of a task until its result is delivered"""
+    task: Task
+    future: Future
+
+    # Workers the task is currently dispatched to, mapped to the dispatch time (time.monotonic)
+    dispatches: dict[ConnectedWorker, float] = field(default_factory=dict)
+
+    # Workers that missed the deadline for this task, the task will not be sent to them again
+    expired: set[ConnectedWorker] = field(default_factory=set)
+
+    # Number of times this task was dispatched
+    attempts: int = 0
+
+    # Whether a speculative duplicate has already been started
+    speculated: bool = False
+
+    # Result cache key of the request, if its result is cached
+    key: str | None = None
+
+    # Verification jobs are only dispatched to trusted workers with spare capacity
+    low_priority: bool = False
+
+    # When the task last entered a queue (time.monotonic)
+    queued_at: float = 0
+
+    # Whether the task was offered to other coordinators through the broker
+    offered: bool = False
+
+    # Coordinator that holds the request, if this one claimed the task from the broker
+    origin: str | None = None
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+from typing import NamedTuple
+
+from bot.bdict_encoder import bdict_decode
+
+# Byte length of int
+INT = 4
+
+# Message types (first byte of binary frames)
+COMPUTE = b'T'
+CHUNK = b'C'
+RESULT = b'R'
+ERROR = b'E'
+EVENT = b'V'
+PING = b'P'
+PONG = b'O'
+
+# Payload bytes per CHUNK frame. Audio sent to workers and results larger than this are split into
+# chunk frames, which stay below the 1 MiB default message size limit of websockets clients and
+# the 16 MiB limit of uvicorn.
+CHUNK_SIZE = 256 * 1024
+
+# Reused compact encoder, json.dumps with custom separators would create a new one every call
+HEADER_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+class Message(NamedTuple):
+    type: bytes
+    header: dict | list
+    sections: dict[str, memoryview]
+
+
+def encode_parts(type: bytes, header: dict | list, sections: dict[str, bytes] | None = None) -> list[bytes]:
+    """
+    Encode a message between the coordinator and workers.
+
+    - Byte 0          : Message type
+    - Byte 1 - 5      : lh = An int - the length (bytes) of the header
+    - Byte 5 - 5+lh   : Header fields as compact json in utf-8
+    - Byte 5+lh - end : Raw payload sections in bdict layout (see bdict_encode)
+
+    The message is returned as a list of fragments so that section payloads are not copied into a
+    new buffer. websockets clients send an iterable as one fragmented message.
+
+    :param type: Message type
+    :param header: Header fields (json serializable)
+    :param sections: Raw payload sections
+    :return: Message fragments
+    """
+    h = HEADER_ENCODER.encode(header).encode('utf-8')
+    parts = [type + len(h).to_bytes(INT, 'big') + h]
+    for k, v in (sections or {}).items():
+        k = k.encode('utf-8')
+        parts.append(len(k).to_bytes(INT, 'big') + len(v).to_bytes(INT, 'big') + k)
+        parts.append(v)
+    return parts
+
+
+def encode_message(type: bytes, header: dict | list, sections: dict[str, bytes] | None = None) -> bytes:
+    """Encode a message into one buffer, see encode_parts()"""
+    return b''.join(encode_parts(type, header, sections))
+
+
+def encode_result(id: str, timings: dict, result: bytes) -> list[list[bytes]]:
+    """
+    Encode the result of a task. Results up to CHUNK_SIZE are sent as one RESULT message. Larger
+    results are sent like audio is sent to workers: a RESULT message with their size and no
+    sections, followed by CHUNK frames of the result.
+
+    :param id: Task id
+    :param timings: Seconds spent in each stage
+    :param result: Result body
+    :return: Messages to send in order, each as fragments (see encode_parts())
+    """
+    if len(result) <= CHUNK_SIZE:
+        return [encode_parts(RESULT, {'id': id, 'timings': timings}, {'result': result})]
+
+    view = memoryview(result)
+    return [encode_parts(RESULT, {'id': id, 'timings': timings, 'size': len(result)}),
+            *(encode_parts(CHUNK, {'id': id, 'offset': i}, {'data': view[i: i + CHUNK_SIZE]})
+              for i in range(0, len(result), CHUNK_SIZE))]
+
+
+def decode_message(frame: bytes) -> Message:
+    """
+    Decode a message. Sections are memoryviews into the frame, so they are not copied.
+
+    :param frame: Message bytes
+    :return: Message
+    """
+    view = memoryview(frame)
+    lh = int.from_bytes(view[1: 1 + INT], 'big')
+    header = json.loads(bytes(view[1 + INT: 1 + INT + lh]))
+    return Message(bytes(view[:1]), header, bdict_decode(view[1 + INT + lh:]))
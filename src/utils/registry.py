@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import importlib
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable
+
+
+@dataclass(frozen=True)
+class TaskSpec:
+    name: str
+
+    # Bump when the parameters or the result format of the task change
+    version: int
+
+    # Import path of the function as 'module:function', only imported on workers
+    target: str
+
+    # Import path of a function that loads the task's models, called once in each task process
+    # before the first task so that tasks don't pay for it
+    warmup: str | None = None
+
+    # Format of the result body, 'bdict' (see RawComputeResults.to_bdict) or 'json'. Results are
+    # compared in this format when they are verified.
+    result: str = 'bdict'
+
+
+# Tasks that workers can run, keyed by name. The coordinator only refers to tasks by name, so it
+# doesn't need to import the compute stack.
+TASKS: dict[str, TaskSpec] = {s.name: s for s in [
+    TaskSpec('compute_audio', 4, 'tasks:compute_audio', 'tasks:load'),
+    TaskSpec('compute_window', 4, 'tasks:compute_window', 'tasks:load'),
+    TaskSpec('classify_features', 1, 'tasks:classify_features', result='json'),
+]}
+
+
+# Stage that a worker can run in one process for all of its task processes, batching the inputs of
+# concurrent tasks: import paths of (model loader, batched function), see utils.batching
+BATCHED_STAGE = ('tasks:load', 'tasks:segment_batch')
+
+
+def versions() -> dict[str, int]:
+    """Task versions supported by this side, sent by workers during the handshake"""
+    return {name: s.version for name, s in TASKS.items()}
+
+
+@lru_cache(maxsize=None)
+def resolve(name: str) -> Callable:
+    """
+    Import the function of a registered task
+
+    :param name: Task name
+    :return: Task function
+    """
+    if name not in TASKS:
+        raise KeyError(f'Unknown task {name}')
+
+    return load_target(TASKS[name].target)
+
+
+def load_target(target: str) -> Callable:
+    """Import a function by its 'module:function' path"""
+    module, fn = target.split(':')
+    return getattr(importlib.import_module(module), fn)
+
+
+def warm() -> None:
+    """Import every registered task and load its models"""
+    for name, spec in TASKS.items():
+        resolve(name)
+        if spec.warmup:
+            load_target(spec.warmup)()
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import base64
+import json
+from typing import Iterable, NamedTuple
+
+import numpy as np
+
+from bot.bdict_encoder import bdict_encode, bdict_decode
+
+
+# Parts of an analysis that can be requested: segments of the ML model, the spectrogram with pitch
+# and formants drawn on it, and statistics of the features
+COMPONENTS = ('ml', 'spect', 'stats')
+
+# Components that need the Praat features (pitch and formants)
+FEATURE_COMPONENTS = ('spect', 'stats')
+
+
+def parse_components(components: Iterable[str] | str | None) -> tuple[str, ...]:
+    """
+    Validate a selection of components
+
+    :param components: Names, or a comma separated string of names. None selects all of them
+    :return: Selected components in the order of COMPONENTS
+    :raises ValueError: If a name is unknown or nothing is selected
+    """
+    if components is None:
+        return COMPONENTS
+    if isinstance(components, str):
+        components = [c.strip() for c in components.split(',') if c.strip()]
+    components = set(components)
+    if unknown := components - set(COMPONENTS):
+        raise ValueError(f'Unknown components {", ".join(sorted(unknown))}, expected some of {", ".join(COMPONENTS)}')
+    if not components:
+        raise ValueError('No components selected')
+    return tuple(c for c in COMPONENTS if c in components)
+
+
+def b64(nd: np.ndarray) -> dict[str, any]:
+    return {'bytes': base64.b64encode(nd.tobytes()).decode(), 'shape': nd.shape}
+
+
+class RawComputeResults(NamedTuple):
+    result: dict
+    freq_array: np.ndarray
+    ml: list
+    mel_spectrogram: np.ndarray
+    sr: int
+    audio_dur: float
+
+    # Seconds spent in each stage. They differ between runs, so they are not part of the result body
+    # that is cached and verified, workers report them in the RESULT header instead.
+    timings: dict[str, float]
+
+    # Components that were computed, the parts of other components are empty
+    components: tuple[str, ...] = COMPONENTS
+
+    def to_json_dict(self) -> dict:
+        return {'result': self.result, 'ml': self.ml, 'freq_array': b64(self.freq_array.T),
+                'spec': b64(self.mel_spectrogram), 'spec_sr': self.sr, 'components': self.components}
+
+    def to_bdict(self) -> bytes:
+        j = {'result': self.result, 'ml': self.ml, 'spec_sr': self.sr,
+             'spec_rows': self.mel_spectrogram.shape[0], 'audio_dur': self.audio_dur, 'components': self.components}
+        bd = {'freq_array': self.freq_array.T.tobytes(), 'spec': self.mel_spectrogram.tobytes(),
+              'json': json.dumps(j)}
+        return bdict_encode(bd)
+
+    @classmethod
+    def from_bdict(cls, b: bytes | memoryview) -> RawComputeResults:
+        """Decode a result of to_bdict(), e.g. of a window computed by a worker"""
+        d = bdict_decode(b)
+        j = json.loads(bytes(d['json']))
+        freq_array = np.frombuffer(d['freq_array'], 'float32').reshape(4, -1).T
+        spec = np.frombuffer(d['spec'], 'float32')
+        spec = spec.reshape(j['spec_rows'], -1) if j['spec_rows'] else spec.reshape(0, 0)
+        return cls(j['result'], freq_array, j['ml'], spec, j['spec_sr'], j['audio_dur'], {},
+                   tuple(j.get('components', COMPONENTS)))
+
+    def select(self, components: Iterable[str]) -> RawComputeResults:
+        """
+        Keep only the parts of some components: 'stats' keeps result, 'spect' keeps the spectrogram and
+        freq_array, 'ml' keeps the segments
+        """
+        components = parse_components(components)
+        return self._replace(
+            result=self.result if 'stats' in components else {},
+            freq_array=self.freq_array if 'spect' in components else np.zeros((0, 4), np.float32),
+            mel_spectrogram=self.mel_spectrogram if 'spect' in components else np.zeros((0, 0), np.float32),
+            ml=self.ml if 'ml' in components else [],
+            components=components)
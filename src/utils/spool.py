@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Callable, Awaitable
+
+import aiofiles
+from fastapi import UploadFile
+
+from utils.audio_info import estimate_duration, probe_duration
+from utils.protocol import CHUNK_SIZE
+
+# Locks of the spool directories claimed by this process, held until it exits
+_locks: list = []
+
+
+def claim(root: Path) -> Path:
+    """
+    Claim a spool directory for this process: the first of root/0, root/1, ... that no running
+    process holds. Coordinators that share a root (e.g. uvicorn --workers) get separate directories,
+    and a restarted coordinator reuses a directory instead of leaving a new one behind.
+
+    Entries of root that are not spool directories are left over from older layouts and removed.
+
+    :param root: Directory that holds the spool directories
+    :return: Spool directory, locked until the process exits
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(1 << 16):
+        lock = open(root / f'{i}.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        _locks.append(lock)
+        break
+    else:
+        raise RuntimeError(f'No free spool directory in {root}')
+
+    for f in root.iterdir():
+        if not f.name.removesuffix('.lock').isdigit():
+            remove(f)
+    return root / str(i)
+
+
+def remove(path: Path) -> None:
+    """Delete a file or a directory tree, if it still exists"""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+@dataclass()
+class StoredAudio:
+    sha: str
+    size: int
+    duration: float
+
+    # Whether the duration was read from the header of the file, otherwise it is estimated from its size
+    probed: bool = False
+
+
+class AudioStore:
+    """
+    Content-addressed on-disk spool of uploaded audio.
+
+    Uploads are written to `path/<sha256>` while being hashed, so queued tasks only need to keep
+    the digest in memory. Identical uploads share one file, which is deleted when the last request
+    referencing it releases it.
+    """
+    refs: dict[str, int]
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.refs = {}
+
+        # Files left over from a previous run are not referenced by anything
+        for f in self.path.iterdir():
+            remove(f)
+
+    def file(self, sha: str) -> Path:
+        return self.path / sha
+
+    async def save(self, upload: UploadFile) -> StoredAudio:
+        """
+        Spool an upload to disk in chunks, computing its digest on the way
+
+        :param upload: Uploaded file
+        :return: Stored audio, release() it when it is no longer needed
+        """
+        h = hashlib.sha256()
+        size = 0
+        tmp = self.path / f'{uuid.uuid4()}.part'
+        try:
+            async with aiofiles.open(tmp, 'wb') as f:
+                while chunk := await upload.read(CHUNK_SIZE):
+                    h.update(chunk)
+                    size += len(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            # E.g. the client disconnected during the upload
+            tmp.unlink(missing_ok=True)
+            raise
+
+        sha = h.hexdigest()
+        if sha in self.refs:
+            tmp.unlink()
+        else:
+            os.replace(tmp, self.file(sha))
+        self.refs[sha] = self.refs.get(sha, 0) + 1
+
+        # Probing may read through files without a length in their header, e.g. some MP3s
+        duration = await asyncio.to_thread(probe_duration, self.file(sha))
+        if duration is None:
+            return StoredAudio(sha, size, estimate_duration(size))
+        return StoredAudio(sha, size, duration, True)
+
+    async def put(self, data: bytes, duration: float) -> StoredAudio:
+        """
+        Store audio made by this process, e.g. a segment of an upload
+
+        :param data: File content
+        :param duration: Duration in seconds
+        :return: Stored audio, release() it when it is no longer needed
+        """
+        sha = hashlib.sha256(data).hexdigest()
+        if sha not in self.refs:
+            tmp = self.path / f'{uuid.uuid4()}.part'
+            try:
+                async with aiofiles.open(tmp, 'wb') as f:
+                    await f.write(data)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+
+            # Another request may have stored it in the meantime
+            if sha in self.refs:
+                tmp.unlink()
+            else:
+                os.replace(tmp, self.file(sha))
+        self.refs[sha] = self.refs.get(sha, 0) + 1
+        return StoredAudio(sha, len(data), duration, True)
+
+    async def fetch(self, sha: str, load: Callable[[Path], Awaitable[None]]) -> None:
+        """
+        Add a reference to a file, loading it from elsewhere if it is not stored yet
+
+        :param sha: Digest of the file
+        :param load: Function that writes the file to the given path
+        """
+        if sha not in self.refs:
+            tmp = self.path / f'{uuid.uuid4()}.part'
+            try:
+                await load(tmp)
+            except BaseException:
+                tmp.unlink(missing_ok=True)
+                raise
+
+            # Another request may have stored it in the meantime
+            if sha in self.refs:
+                tmp.unlink()
+            else:
+                os.replace(tmp, self.file(sha))
+                self.refs[sha] = 0
+        self.refs[sha] += 1
+
+    def retain(self, sha: str) -> None:
+        """Add a reference to a stored file"""
+        self.refs[sha] += 1
+
+    def release(self, sha: str) -> None:
+        """Drop one reference to a stored file, deleting it after the last one"""
+        self.refs[sha] -= 1
+        if self.refs[sha] <= 0:
+            del self.refs[sha]
+            self.file(sha).unlink(missing_ok=True)
+
+    def chunks(self, sha: str) -> Iterator[tuple[int, bytes]]:
+        """
+        Read a stored file through mmap, chunk by chunk
+
+        :return: Iterator of (offset, chunk)
+        """
+        with open(self.file(sha), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for i in range(0, len(mm), CHUNK_SIZE):
+                    yield i, mm[i: i + CHUNK_SIZE]
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from utils.metrics import collect_stages, collected, stage
+
+# Threads that run the stages of a task in each task process. Praat holds the GIL, but TensorFlow
+# and the Segmenter's batch requests release it, so independent stages overlap on threads.
+STAGE_THREADS = int(os.environ.get('STAGE_THREADS', 3))
+
+_executor: ThreadPoolExecutor | None = None
+
+
+@dataclass()
+class Stage:
+    """A step of a task that runs once the stages it depends on are done"""
+    name: str
+    fn: Callable[..., Any]
+
+    # Names of the stages (or inputs) whose outputs are passed to fn as keyword arguments
+    after: tuple[str, ...] = ()
+
+
+def executor() -> ThreadPoolExecutor:
+    """Thread pool of this process, created on first use"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(STAGE_THREADS, thread_name_prefix='stage')
+    return _executor
+
+
+def run_timed(s: Stage, timings: dict[str, float] | None, kwargs: dict[str, Any]) -> Any:
+    """Run a stage on a pool thread, timed into the collect_stages() of the thread that started it"""
+    with collect_stages(timings), stage(s.name):
+        return s.fn(**kwargs)
+
+
+def run_stages(stages: list[Stage], **inputs: Any) -> dict[str, Any]:
+    """
+    Run a graph of stages on the thread pool, each one as soon as the stages it depends on are done
+
+    :param stages: Stages
+    :param inputs: Known outputs that stages can depend on, by name
+    :return: Outputs of every stage and input by name
+    :raises Exception: The first exception raised by a stage, once the stages that were already
+        running have finished. Stages that didn't start yet are skipped.
+    """
+    outputs = dict(inputs)
+    pending = {s.name: s for s in stages}
+    running: dict[Future, str] = {}
+    timings = collected()
+    error: Exception | None = None
+
+    while running or (pending and error is None):
+        if error is None:
+            for name, s in list(pending.items()):
+                if all(d in outputs for d in s.after):
+                    del pending[name]
+                    kwargs = {d: outputs[d] for d in s.after}
+                    running[executor().submit(run_timed, s, timings, kwargs)] = name
+
+            if not running:
+                raise ValueError(f'Stages {", ".join(pending)} depend on outputs that no stage produces')
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for f in done:
+            name = running.pop(f)
+            try:
+                outputs[name] = f.result()
+            except Exception as e:
+                error = error or e
+
+    if error is not None:
+        raise error
+    return outputs
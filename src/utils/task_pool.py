@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from utils import registry
+from utils.batching import BatchProcess, BatchProcessDied, connect
+from utils.metrics import collect_stages
+from utils.models import Task
+
+
+def ready() -> None:
+    """No-op job, submitted once per process to start the pool"""
+
+
+def execute(header: list, file: bytes | bytearray | None) -> tuple[bytes, dict[str, float]]:
+    """
+    Run a task in a pool process
+
+    :param header: Task.to_header() of the task
+    :param file: Audio of the task, passed to the task function as `file`
+    :return: Result and seconds spent in each pipeline stage
+    """
+    task = Task.from_header(header)
+    if file is not None:
+        task.params['file'] = file
+    with collect_stages() as timings:
+        return task.run(), timings
+
+
+class TaskCrashed(Exception):
+    """Raised when the process running a task died"""
+
+
+class TaskPool:
+    """
+    Pool of pre-warmed processes that run tasks off the event loop.
+
+    With more than one process and a batch size above one, the batched stage of the registry runs in
+    an extra process that batches the inputs of concurrent tasks (see utils.batching).
+
+    A process that dies (e.g. killed for running out of memory) breaks the whole executor, so the
+    tasks that were running in it fail with TaskCrashed and the pool is replaced.
+    """
+
+    def __init__(self, processes: int, batch_size: int = 1, batch_window: float = 0):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.executor = None
+        self.batch = None
+
+    async def start(self) -> None:
+        """Start all processes and wait until they imported the tasks"""
+        # Spawn rather than fork, since tensorflow doesn't support forking after it is initialized
+        context = multiprocessing.get_context('spawn')
+        initializer, initargs = registry.warm, ()
+        if self.processes > 1 and self.batch_size > 1:
+            self.batch = BatchProcess(context, self.processes, *registry.BATCHED_STAGE, self.batch_size, self.batch_window)
+            initializer, initargs = connect, self.batch.initargs()
+
+        self.executor = ProcessPoolExecutor(self.processes, context, initializer=initializer, initargs=initargs)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, ready) for _ in range(self.processes)])
+        if self.batch:
+            await asyncio.to_thread(self.batch.wait)
+
+    async def run(self, task: Task, file: bytes | bytearray | None) -> tuple[bytes, dict[str, float]]:
+        """
+        Run a task in one of the processes
+
+        :raises TaskCrashed: If the process died
+        """
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, execute, task.to_header(), file)
+        except (BrokenProcessPool, BatchProcessDied) as e:
+            # The first task that notices replaces the pool
+            if self.executor is executor:
+                print(f'[-] Task process died, restarting {self.processes} processes')
+                self.shutdown()
+                await self.start()
+            raise TaskCrashed(str(e) or 'Task process died')
+
+    def shutdown(self) -> None:
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.batch:
+            self.batch.stop()
+            self.batch = None
@@ -1,11 +1,16 @@
 import multiprocessing
+import os
 import platform
 import random
 import string
+import time
 from pathlib import Path
 
+import numpy as np
+import psutil
 from cpuinfo import cpuinfo
 
+from utils import registry
 from utils.models import version
 
 
@@ -24,10 +29,47 @@ def load_token() -> str:
         return load_token()
 
 
+# Memory that one task process needs with the models loaded
+PROCESS_MEMORY = 2 * 1024 * 1024 * 1024
+
+
+def worker_capacity() -> int:
+    """Number of task processes, WORKER_PROCESSES or as many as the CPUs and available memory allow"""
+    if 'WORKER_PROCESSES' in os.environ:
+        return max(int(os.environ['WORKER_PROCESSES']), 1)
+    return max(min(multiprocessing.cpu_count(), psutil.virtual_memory().available // PROCESS_MEMORY), 1)
+
+
+# Seconds of audio per second that a reference machine processes in calibrate()
+CALIBRATION_REFERENCE = 700
+
+
+def calibrate(seconds: float = 0.5) -> float:
+    """
+    Short benchmark of the spectral work that tasks do (windowed FFTs and a mel projection of 10 s of
+    16 kHz audio), run at connect time so that the coordinator can place tasks by speed
+
+    :param seconds: Time to run the benchmark for
+    :return: Speed relative to the reference machine
+    """
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal(16000 * 10).astype(np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(y, 2048)[::512] * np.hanning(2048).astype(np.float32)
+    basis = rng.random((1025, 128)).astype(np.float32)
+
+    start = time.perf_counter()
+    runs = 0
+    while (elapsed := time.perf_counter() - start) < seconds:
+        np.abs(np.fft.rfft(frames, axis=1)) ** 2 @ basis
+        runs += 1
+    return runs * 10 / elapsed / CALIBRATION_REFERENCE
+
+
 def get_worker_info():
     cpu_info = cpuinfo.get_cpu_info()
     cpu_info['flags'] = None
 
     return {'token': load_token(), 'version': version, 'cpu_count': multiprocessing.cpu_count(),
-            'platform': platform.platform(), 'os': platform.system(), 'cpu': cpu_info}
+            'platform': platform.platform(), 'os': platform.system(), 'cpu': cpu_info,
+            'tasks': registry.versions(), 'capacity': worker_capacity(), 'speed': calibrate()}
 
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import os
+
+import numpy as np
+
+from utils.decode import Audio
+
+# Energy-based voice activity detection before Praat and the mel spectrogram, which then only run on
+# speech: Praat analyzes each region of speech on its own, and the mel frames outside of speech are
+# zero. VAD=1 enables it, it changes the results, so it is off by default. The Segmenter always sees
+# the whole recording, its networks already skip the frames that its own energy detection labels
+# noEnergy.
+VAD = os.environ.get('VAD', '0') == '1'
+
+# A frame is speech if its level is less than VAD_RELATIVE_DB below the loudest frame and above
+# VAD_FLOOR_DB (dBFS)
+VAD_RELATIVE_DB = float(os.environ.get('VAD_RELATIVE_DB', 40))
+VAD_FLOOR_DB = float(os.environ.get('VAD_FLOOR_DB', -60))
+
+# Silences shorter than VAD_MIN_SILENCE seconds are kept, and VAD_PADDING seconds of context are
+# kept around speech, so that Praat's analysis windows see the onsets and decays of voice
+VAD_MIN_SILENCE = float(os.environ.get('VAD_MIN_SILENCE', 1))
+VAD_PADDING = float(os.environ.get('VAD_PADDING', 0.25))
+
+# Recordings that are mostly speech are analyzed whole, trimming them saves less than it costs
+VAD_MAX_SHARE = float(os.environ.get('VAD_MAX_SHARE', 0.9))
+
+# Seconds per frame of the level measurement
+VAD_FRAME = 0.02
+
+
+def frame_levels(y: np.ndarray, frame: int) -> np.ndarray:
+    """
+    RMS level of consecutive frames, the last one may be shorter
+
+    :param y: Mono audio in [-1, 1]
+    :param frame: Samples per frame
+    :return: dBFS of each frame, -200 for digital silence
+    """
+    n = -(-len(y) // frame)
+    padded = np.zeros(n * frame, np.float32)
+    padded[:len(y)] = y
+    power = np.einsum('ij,ij->i', padded.reshape(n, frame), padded.reshape(n, frame))
+    counts = np.full(n, frame)
+    if n:
+        counts[-1] = len(y) - (n - 1) * frame
+    return 10 * np.log10(np.maximum(power / counts, 1e-20))
+
+
+def speech_regions(audio: Audio, align: int = 1) -> np.ndarray:
+    """
+    Find the parts of a recording that contain speech
+
+    :param audio: Decoded audio
+    :param align: Region starts are rounded down to multiples of this, e.g. a spectrogram stride
+    :return: Disjoint (start, stop) sample ranges in order, shape (regions, 2)
+    """
+    y, sr = audio
+    frame = max(int(VAD_FRAME * sr), 1)
+    levels = frame_levels(y, frame)
+    if not len(levels):
+        return np.zeros((0, 2), np.int64)
+
+    active = levels > max(levels.max() - VAD_RELATIVE_DB, VAD_FLOOR_DB)
+
+    # Runs of active frames, from the edges of the active mask
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], active.view(np.int8), [0]])))
+    starts, stops = edges[::2], edges[1::2]
+    if not len(starts):
+        return np.zeros((0, 2), np.int64)
+
+    # Join runs separated by short silences
+    gaps = starts[1:] - stops[:-1]
+    keep = np.concatenate([[True], gaps >= VAD_MIN_SILENCE / VAD_FRAME])
+    starts, stops = starts[keep], np.concatenate([stops[:-1][keep[1:]], stops[-1:]])
+
+    # Pad, align and clip in samples, then join runs whose padding overlaps
+    pad = int(VAD_PADDING * sr)
+    starts = np.maximum(starts * frame - pad, 0) // align * align
+    stops = np.minimum(stops * frame + pad, len(y))
+    first = np.flatnonzero(np.concatenate([[True], starts[1:] > stops[:-1]]))
+    return np.stack([starts[first], np.maximum.reduceat(stops, first)], 1).astype(np.int64)
+
+
+def speech(audio: Audio, align: int = 1) -> np.ndarray | None:
+    """
+    Speech regions that the costly stages should be restricted to
+
+    :return: Regions (see speech_regions()), or None to analyze the whole recording
+    """
+    if not VAD or not len(audio.y):
+        return None
+    regions = speech_regions(audio, align)
+    if (regions[:, 1] - regions[:, 0]).sum() > VAD_MAX_SHARE * len(audio.y):
+        return None
+    return regions
+
+
+def row_regions(regions: np.ndarray, sr: int, step: float) -> np.ndarray:
+    """
+    Move the starts of regions back to rows of a frame-by-frame analysis, so that the rows computed
+    on each region are rows of the analysis of the whole recording
+
+    :param regions: Regions (see speech_regions())
+    :param sr: Sample rate
+    :param step: Seconds per row
+    :return: Regions starting at the sample of a row
+    """
+    rows = regions[:, 0] // (step * sr)
+    return np.stack([np.round(rows * step * sr).astype(np.int64), regions[:, 1]], 1)
+
+
+def place_rows(parts: list[np.ndarray], regions: np.ndarray, samples: int, sr: int, step: float) -> np.ndarray:
+    """
+    Map the rows of frame-by-frame analyses of each region back onto the timeline of the recording,
+    rows outside the regions are NaN
+
+    :param parts: Rows computed on each region, each `step` seconds from the start of the region
+    :param regions: Regions, starting at rows (see row_regions())
+    :param samples: Length of the recording
+    :param sr: Sample rate
+    :param step: Seconds per row
+    :return: Rows of the whole recording
+    """
+    to_row = 1 / (step * sr)
+    out = np.full((round(samples * to_row), *parts[0].shape[1:]), np.nan, parts[0].dtype)
+    for rows, (a, b) in zip(parts, regions):
+        dst = round(a * to_row)
+        part = rows[:max(round(b * to_row) - dst, 0)][:len(out) - dst]
+        out[dst:dst + len(part)] = part
+    return out
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import json
+import math
+import random
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+from bot.bdict_encoder import bdict_decode
+from database.db import Worker
+
+# Result sections that hold float32 arrays, everything else except json is compared byte by byte
+FLOAT_SECTIONS = {'freq_array', 'spec'}
+
+
+@dataclass()
+class Tolerance:
+    # Float values and arrays match if |a - b| <= atol + rtol * |b|
+    rtol: float = 1e-3
+    atol: float = 1e-4
+
+    # Minimum share of the audio duration that ml segments must label the same way
+    min_overlap: float = 0.95
+
+
+def segment_agreement(a: list, b: list) -> float:
+    """
+    Share of the labelled duration on which two segmentations agree
+
+    :param a: Segments [label, start, end, confidence] sorted by start, not overlapping each other,
+        the confidence is ignored
+    :param b: Segments of the same form
+    :return: Duration where both have the same label, divided by the longer total duration
+    """
+    total = max(sum(e - s for _, s, e, *_ in a), sum(e - s for _, s, e, *_ in b))
+    if total <= 0:
+        return 1.0
+
+    common = 0.0
+    i = j = 0
+    while i < len(a) and j < len(b):
+        la, sa, ea, *_ = a[i]
+        lb, sb, eb, *_ = b[j]
+        if la == lb:
+            common += max(min(ea, eb) - max(sa, sb), 0)
+        if ea < eb:
+            i += 1
+        else:
+            j += 1
+    return common / total
+
+
+def compare_values(a: any, b: any, tol: Tolerance, path: str = '') -> str | None:
+    """
+    Compare decoded json values, floats within tolerance and `ml` segments by overlap
+
+    :return: Description of the first mismatch, or None if they match
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        if a.keys() != b.keys():
+            return f'{path}: keys {sorted(a)} != {sorted(b)}'
+        for k in a:
+            if k == 'ml' and isinstance(a[k], list) and isinstance(b[k], list):
+                agreement = segment_agreement(a[k], b[k])
+                if agreement < tol.min_overlap:
+                    return f'{path}.ml: segments agree on {agreement:.1%} of the duration'
+            elif r := compare_values(a[k], b[k], tol, f'{path}.{k}'):
+                return r
+        return None
+
+    if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            return f'{path}: length {len(a)} != {len(b)}'
+        for i, (x, y) in enumerate(zip(a, b)):
+            if r := compare_values(x, y, tol, f'{path}[{i}]'):
+                return r
+        return None
+
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)) \
+            and not isinstance(a, bool) and not isinstance(b, bool):
+        if (math.isnan(a) and math.isnan(b)) or math.isclose(a, b, rel_tol=tol.rtol, abs_tol=tol.atol):
+            return None
+        return f'{path}: {a} != {b}'
+
+    return None if a == b else f'{path}: {a!r} != {b!r}'
+
+
+def compare_results(expected: bytes | memoryview, actual: bytes | memoryview, tol: Tolerance,
+                    format: str = 'bdict') -> str | None:
+    """
+    Compare two results of the same task. Results computed on different hardware are not
+    bit-identical, so float arrays are compared with a tolerance and segments by overlap.
+
+    :param expected: Result of a trusted worker
+    :param actual: Result under verification
+    :param format: Format of the results, 'bdict' or 'json' (see registry.TaskSpec.result)
+    :return: Description of the first mismatch, or None if they match
+    """
+    if format == 'json':
+        return compare_values(json.loads(bytes(expected)), json.loads(bytes(actual)), tol)
+
+    a, b = bdict_decode(expected), bdict_decode(actual)
+    if a.keys() != b.keys():
+        return f'Sections {sorted(a)} != {sorted(b)}'
+
+    for k in a:
+        if k == 'json':
+            r = compare_values(json.loads(bytes(a[k])), json.loads(bytes(b[k])), tol)
+        elif k in FLOAT_SECTIONS:
+            x, y = np.frombuffer(a[k], 'float32'), np.frombuffer(b[k], 'float32')
+            if x.shape != y.shape:
+                r = f'{k}: shape {x.shape} != {y.shape}'
+            elif not np.allclose(y, x, rtol=tol.rtol, atol=tol.atol, equal_nan=True):
+                r = f'{k}: max difference {np.nanmax(np.abs(x - y))}'
+            else:
+                r = None
+        else:
+            r = None if a[k] == b[k] else f'{k}: bytes differ'
+        if r:
+            return r
+    return None
+
+
+@dataclass()
+class VerifyStats:
+    sampled: int = 0
+    skipped: int = 0
+    passed: int = 0
+    failed: int = 0
+    errors: int = 0
+
+
+class Verifier:
+    """
+    Re-runs randomly sampled results of untrusted workers on trusted workers.
+
+    A worker's results are sampled with probability 1 - trusted_level (at least `min_rate`), and
+    every passed check moves trusted_level `trust_step` of the way towards 1. A mismatch bans the
+    worker and resets its level.
+
+    The cost is bounded by `budget`: verification jobs may occupy at most this share of the slots
+    of trusted workers, and samples are dropped while `max_pending` jobs are waiting.
+    """
+    running: set[str]
+
+    def __init__(self, budget: float, min_rate: float, trust_step: float, max_pending: int, tolerance: Tolerance):
+        self.budget = budget
+        self.min_rate = min_rate
+        self.trust_step = trust_step
+        self.max_pending = max_pending
+        self.tolerance = tolerance
+        self.running = set()
+        self.stats = VerifyStats()
+
+    def rate(self, db: Worker | None) -> float:
+        """Probability that a result of this worker is verified"""
+        if db is None or db.trusted or self.budget <= 0:
+            return 0
+        return max(1 - db.trusted_level, self.min_rate)
+
+    def limit(self, trusted_capacity: int) -> int:
+        """Number of verification jobs that may run at once, rounded up so that small fleets verify too"""
+        return math.ceil(trusted_capacity * self.budget)
+
+    def sample(self, db: Worker | None, pending: int) -> bool:
+        """
+        Decide whether to verify a result
+
+        :param db: Worker that computed the result
+        :param pending: Number of verification jobs waiting to be dispatched
+        """
+        if random.random() >= self.rate(db):
+            return False
+        if pending >= self.max_pending:
+            self.stats.skipped += 1
+            return False
+        self.stats.sampled += 1
+        return True
+
+    def record(self, db: Worker, mismatch: str | None) -> None:
+        """
+        Update the trust of a worker after one of its results was checked
+
+        :param db: Worker that computed the result
+        :param mismatch: Result of compare_results(), None if the result passed
+        """
+        if mismatch is None:
+            self.stats.passed += 1
+            db.trusted_level += (1 - db.trusted_level) * self.trust_step
+        else:
+            self.stats.failed += 1
+            db.trusted_level = 0
+            db.approved = False
+
+    def to_dict(self) -> dict:
+        return {**asdict(self.stats), 'budget': self.budget, 'running': len(self.running)}
@@ -1,36 +1,132 @@
 import asyncio
 import json
 import os
+import random
 import traceback
+from collections import OrderedDict
 
 import websockets
-from hypy_utils.serializer import pickle_decode, pickle_encode
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosed
 from websockets.legacy.client import WebSocketClientProtocol
 
 from utils.models import Task
+from utils.protocol import decode_message, encode_parts, encode_message, encode_result, COMPUTE, CHUNK, ERROR, EVENT, \
+    PING, PONG
+from utils.task_pool import TaskPool, TaskCrashed
 from utils.utils import get_worker_info
 
 
-coordinator_host = os.environ['COORDINATOR_HOST']
-worker_info = get_worker_info()
+coordinator_host = os.environ.get('COORDINATOR_HOST')
 
+# Segmenter inputs of concurrent tasks are batched, up to this many files per forward pass, waiting
+# at most SEGMENT_BATCH_WINDOW seconds for more files
+SEGMENT_BATCH_SIZE = int(os.environ.get('SEGMENT_BATCH_SIZE', 8))
+SEGMENT_BATCH_WINDOW = float(os.environ.get('SEGMENT_BATCH_WINDOW', 0.05))
 
-async def start():
+# Results that could not be sent are kept for this many tasks, and sent again when the session is
+# resumed after reconnecting
+OUTBOX_SIZE = int(os.environ.get('OUTBOX_SIZE', 64))
+
+# Reconnects wait a random time of up to RECONNECT_BASE * 2 ^ (failed attempts) seconds, capped at
+# RECONNECT_MAX, so that workers don't all reconnect at once after a coordinator restart
+RECONNECT_BASE = float(os.environ.get('RECONNECT_BASE', 1))
+RECONNECT_MAX = float(os.environ.get('RECONNECT_MAX', 60))
+
+# Running tasks by id, referenced until they finish. They keep running while reconnecting.
+running: dict[str, asyncio.Task] = {}
+
+# Encoded results and errors that were not delivered, by task id. A result may take several
+# messages, see utils.protocol.encode_result
+outbox: OrderedDict[str, list[list[bytes]]] = OrderedDict()
+
+# Current connection, and the session negotiated with the coordinator
+connection: WebSocketClientProtocol | None = None
+session: str | None = None
+
+
+async def send_all(ws: WebSocketClientProtocol, messages: list[list[bytes]]) -> None:
+    for message in messages:
+        await ws.send(message)
+
+
+async def deliver(id: str, messages: list[list[bytes]]) -> None:
+    """
+    Send the result or error of a task, or keep it in the outbox until the session is resumed. A
+    result that was partly sent is sent again whole, the coordinator drops partial results when the
+    connection closes.
+    """
+    if connection is not None:
+        try:
+            await send_all(connection, messages)
+            return
+        except ConnectionClosed as e:
+            print(f'[-] Result of task {id} not sent, keeping it until reconnected ({e})')
+
+    outbox[id] = messages
+    while len(outbox) > OUTBOX_SIZE:
+        outbox.popitem(last=False)
+
+
+async def run_task(pool: TaskPool, task: Task, file: bytes | bytearray | None):
+    """Run a task in the process pool and send its result or error back as soon as it finishes"""
+    try:
+        result, timings = await pool.run(task, file)
+
+        # Stage timings are reported to the coordinator's metrics
+        messages = encode_result(task.id, timings, result)
+    except TaskCrashed as e:
+        # Not the task's fault, the coordinator gives it to another worker
+        messages = [encode_parts(ERROR, {'id': task.id, 'error': f'Task process died: {e}', 'crash': True})]
+    except Exception as e:
+        traceback.print_exc()
+        messages = [encode_parts(ERROR, {'id': task.id, 'error': f'{type(e).__name__}: {e}'})]
+
+    await deliver(task.id, messages)
+
+
+async def resume(ws: WebSocketClientProtocol, resumed: bool) -> None:
+    """Replay the outbox after the coordinator resumed the session, or drop it for a new session"""
+    if not resumed:
+        if outbox:
+            print(f'[-] Session not resumed, dropping {len(outbox)} undelivered results')
+        outbox.clear()
+        return
+
+    print(f'[+] Session resumed, sending {len(outbox)} undelivered results')
+    while outbox:
+        id, messages = next(iter(outbox.items()))
+        await send_all(ws, messages)
+        del outbox[id]
+
+
+async def start(worker_info: dict, pool: TaskPool) -> None:
+    global connection, session
     print(f'Connecting to ws://{coordinator_host}')
     async with websockets.connect(f'ws://{coordinator_host}/ws/worker-connect') as ws:
         ws: WebSocketClientProtocol
 
-        # Send worker information
-        await ws.send(json.dumps(worker_info))
+        # Send worker information, with the tasks of the previous session
+        await ws.send(json.dumps({**worker_info, 'session': session, 'holding': [*running, *outbox]}))
 
-        # Receive validation results
-        validation = await ws.recv()
-        if validation.strip() != 'Success':
-            raise ConnectionError(validation)
+        # Receive validation results and the session id
+        status, _, new_session = (await ws.recv()).strip().partition(' ')
+        if status != 'Success':
+            raise ConnectionError(f'{status} {new_session}')
         print('[+] Connected, start polling')
 
-        # Start receiving messages, they must be json format
+        resumed, session = new_session == session, new_session
+        await resume(ws, resumed)
+        connection = ws
+
+        # Tasks waiting for their audio, mapped to (task, file buffer, received bytes)
+        pending: dict[str, tuple[Task, bytearray, int]] = {}
+
+        def start_task(task: Task, file: bytes | bytearray | None = None):
+            t = asyncio.create_task(run_task(pool, task, file))
+            running[task.id] = t
+            t.add_done_callback(lambda _: running.pop(task.id, None))
+
+        # Start receiving messages, see utils.protocol for the format
         while True:
             msg = await ws.recv()
 
@@ -40,29 +136,72 @@ async def start():
                     print(f'Unknown message received: {msg}')
                 continue
 
-            msg = pickle_decode(msg)
+            msg = decode_message(msg)
+
+            # Heartbeat, answered right away so that the coordinator can measure the round trip
+            if msg.type == PING:
+                await ws.send(encode_message(PONG, msg.header))
+
+            # Audio chunk of a pending task, written straight into the preallocated file buffer
+            elif msg.type == CHUNK:
+                id, offset, data = msg.header['id'], msg.header['offset'], msg.sections['data']
+                if id not in pending:
+                    print(f'> Received chunk of unknown task {id}')
+                    continue
+
+                task, buf, received = pending[id]
+                buf[offset: offset + len(data)] = data
+                received += len(data)
+                if received < task.size:
+                    pending[id] = (task, buf, received)
+                    continue
+
+                del pending[id]
+                start_task(task, buf)
 
             # Event TODO: Event handlers
-            if msg['type'] == 'event':
-                print(f'> Received event {msg["event_type"]}')
+            elif msg.type == EVENT:
+                print(f'> Received event {msg.header["event_type"]}')
 
             # Compute command
-            elif msg['type'] == 'compute':
+            elif msg.type == COMPUTE:
                 print(f'> Received compute request.')
-                task: Task = msg['task']
-                print(task.fn)
-                result = task.run()
-                await ws.send(json.dumps({'id': task.id, 'result': result}))
+                task = Task.from_header(msg.header)
+
+                # Wait for the audio to arrive in chunks
+                if task.audio and task.size:
+                    pending[task.id] = (task, bytearray(task.size), 0)
+                    continue
+
+                start_task(task, b'' if task.audio else None)
 
             else:
                 print(f'> Received unknown message: {msg}')
 
 
-if __name__ == '__main__':
+async def main():
+    worker_info = get_worker_info()
+    pool = TaskPool(worker_info['capacity'], SEGMENT_BATCH_SIZE, SEGMENT_BATCH_WINDOW)
+    print(f'Starting {pool.processes} task processes')
+    await pool.start()
+
+    # The processes stay warm and tasks keep running across reconnects
+    global connection
+    failures = 0
     while True:
         try:
-            asyncio.run(start())
+            await start(worker_info, pool)
         except Exception as e:
             traceback.print_exc()
-            print(f'[-] Connection closed, reconnecting... ({str(e)})')
-            continue
+            print(f'[-] Connection closed ({str(e)})')
+
+        # Back off only while the connection keeps failing
+        failures = 0 if connection is not None else failures + 1
+        connection = None
+        delay = random.uniform(0, min(RECONNECT_BASE * 2 ** failures, RECONNECT_MAX))
+        print(f'[-] Reconnecting in {delay:.1f}s...')
+        await asyncio.sleep(delay)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())